@@ -1,24 +1,46 @@
 """Entry point with main script logic"""
 
 import os
+import csv
 import sys
 import shutil
-from time import sleep
+from itertools import cycle
+from argparse import Namespace
+from time import sleep, strftime, perf_counter
 
 import config
+import metrics
+import eventlog
+from config import ConfigError, stamp
 from util import cls, title, _center, backline, divider, _fail
 from util import parse_arguments, download_chromedriver
 from prescription import read_prescriptions, choose_prescription
+from prescription import import_prescriptions, CREDENTIAL_ERRORS
 from appointment import Appointment, interactive_latest_appointment, send_notif
-from driver import By
-from driver import name_class_appointment
-from driver import init_driver, get_appointments_page, expand_list
+from appointment import LAST_KEY
+from driver import init_driver, get_appointments_page, expand_list, login_page
+from driver import extract_appointments, get_list_html, CookieKeeper
+from driver import wait_list_digest, extraction_round_trips
+from snapshot import SnapshotRecorder
+from network import NetworkCapture
+from monitor import Monitor, ListGate
+from health import verify_prescriptions, BAD, DESCRIPTION
+from rules import RuleSet, RuleError, read_rules
+from geo import Gazetteer, GazetteerError, DistanceFilter
+from lifecycle import BrowserLifecycle, sparkline
+from checkpoint import CheckpointError, save_checkpoint, load_checkpoint
+from checkpoint import checkpoint_path, find_checkpoint
+from ledger import NotificationLedger
+from limiter import HostLimiter
+from coalesce import SharedPoll
+from profiler import CycleProfiler
+from notifier import Notifier
+from api import StatusServer, appointment_dict
 
 __version__ = '1.3'
 
-def run():
-    # parse arguments, get absolute directories for files
-    args = parse_arguments()
+def run(args: Namespace):
+    # get absolute directories for files
     audio_path = os.path.abspath(os.path.join(root, args.audioFile))
     audio_exists = os.path.isfile(audio_path)
     list_reload_interval = int(args.interval)
@@ -54,11 +76,154 @@ def run():
         _fail('driver_path')
 
     # read prescriptions from file and choose which to track
-    prescriptions = read_prescriptions(cred_path)
-    c = choose_prescription(prescriptions, cred_path)
+    store = read_prescriptions(cred_path)
+
+    # bulk import and leave, if asked to
+    if args.importFile is not None:
+        print("Importazione impegnative... ", end='')
+        sys.stdout.flush()
+        try:
+            added, duplicates, errors = import_prescriptions(
+                os.path.abspath(args.importFile), store)
+        except (OSError, UnicodeDecodeError, csv.Error):
+            print("non riuscita.\nIl file da importare non esiste oppure "+
+                  "non e' un file CSV o JSON lines leggibile.")
+            sys.exit(1)
+        print(f"fatto.\n{added} impegnative aggiunte, {duplicates} gia' "+
+              f"presenti, {len(errors)} righe non valide.")
+        for n, reason in errors[:20]:
+            print(f"  riga {n}: {reason}")
+        if len(errors) > 20:
+            print(f"  ... e altre {len(errors) - 20}.")
+        sys.exit(0)
+
+    # shared record of the slots already notified
+    default_ledger_path = '../../data/notifiche.db'
+    if args.ledgerFile == '':
+        ledger_path = os.path.abspath(os.path.join(root, default_ledger_path))
+    else:
+        ledger_path = os.path.abspath(args.ledgerFile)
+    ledger = NotificationLedger(ledger_path, float(args.ledgerTtl) * 3600)
+    notifier = Notifier(float(args.digestWindow), float(args.notifPerHour),
+                        int(args.notifBurst), int(args.flapToggles))
+
+    # state file, rewritten at the end of every cycle, by default one per
+    # prescription and known once it's chosen
+    state_dir = os.path.abspath(os.path.join(root, '../../data'))
+    state_path = None
+    if args.stateFile != '':
+        state_path = os.path.abspath(args.stateFile)
 
+    # logins of all the instances on this computer, taken in turns
+    limiter = None
+    if float(args.hostRate) > 0:
+        default_limit_path = '../../data/limite.json'
+        if args.hostLimitFile == '':
+            limit_path = os.path.abspath(os.path.join(root,
+                                                      default_limit_path))
+        else:
+            limit_path = os.path.abspath(args.hostLimitFile)
+        limiter = HostLimiter(limit_path, float(args.hostRate),
+                              int(args.hostBurst))
+
+    # a resumed watch goes straight to the first poll, without prompts
+    checkpoint = None
+    verify_ttl = float(args.verifyTtl) * 3600
+    if args.resume is not None:
+        try:
+            if state_path is None:
+                state_path = find_checkpoint(state_dir, args.resume)
+            checkpoint = load_checkpoint(state_path)
+        except CheckpointError as e:
+            print(f"Impossibile riprendere il monitoraggio: {e}.")
+            sys.exit(1)
+        if args.resume.strip().upper() not in ('',
+                                               checkpoint['nre'].upper()):
+            print(f"Impossibile riprendere il monitoraggio: il file di "+
+                  f"stato e' dell'impegnativa {checkpoint['nre']}.")
+            sys.exit(1)
+        prescr = store.get(checkpoint['cf'], checkpoint['nre'])
+        if prescr is None:
+            print("Impossibile riprendere il monitoraggio: l'impegnativa "+
+                  "non e' piu' tra quelle salvate.")
+            sys.exit(1)
+        prescriptions = [prescr]
+        c = 0
+        print(f"Ripresa del monitoraggio dell'impegnativa {prescr.nre}... ",
+              end='')
+        # it may have been found unusable since the checkpoint
+        status = store.statuses(verify_ttl).get(prescr.get_creds())
+        if status in BAD:
+            _fail(reason='prescription', masculine=False, details=
+                  f"Esito della verifica sul sito: {DESCRIPTION[status]}.")
+        print("fatto.")
+    else:
+        # check every prescription on the website if asked to, and leave
+        # out those already known to be unusable
+        if args.verify:
+            print("\nVerifica impegnative sul sito...")
+            verify_prescriptions(store.all(), store, driver_path,
+                                 int(args.verifyWorkers), ttl=verify_ttl,
+                                 limiter=limiter)
+        known = store.statuses(verify_ttl)
+        prescriptions = [p for p in store.all()
+                         if known.get((p.cf, p.nre)) not in BAD]
+        hidden = len(store) - len(prescriptions)
+        if hidden > 0:
+            print(f"\n{hidden} impegnative non sono mostrate perche' "+
+                  "risultano scadute, gia' prenotate o con credenziali "+
+                  "errate.")
+        c = choose_prescription(prescriptions, store)
+
+    # invalid credentials would only fail after a whole login
+    valid, reason = prescriptions[c].is_valid()
+    if not valid:
+        _fail(reason='credentials', details=CREDENTIAL_ERRORS[reason]+'.')
+    if state_path is None:
+        state_path = checkpoint_path(state_dir, prescriptions[c].nre)
+
+    # compile the notification rules of this prescription, if any
+    rules = None
+    if args.rulesFile is not None:
+        print("Lettura regole di notifica... ", end='')
+        sys.stdout.flush()
+        try:
+            rules = RuleSet(read_rules(os.path.abspath(args.rulesFile)),
+                            *prescriptions[c].get_creds())
+        except RuleError as e:
+            _fail(reason='rules', details=f"Errore: {e}.")
+        print(f"fatto, {len(rules)} regole per questa impegnativa.")
+        if len(rules) == 0:
+            # no rule applies, so every slot is notified as without a file
+            rules = None
+
+    # locate home, to measure how far facilities are
+    distance = None
+    if args.home is not None:
+        print("Lettura elenco dei luoghi... ", end='')
+        sys.stdout.flush()
+        try:
+            gazetteer = Gazetteer()
+            max_km = None
+            if args.maxDistance is not None:
+                max_km = float(args.maxDistance)
+            distance = DistanceFilter(gazetteer, gazetteer.home(args.home),
+                                      max_km)
+        except (GazetteerError, ValueError) as e:
+            _fail(reason='home', details=f"Errore: {e}.")
+        print("fatto.")
+    elif args.maxDistance is not None:
+        # a maximum distance from nowhere would silently filter nothing
+        print("Filtro per distanza... ", end='')
+        _fail(reason='home', details="Errore: --distanza-massima richiede "+
+              "--casa, da cui misurare la distanza.")
+
+    # the date of a resumed watch is the one it had, possibly moved forward
+    if checkpoint is not None:
+        latest_appointment = None
+        ldate = checkpoint['ldate']
     # set up latest date appointment if date is defined by command line
-    if args.latestDate != '':
+    elif args.latestDate != '':
         latest_appointment = Appointment.latest(args.latestDate)
         if latest_appointment is None:
             _fail(reason='date')
@@ -67,158 +232,503 @@ def run():
         latest_appointment = interactive_latest_appointment()
 
     # set up variable for easier printing later
-    ldate = latest_appointment.date[7:]
-    if ldate == '':
-        ldate = 'non specificata'
+    if checkpoint is None:
+        ldate = latest_appointment.date[7:]
+        if ldate == '':
+            ldate = 'non specificata'
+
+    # set up stage timings and counters only if they're going to be exported
+    if args.metricsFile or args.metricsJson or args.metricsPort or \
+       args.apiPort or args.profile:
+        metrics.enable(
+            args.metricsFile and os.path.abspath(args.metricsFile),
+            args.metricsJson and os.path.abspath(args.metricsJson),
+            args.metricsPort)
 
-    # initialize driver
-    driver = init_driver(driver_path, args.visible)
+    # structured log, written from its own thread
+    if args.eventsFile is not None:
+        try:
+            eventlog.enable(os.path.abspath(args.eventsFile),
+                            int(float(args.eventsMb) * 2**20),
+                            float(args.eventsHours) * 3600,
+                            int(args.eventsKeep))
+        except OSError as e:
+            print(f"Impossibile scrivere il log degli eventi: {e.strerror}.")
+            sys.exit(1)
+        if checkpoint is not None:
+            eventlog.emit('ripresa', motivo='checkpoint', nre=prescr.nre,
+                          ciclo=checkpoint['monitor']['refresh_counter'])
+
+    # status API, served from its own threads
+    status = None
+    if args.apiPort:
+        try:
+            status = StatusServer(args.apiPort)
+        except OSError as e:
+            print(f"Impossibile avviare l'API sulla porta {args.apiPort}: "+
+                  f"{e.strerror}.")
+            sys.exit(1)
+
+    # initialize driver, which is replaced from time to time during long
+    # watches; old and new browser briefly coexist, so they take turns
+    # between two debugging ports
+    debug_port = int(args.debugPort)
+    ports = cycle((debug_port, debug_port + 1) if debug_port else (0,))
+    with metrics.stage('driver_init'):
+        lifecycle = BrowserLifecycle(
+            lambda: init_driver(driver_path, args.visible,
+                                args.network or args.networkParity,
+                                next(ports)),
+            int(args.recycleCycles), float(args.maxMemory),
+            float(args.recycleHours) * 3600)
+    driver = lifecycle.driver
+    capture = None
+    if args.network or args.networkParity:
+        capture = NetworkCapture()
+
+    # keep a copy of every list if asked to, to replay it later
+    recorder = None
+    if args.recordDir is not None:
+        recorder = SnapshotRecorder(os.path.abspath(args.recordDir))
+
+    cookies = CookieKeeper()
+    def refresh(target=None):
+        """Reach the expanded list, saving the page if that fails"""
+        target = driver if target is None else target
+        if limiter is not None:
+            with metrics.stage('login_wait'):
+                limiter.wait(login_page)
+        try:
+            get_appointments_page(target, *prescriptions[c].get_creds(),
+                                  cookies)
+            with metrics.stage('list_expansion'):
+                expand_list(target)
+        except SystemExit:
+            if recorder is not None:
+                recorder.record(target.page_source, 'errore')
+            raise
+
+    # profile every cycle, from the login to the end of the render, and
+    # keep the slowest
+    profiler = None
+    if args.profile:
+        default_profile_dir = '../../data/profili'
+        if args.profileDir == '':
+            profile_dir = os.path.abspath(os.path.join(root,
+                                                       default_profile_dir))
+        else:
+            profile_dir = os.path.abspath(args.profileDir)
+        if args.profileKeep < 1:
+            print("Errore: --profila-cicli deve essere almeno 1.")
+            sys.exit(1)
+        profiler = CycleProfiler(profile_dir, args.profileKeep)
+        profiler.begin(0 if checkpoint is None
+                       else checkpoint['monitor']['refresh_counter'])
 
     # get the page with the list of all the appointments and expand the list
-    get_appointments_page(driver, *prescriptions[c].get_creds())
-    expand_list(driver)
+    refresh()
     
     print(f"\nRaggiunta la pagina. Aggiornamento ogni "+
           f"{list_reload_interval} secondi.")
     print("Caricamento lista appuntamenti... ")
 
+    # options changed in the configuration file, or a changed rules file,
+    # apply from the next cycle without touching the browser
+    rules_stamp = args.rulesFile and stamp(os.path.abspath(args.rulesFile))
+    def reload_config():
+        nonlocal list_reload_interval, audio_path, audio_exists, ldate
+        nonlocal rules_stamp
+        try:
+            changed, restart = args.configuration.reload(args)
+        except ConfigError as e:
+            print(f"Configurazione non ricaricata: {e}.")
+            return
+        if args.rulesFile is not None and 'rulesFile' not in changed and \
+           stamp(os.path.abspath(args.rulesFile)) != rules_stamp:
+            changed['rulesFile'] = args.rulesFile
+        names = {a.dest: key for key, a
+                 in args.configuration.options.items()}
+        applied = []
+        for dest, value in changed.items():
+            try:
+                if dest == 'interval':
+                    list_reload_interval = int(value)
+                    if shared is not None:
+                        shared.max_age = list_reload_interval
+                elif dest == 'latestDate':
+                    if value == '':
+                        raise ValueError("nessuna data indicata, resta "+
+                                         "quella attuale")
+                    latest = Appointment.latest(value)
+                    if latest is None:
+                        raise ValueError("la data non e' valida")
+                    monitor.postpone(latest)
+                    ldate = latest.date[7:] or 'non specificata'
+                elif dest == 'audioFile':
+                    audio_path = os.path.abspath(os.path.join(root, value))
+                    audio_exists = os.path.isfile(audio_path)
+                elif dest == 'rulesFile':
+                    new_rules = None
+                    if value is not None:
+                        path = os.path.abspath(value)
+                        rules_stamp = stamp(path)
+                        new_rules = RuleSet(read_rules(path),
+                                            *prescriptions[c].get_creds())
+                        if len(new_rules) == 0:
+                            new_rules = None
+                    monitor.set_rules(new_rules)
+                elif dest == 'digestWindow':
+                    notifier.window = float(value)
+                elif dest in ('notifPerHour', 'notifBurst'):
+                    for bucket in notifier.buckets.values():
+                        bucket.rate = float(args.notifPerHour) / 3600
+                        bucket.burst = int(args.notifBurst)
+                elif dest == 'flapToggles':
+                    notifier.flap_toggles = int(value)
+                # nonstop is read from args every cycle
+            except (ValueError, RuleError) as e:
+                print(f"Opzione {names[dest]} non applicata: {e}.")
+                continue
+            applied.append(names[dest])
+        if applied:
+            print(f"Configurazione ricaricata: {', '.join(applied)}.")
+            eventlog.emit('configurazione', ciclo=monitor.refresh_counter,
+                          opzioni=applied)
+        if restart:
+            print("Per applicare " + ', '.join(restart) +
+                  " bisogna riavviare SaniDrive.")
+
     # main loop
-    appointments : list[Appointment] = []
-    old_appointments : list[Appointment] = []
-    appnts = [] # the appointment webelements from the driver, bad name mb
-    earliest_appointment = Appointment('','','','')
-    change_counter = -1
-    refresh_counter = 0
-    found_on_refresh = 0
+    if checkpoint is None:
+        monitor = Monitor(latest_appointment, rules, distance)
+    else:
+        monitor = Monitor.from_state(checkpoint['monitor'], rules, distance)
+    gate = ListGate()
+    table = ''
+    facilities = {}
     pretty = 0 # used to make change_counter display intuitive stats
     p = lambda s: _center(s, line_width, True) # shorten call to _center
+
+    quiet = False
+    def extract():
+        """Read the list from the page of the current driver"""
+        nonlocal quiet
+        # most cycles return the same list, a digest computed by the
+        # browser tells without reading it
+        quiet = False
+        if not args.alwaysExtract:
+            quiet = gate.is_quiet(wait_list_digest(driver))
+        if quiet:
+            return monitor.old_appointments
+
+        start = perf_counter()
+        round_trips = 0
+        appointments = None
+        if capture is not None:
+            appointments = capture.extract(driver)
+        # the rendered page is the reference, and the fallback
+        if appointments is None or args.networkParity:
+            dom_appointments = extract_appointments(driver)
+            round_trips = extraction_round_trips(len(dom_appointments))
+            if args.networkParity and \
+               not capture.parity(appointments, dom_appointments):
+                metrics.inc('parity_mismatches')
+            appointments = dom_appointments
+        gate.extracted(perf_counter() - start, round_trips)
+        return appointments
+
+    # with a shared list, the page is only loaded again by the process
+    # that polls for the others
+    shared = None
+    stale = False
+    if args.shareDir is not None:
+        shared = SharedPoll(os.path.abspath(args.shareDir),
+                            *prescriptions[c].get_creds(),
+                            list_reload_interval)
+    def poll():
+        nonlocal stale
+        if stale:
+            print("Aggiornamento lista appuntamenti... ")
+            # timed by its own stages, which leave it out of 'extraction'
+            refresh()
+            stale = False
+        return extract()
+
     while True:
-        cls()
+        nre = prescriptions[c].nre
+        eventlog.emit('inizio_ciclo', ciclo=monitor.refresh_counter, nre=nre)
+        with metrics.stage('render'):
+            cls()
 
-        # print selected prescription data for sanity
-        print("\nNumero\t Codice fiscale\t\tNRE\t\tNome\t\t\t\tNota")
-        print(c+1, "\t", prescriptions[c], '\n')
-        divider('=', line_width, '\n')
-        sys.stdout.flush()
-        
-        # get appointment objects and discard the first because it's repeated later
-        while len(appnts) == 0:
-            sleep(1)
-            appnts = driver.find_elements(By.CLASS_NAME,
-                                          name_class_appointment)
-            appnts = appnts[1:]
-
-        for appnt in appnts:
-            # extract information
-            time_obj = appnt.find_element(By.CLASS_NAME,
-                                          'captionAppointment-dateApp')
-            time_fields = time_obj.find_elements(By.XPATH, './*')
-            place_obj = appnt.find_element(By.CLASS_NAME, 'unita-address')
-            place = place_obj.text
-            # note support to be added
-
-            # store information in new instance
-            appointments.append(Appointment(place, time_fields[0].text.strip(),
-                                            time_fields[2].text, ''))
+            # print selected prescription data for sanity
+            print("\nNumero\t Codice fiscale\t\tNRE\t\tNome\t\t\t\tNota")
+            print(c+1, "\t", prescriptions[c], '\n')
+            divider('=', line_width, '\n')
+            sys.stdout.flush()
+
+        with metrics.stage('extraction'):
+            if shared is None:
+                appointments = extract()
+            else:
+                # a list fetched by another process is formatted anew
+                quiet = False
+                appointments = shared.fetch(poll)
+                if not shared.leader:
+                    # the last list isn't the page's anymore, so the next
+                    # poll by this process must read the page
+                    gate.digest = None
+        if recorder is not None and (shared is None or shared.leader):
+            if quiet:
+                recorder.repeat()
+            else:
+                recorder.record(get_list_html(driver))
 
         # find out if something changed, send a notif and move on
-        if appointments != old_appointments:
-            change_counter += 1
+        with metrics.stage('comparison'):
+            notify = monitor.update(appointments, quiet)
+            if monitor.changed:
+                metrics.inc('changes')
+        if status is not None:
+            status.emit(nre, monitor.added, monitor.removed)
+        for kind, slots in (('aggiunto', monitor.added),
+                            ('rimosso', monitor.removed)):
+            for a in slots:
+                eventlog.emit(kind, ciclo=monitor.refresh_counter, nre=nre,
+                              **eventlog.slot_fields(a))
 
-        # store earliest found appointment separately and compare the new
-        # batch's earliest with it and the latest for notifications
-        try:
-            if appointments[0].is_sooner_than(earliest_appointment):
-                earliest_appointment = appointments[0]
-                found_on_refresh = refresh_counter
-
-            if appointments[0].is_sooner_than(latest_appointment):
-                send_notif(appointments[0])
-                
-                if audio_exists:
+        with metrics.stage('notification'):
+            # slots already announced, by this or another instance or
+            # before a restart, aren't dispatched again
+            def claim(appnt):
+                if ledger.claim(nre, appnt):
+                    return True
+                metrics.inc('duplicates_suppressed')
+                return False
+
+            notifier.observe(monitor.added, monitor.removed)
+            metrics.inc('flapping_suppressed',
+                        sum(a.slot in notifier.flapping
+                            for a in monitor.qualifying))
+            digest = notifier.offer(monitor.qualifying)
+            if digest is not None:
+                desktop = notifier.allow('desktop')
+                if not desktop:
+                    metrics.inc('rate_limited')
+                audio = audio_exists and notifier.allow('audio')
+                if not (desktop or audio):
+                    # claimed only once dispatched, or nobody would
+                    # ever announce them
+                    notifier.defer(digest)
+                    digest = None
+                else:
+                    digest = [a for a in digest if claim(a)]
+            if digest:
+                eventlog.emit('notifica', ciclo=monitor.refresh_counter,
+                              nre=nre, urgente=notifier.urgent,
+                              appuntamenti=[eventlog.slot_fields(a)
+                                            for a in digest])
+                if desktop:
+                    send_notif(digest[0], len(digest) - 1)
+                    metrics.inc('notifications')
+                if audio:
                     os.system(f'{audio_path}')
 
-                if not args.nonstop:
-                    appnt_str = appointments[0].__str__().replace('\t', '    ')
-                    pc = 0 # printed_characters
-                    print('')
-                    pc += p('|||   NUOVO APPUNTAMENTO TROVATO   |||')
-                    print('')
-                    pc += p('Trovato un appuntamento per prima della data '+
-                        'specificata:')
-                    print('')
-                    p('-' * int(line_width * 4/5))
-                    pc += p(appnt_str)
-                    p('-' * int(line_width * 4/5))
-                    print('\n')
-                    pc += _center('Effettua la prenotazione dalla finestra ' \
-                    'di ChromeDriver oppure premi Invio per continuare a ' \
-                    'cercare usando la data di questo prossimo appuntamento ' \
-                    'come nuova data di riferimento.', line_width, True, True)
-                    input('')
-                    backline(6 + pc)
-                    latest_appointment = appointments[0]
-                    ldate = ' '.join(appointments[0].date.split()[1:])
-            pass
-        except IndexError:
-            pass
+        if notify is not None:
+            if not args.nonstop:
+                appnt_str = notify.__str__().replace('\t', '    ')
+                pc = 0 # printed_characters
+                print('')
+                pc += p('|||   NUOVO APPUNTAMENTO TROVATO   |||')
+                print('')
+                pc += p('Trovato un appuntamento per prima della data '+
+                    'specificata:')
+                print('')
+                p('-' * int(line_width * 4/5))
+                pc += p(appnt_str)
+                p('-' * int(line_width * 4/5))
+                print('\n')
+                pc += _center('Effettua la prenotazione dalla finestra ' \
+                'di ChromeDriver oppure premi Invio per continuare a ' \
+                'cercare usando la data di questo prossimo appuntamento ' \
+                'come nuova data di riferimento.', line_width, True, True)
+                input('')
+                backline(6 + pc)
+                monitor.postpone(notify)
+                ldate = ' '.join(notify.date.split()[1:])
 
-        # print prescription column info
-        print(f'APPUNTAMENTI'.center(line_width), '\n')
-        print(f'Numero\t\t Data\t\t\t\t Ora\t\t\tVia')
-        sys.stdout.flush()
+        with metrics.stage('render'):
+            # print prescription column info
+            print(f'APPUNTAMENTI'.center(line_width), '\n')
+            print(f'Numero\t\t Data\t\t\t\t Ora\t\t\tVia')
+            sys.stdout.flush()
 
-        # print all available appointments
-        if len(appointments) == 0:
-            print("\t\t\t\t\tNessun appuntamento.")
-            pretty = 1
-        else:
-            for i, a in enumerate(appointments):
-                print(f"{i+1}\t", a)
+            # print all available appointments earliest first, whatever
+            # the order of the page, formatted again only if they changed
+            if not quiet:
+                if len(monitor.index) == 0:
+                    table = "\t\t\t\t\tNessun appuntamento."
+                    pretty = 1
+                else:
+                    table = '\n'.join(f"{i+1}\t {a}" for i, a
+                                      in enumerate(monitor.index.ordered()))
+                facilities = monitor.index.earliest_by_facility()
+            print(table)
 
-        # print some statistics
-        print('\n')
-        p(f'Data prima della quale avvisare con notifica:')
-        p(f'{ldate}')
-        print('')
-        p(f"Appuntamento piu' vicino trovato (durante aggiornamento "+
-          f"{found_on_refresh}):")
-        p(f'{' '.join(earliest_appointment.__str__().split())}')
-        print('')
-        p(f"Aggiornamenti totali: {refresh_counter}"+' '*25+
-          f"Cambiamenti rilevati: {change_counter+pretty}")
-        print('')
-        """ print(f'\n\t\t\tAggiornamenti totali: '+
-              f'{refresh_counter}\t\t\t\tCambiamenti rilevati: '+
-              f'{change_counter+pretty}\n') """
-        divider('=', line_width, '\n')
+            # print some statistics
+            print('\n')
+            p(f'Data prima della quale avvisare con notifica:')
+            p(f'{ldate}')
+            print('')
+            p(f"Appuntamento piu' vicino trovato (durante aggiornamento "+
+              f"{monitor.found_on_refresh}):")
+            p(f'{' '.join(monitor.earliest.__str__().split())}')
+            if len(facilities) > 1:
+                print('')
+                if distance is None:
+                    p("Appuntamento piu' vicino per ogni struttura:")
+                    shown = facilities.values()
+                else:
+                    p("Appuntamento piu' vicino per ogni struttura, dalla "+
+                      "piu' vicina a casa:")
+                    shown = distance.rank(list(facilities.values()))
+                for a in shown:
+                    line = f"{' '.join(a.date.split()[1:])} ore {a.time} - "+\
+                           a.place
+                    if distance is not None:
+                        km = distance.distance(a)
+                        line += " (distanza sconosciuta)" if km is None \
+                                else f" ({km:.0f} km)"
+                    p(line)
+            print('')
+            p(f"Aggiornamenti totali: {monitor.refresh_counter}"+' '*25+
+              f"Cambiamenti rilevati: {monitor.change_counter+pretty}")
+            p(f"Tempo risparmiato evitando il cookie banner: "+
+              f"{cookies.seconds_saved:.1f} secondi")
+            if not args.alwaysExtract:
+                p(f"Aggiornamenti senza cambiamenti: {gate.quiet_cycles}, "+
+                  f"risparmiati {gate.seconds_saved:.1f} secondi e "+
+                  f"{gate.round_trips_saved} richieste a ChromeDriver")
+            memory = lifecycle.measure()
+            if memory is not None:
+                metrics.gauge('browser_rss_mb', round(memory, 1))
+                p(f"Memoria del browser: {memory:.0f} MB "+
+                  f"{sparkline(list(lifecycle.memory))} sostituito "+
+                  f"{lifecycle.recycles} volte")
+            if ledger.suppressed > 0:
+                p(f"Notifiche non ripetute perche' gia' inviate: "+
+                  f"{ledger.suppressed}")
+            if notifier.delivered > 0 or notifier.pending:
+                p(f"Notifiche inviate: {notifier.delivered}, in attesa: "+
+                  f"{len(notifier.pending)}, oltre il limite orario: "+
+                  f"{notifier.limited['desktop']}, appuntamenti instabili: "+
+                  f"{len(notifier.flapping)}")
+            if limiter is not None:
+                p(f"Attesa per il limite di accessi condiviso: ultima "+
+                  f"{limiter.last_wait:.1f} secondi, media "+
+                  f"{limiter.waited / max(limiter.calls, 1):.1f}, totale "+
+                  f"{limiter.waited:.0f}")
+            if shared is not None:
+                p(f"Liste lette dal sito: {shared.fetched}, ricevute da "+
+                  f"altre istanze che controllano la stessa impegnativa: "+
+                  f"{shared.received}")
+            if profiler is not None and profiler.kept:
+                slowest = sorted(profiler.kept, reverse=True)
+                p("Cicli piu' lenti profilati: " + ', '.join(
+                  f"{n} ({sec:.1f} s)" for sec, n, _ in slowest))
+            if status is not None:
+                p(f"Stato consultabile su http://127.0.0.1:{args.apiPort}, "+
+                  f"client in ascolto degli eventi: {status.clients}")
+            if monitor.rules is not None:
+                p(f"Regole di notifica: {len(monitor.rules)}, appuntamenti "+
+                  f"che ne soddisfano almeno una: {len(monitor.matched)}")
+            p(f"Ultimo aggiornamento: {strftime('%H:%M:%S')}")
+            if args.networkParity:
+                p(f"Differenze tra lista letta dalla rete e dalla pagina: "+
+                  f"{capture.mismatches}")
+            print('')
+            divider('=', line_width, '\n')
 
         # cycle data
-        old_appointments = appointments
-        appointments = []
-        appnts = []
-        refresh_counter += 1
+        monitor.advance()
+        try:
+            save_checkpoint(state_path, *prescriptions[c].get_creds(), ldate,
+                            monitor.state())
+        except OSError:
+            # a missed checkpoint only matters if this is the last one
+            pass
+        metrics.inc('refreshes')
+        metrics.end_cycle()
+        if profiler is not None:
+            profiler.end(dict(metrics.registry.last_cycle))
+        eventlog.emit('fine_ciclo', ciclo=monitor.refresh_counter - 1,
+                      nre=nre, cambiato=monitor.changed,
+                      appuntamenti=len(monitor.index),
+                      tempi={k: round(v, 4) for k, v in
+                             (metrics.registry.last_cycle.items()
+                              if metrics.registry is not None else ())})
+        if status is not None:
+            earliest = None
+            if monitor.earliest.key != LAST_KEY:
+                earliest = appointment_dict(monitor.earliest) | \
+                           {'refresh': monitor.found_on_refresh}
+            snapshot = metrics.registry.snapshot()
+            status.publish({
+                'appointments': {nre: [
+                    appointment_dict(a) for a in monitor.index.ordered()]},
+                'earliest': earliest,
+                # the monitor's count survives --riprendi, the registry's
+                # only covers this session
+                'counters': snapshot['counters'] | snapshot['gauges'] | {
+                    'refreshes': monitor.refresh_counter,
+                    'changes': monitor.change_counter,
+                    'event_clients': status.clients},
+                'stages': snapshot['stages'],
+            })
 
-        # refresh
-        driver.delete_all_cookies()
+        # refresh, dropping only the session so the consent cookie survives
+        cookies.purge(driver)
+        reload_config()
         sleep(list_reload_interval)
-        print("Aggiornamento lista appuntamenti... ")
-        get_appointments_page(driver, *prescriptions[c].get_creds())
-        expand_list(driver)
+        if profiler is not None:
+            profiler.begin(monitor.refresh_counter)
+        reason = lifecycle.due()
+        recycled = False
+        if reason is not None:
+            # the new browser reaches the list before the old one is closed
+            print(f"Sostituzione del browser, {reason}.")
+            recycled = lifecycle.recycle(refresh)
+            if recycled:
+                driver = lifecycle.driver
+                metrics.inc('recycles')
+                eventlog.emit('ripresa', motivo='browser', dettagli=reason,
+                              ciclo=monitor.refresh_counter, nre=nre)
+            else:
+                print("Sostituzione non riuscita, si continua con il "+
+                      "browser attuale.")
+        if recycled:
+            stale = False
+        elif shared is not None:
+            # the login waits until this process has to poll for everyone
+            stale = True
+        else:
+            print("Aggiornamento lista appuntamenti... ")
+            refresh()
 
 if __name__ == "__main__":
-    # parse arguments, get absolute directories for files
+    # get absolute directories for files
     root = os.path.dirname(os.path.realpath(__file__))
     title_path = os.path.join(root, '../../data/title.txt')
 
-    # get screen dimensions and print title
+    # get screen dimensions and print title, unless resuming
+    args = parse_arguments()
     line_width = shutil.get_terminal_size((120, 30))[0]
     config.set_line_width(line_width)
-    cls()
-    title(title_path)
+    if args.resume is None:
+        cls()
+        title(title_path)
 
     try:
-        run()
+        run(args)
     except (KeyboardInterrupt, EOFError):
         print('')
         sys.exit(0)
\ No newline at end of file
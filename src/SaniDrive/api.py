@@ -0,0 +1,204 @@
+"""
+Serves the state of a running watch on localhost, so that phones, home
+dashboards and scripts can follow it without scraping the terminal.
+
+The JSON endpoints are:
+
+- `/` everything below in a single document
+- `/appointments` the appointments on the list, per prescription
+- `/earliest` the earliest appointment ever found
+- `/counters` counters and gauges
+- `/stages` the timings of the stages of the last cycle and their means
+
+and `/events` is a stream of server-sent events, `slot-added` and
+`slot-removed`, one per slot that appears on or disappears from the list.
+A client reconnecting with the Last-Event-ID header receives the events
+it missed, as long as they're among the latest `EVENT_BUFFER`. Event ids
+are prefixed by the start time of the process, so a client that followed
+an earlier run receives every event of this one instead of waiting for
+the count to catch up.
+
+The polling thread only hands over a document, serialized once per cycle,
+and the events of the cycle; the server answers from its own threads with
+what was handed over, so that neither slow nor many clients slow down the
+cycles.
+
+See Also
+--------
+:py:mod:`metrics`
+"""
+
+import json
+import threading
+from time import time, time_ns
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from appointment import Appointment
+
+EVENT_BUFFER = 1000
+# seconds between comments sent to idle event streams, so that clients and
+# proxies don't drop them and closed connections are noticed
+KEEPALIVE = 15
+SECTIONS = ('appointments', 'earliest', 'counters', 'stages')
+
+def appointment_dict(appnt: Appointment) -> dict:
+    return {'date': appnt.date, 'time': appnt.time, 'place': appnt.place,
+            'notes': appnt.notes}
+
+class StatusServer:
+    """
+    Class that serves the state of the watch from daemon threads.
+
+    Parameters
+    ----------
+    port : int
+        The port on 127.0.0.1 to listen on.
+
+    Attributes
+    ----------
+    documents : dict[str, bytes]
+        The JSON of every endpoint, as of the last cycle published.
+    events : deque[tuple[int, str, str]]
+        The latest events as (number, kind, JSON data).
+    epoch : str
+        Prefix of the event ids, different for every run.
+    clients : int
+        Event streams currently open.
+
+    Methods
+    -------
+    publish(state)
+        Replace the document served with `state`.
+    emit(nre, added, removed)
+        Queue the events of the slots that appeared and disappeared.
+    close()
+        Stop the server and end the event streams.
+    """
+    def __init__(self, port: int):
+        self.documents = {'': b'{}'} | {s: b'{}' for s in SECTIONS}
+        self.events = deque(maxlen=EVENT_BUFFER)
+        self.next_id = 1
+        self.epoch = f'{time_ns() // 10**6:x}'
+        self.clients = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port),
+                                          self._handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def publish(self, state: dict) -> None:
+        """
+        Parameters
+        ----------
+        state : dict
+            A JSON serialisable dict with a key per section in `SECTIONS`.
+        """
+        documents = {s: json.dumps(state[s], ensure_ascii=False).encode()
+                     for s in SECTIONS}
+        documents[''] = json.dumps(state, ensure_ascii=False).encode()
+        # a single assignment, so readers see either the old or the new
+        self.documents = documents
+
+    def emit(self, nre: str, added: list[Appointment],
+             removed: list[Appointment]) -> None:
+        if not added and not removed:
+            return
+        with self.condition:
+            for kind, appointments in (('slot-added', added),
+                                       ('slot-removed', removed)):
+                for appnt in appointments:
+                    data = appointment_dict(appnt) | {'nre': nre,
+                                                      't': time()}
+                    self.events.append((self.next_id, kind,
+                                        json.dumps(data, ensure_ascii=False)))
+                    self.next_id += 1
+            self.condition.notify_all()
+
+    def _wait(self, last_id: int) -> list[tuple[int, str, str]] | None:
+        """Returns the events after `last_id`, waiting up to `KEEPALIVE`
+        seconds for one; None once the server is closed"""
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.closed or self.next_id - 1 > last_id, KEEPALIVE)
+            if self.closed:
+                return None
+            return [e for e in self.events if e[0] > last_id]
+
+    def last_seen(self, header: str | None) -> int:
+        """Returns the number of the last event a client received, from
+        the Last-Event-ID header it sent"""
+        epoch, _, n = (header or '').rpartition('-')
+        try:
+            n = int(n)
+        except ValueError:
+            # new clients only get what happens from now on
+            return self.next_id - 1
+        if epoch != self.epoch or n >= self.next_id:
+            # an id of an earlier run, all of this one is new to the client
+            return 0
+        return n
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        status = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?')[0].strip('/')
+                if path == 'events':
+                    self.stream()
+                    return
+                if path not in status.documents:
+                    self.send_error(404)
+                    return
+                body = status.documents[path]
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Cache-Control', 'no-store')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def stream(self):
+                last_id = status.last_seen(self.headers.get('Last-Event-ID'))
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-store')
+                self.end_headers()
+                with status.condition:
+                    status.clients += 1
+                try:
+                    self.wfile.write(b'retry: 5000\n\n')
+                    self.wfile.flush()
+                    while True:
+                        events = status._wait(last_id)
+                        if events is None:
+                            return
+                        if not events:
+                            self.wfile.write(b': ping\n\n')
+                        for event_id, kind, data in events:
+                            self.wfile.write(f'id: {status.epoch}-{event_id}'
+                                             f'\nevent: {kind}\ndata: {data}'
+                                             '\n\n'.encode())
+                            last_id = event_id
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    with status.condition:
+                        status.clients -= 1
+
+            def log_message(self, *args):
+                # keep the terminal clean, it's redrawn every cycle
+                pass
+
+        return Handler
@@ -7,8 +7,12 @@ import config
 from config import MONTH, DAYS
 from util import divider, _center, backline, cls
 
+from bs4 import BeautifulSoup
 from plyer import notification
 
+# sort key of empty appointments, later than any date
+LAST_KEY = 99999999 * 10000
+
 class Appointment:
     """
     Class that stores information on found appointments and provides
@@ -25,6 +29,11 @@ class Appointment:
     notes : str
         Other information as read from website (not implemented)
 
+    key : int
+        Integer that orders appointments in time, see `sort_key`.
+    slot : tuple[str, str, str]
+        The date, time and place that identify the appointment.
+
     Methods
     -------
     is_sooner_than
@@ -41,6 +50,7 @@ class Appointment:
         self.date = date
         self.time = time
         self.notes = notes
+        self.key = Appointment.sort_key(date, time)
 
     def __str__(self):
         """Returns appointment information in readable string form"""
@@ -57,6 +67,23 @@ class Appointment:
             return True
         else: return False
 
+    @staticmethod
+    def sort_key(date: str, time: str) -> int:
+        """
+        Returns an integer in the form YYYYMMDDhhmm, e.g. 202511021420 for
+        'Sabato 2 Novembre 2025' at '14:20', so that comparing appointments
+        costs a single integer comparison. Empty dates come after any other.
+        """
+        if date == '':
+            return LAST_KEY
+        tokens = date.split()
+        day = (int(tokens[3]) * 100 + MONTH[tokens[2]]) * 100 + int(tokens[1])
+        return day * 10000 + int('0'+time.replace(':', ''))
+
+    @property
+    def slot(self) -> tuple[str, str, str]:
+        return self.date, self.time, self.place
+
     def is_sooner_than(self, other: 'Appointment') -> bool:
         """
         Method that is used to determine which of two Appointment instances
@@ -79,37 +106,7 @@ class Appointment:
         # if we're comparing against an empty appointment, return True
         if other.date == '':
             return True
-
-        # sanitize inputs
-        tokens = self.date.split()
-        this_hour = int('0'+self.time.replace(':', ''))
-        this_day = tokens[1]; this_month = MONTH[tokens[2]]
-        this_year = int(tokens[3])
-
-        tokens = other.date.split()
-        other_hour = int('0'+other.time.replace(':', ''))
-        other_day = tokens[1]; other_month = MONTH[tokens[2]]
-        other_year = int(tokens[3])
-
-        # compare
-        if this_year > other_year:
-            return False
-        if this_year < other_year:
-            return True
-        if this_year == other_year:
-            if this_month > other_month:
-                return False
-            if this_month < other_month:
-                return True
-            if this_month == other_month:
-                if this_day > other_day:
-                    return False
-                if this_day < other_day:
-                    return True
-                if this_day == other_day:
-                    if this_hour >= other_hour:
-                        return False
-        return True
+        return self.key < other.key
     
     @classmethod
     def latest(cls, date: list[str]) -> 'Appointment | None':
@@ -354,11 +351,46 @@ def interactive_latest_appointment() -> Appointment:
     
     return Appointment.latest(date)
 
-def send_notif(appnt: Appointment) -> None:
-    """Send desktop notification with appointment information"""
+def parse_appointments(html: str) -> list[Appointment]:
+    """
+    Convert the HTML of the appointment list into Appointment instances
+    without a browser, the same way `driver.extract_appointments` does from
+    the rendered page.
+
+    Parameters
+    ----------
+    html : str
+        Any HTML containing the `.appuntamento` blocks of the list.
+
+    Returns
+    -------
+    list[Appointment]
+        The appointments in document order, including the first one,
+        which is repeated later in the list; see `monitor.SlotIndex`.
+    """
+    # rendered text has its whitespace collapsed, do the same here
+    text = lambda tag: ' '.join(tag.get_text(' ').split())
+    soup = BeautifulSoup(html, 'html.parser')
+    appointments = []
+    for appnt in soup.select('.appuntamento'):
+        time_obj = appnt.select_one('.captionAppointment-dateApp')
+        time_fields = time_obj.find_all(recursive=False)
+        place = text(appnt.select_one('.unita-address'))
+        appointments.append(Appointment(place, text(time_fields[0]),
+                                        text(time_fields[2]), ''))
+    return appointments
+
+def send_notif(appnt: Appointment, others: int = 0) -> None:
+    """Send desktop notification with appointment information, and the
+    number of other appointments found with it if any"""
+    message = appnt.date + ' ' + appnt.place
+    if others == 1:
+        message += ' e un altro appuntamento'
+    elif others > 1:
+        message += f' e altri {others} appuntamenti'
     notification.notify(
             title='SaniDrive ha trovato qualcosa!',
-            message=appnt.date + ' ' + appnt.place,
+            message=message,
             app_name='SaniDrive',
             app_icon='',
             timeout=30,
@@ -0,0 +1,229 @@
+"""
+Microbenchmarks of the pure-Python routines that run constantly during a
+long watch, with fixed and realistic inputs.
+
+Results are compared against a baseline file and the script exits with
+status 1 if any benchmark got slower than the baseline by more than the
+threshold, so that it can be used as a CI step.
+
+Timings are stored as multiples of a calibration loop timed in the same
+process, so that a baseline saved on one machine can be checked on another:
+a faster or slower CPU changes both by about the same factor. The loop
+doesn't touch the disk, so the benchmarks that do are still best compared
+on similar machines.
+
+Examples
+--------
+Save a new baseline: `py benchmark.py --salva`
+Compare against it:  `py benchmark.py --soglia 0.25`
+"""
+
+import io
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+import timeit
+from contextlib import redirect_stdout
+
+from config import MONTH
+from util import _center
+from appointment import Appointment
+from monitor import SlotIndex
+from prescription import Prescription, pop_prescriptions, write_prescriptions
+from prescription import PrescriptionStore
+
+root = os.path.dirname(os.path.realpath(__file__))
+default_baseline = os.path.join(root, '../../data/benchmark_baseline.json')
+
+# Fixed inputs, generated once from a fixed seed
+WEEKDAYS = ('Lunedì', 'Martedì', 'Mercoledì', 'Giovedì', 'Venerdì', 'Sabato',
+            'Domenica')
+LONG_TEXT = ('Effettua la prenotazione dalla finestra di ChromeDriver oppure '+
+             'premi Invio per continuare a cercare usando la data di questo '+
+             'prossimo appuntamento come nuova data di riferimento. ') * 40
+DATES = [['7', '10', '25'], ['17/04/2025'], ['2', 'Marzo', '2025'],
+         ['29-02-2028'], ['31', '04', '2025'], ['3', 'Ottobbre', '25']]
+
+def make_appointments(n: int, seed: int = 0) -> list[Appointment]:
+    rand = random.Random(seed)
+    months = list(MONTH)
+    appointments = []
+    for _ in range(n):
+        date = ' '.join([rand.choice(WEEKDAYS), str(rand.randint(1, 28)),
+                         rand.choice(months), str(rand.randint(2025, 2027))])
+        time = f'{rand.randint(8, 18):02}:{rand.choice((0, 15, 30, 45)):02}'
+        appointments.append(Appointment('Via Roma 12, 09124 Cagliari (CA)',
+                                        date, time, ''))
+    return appointments
+
+def make_prescriptions(n: int, seed: int = 0) -> list[Prescription]:
+    rand = random.Random(seed)
+    prescriptions = []
+    for i in range(n):
+        cf = f'RSSMRA{rand.randint(10, 99)}A01B{rand.randint(100, 999)}X'
+        prescriptions.append(Prescription(cf, f'2000A{i:010}',
+                                          f'Visita {i}', 'nota'))
+    return prescriptions
+
+def benchmarks(tmp_dir: str) -> dict:
+    """Returns the benchmarks as a dict of name to zero-argument callable"""
+    appointments = make_appointments(1000)
+    earliest = appointments[0]
+    prescriptions = make_prescriptions(500)
+    long_list = make_prescriptions(5)
+    json_path = os.path.join(tmp_dir, 'credenziali.json')
+    write_prescriptions(prescriptions, json_path)
+    write_path = os.path.join(tmp_dir, 'scrittura.json')
+    db_path = os.path.join(tmp_dir, 'credenziali.db')
+    store = PrescriptionStore(db_path)
+    store.add_many(prescriptions)
+    extra = Prescription('VRDLGU80A01B354X', '2000A9999999999', 'Nuova', '')
+    sink = io.StringIO()
+    # successive lists of 200 slots, each with a few slots replaced
+    rand = random.Random(0)
+    cycles = [appointments[:200]]
+    for _ in range(49):
+        current = list(cycles[-1])
+        for _ in range(3):
+            current[rand.randrange(len(current))] = rand.choice(appointments)
+        rand.shuffle(current)
+        cycles.append(current)
+
+    def is_sooner_than():
+        e = earliest
+        for a in appointments:
+            if a.is_sooner_than(e):
+                e = a
+
+    def date_is_valid():
+        for date in DATES:
+            Appointment.date_is_valid(date)
+
+    def slot_index():
+        index = SlotIndex()
+        for current in cycles:
+            index.sync(current)
+            index.top(5)
+            index.earliest_by_facility()
+
+    def center():
+        with redirect_stdout(sink):
+            _center(LONG_TEXT, 120, True, True)
+        sink.seek(0); sink.truncate()
+
+    def prescription_str():
+        for p in long_list * 100:
+            str(p)
+
+    def pop():
+        pop_prescriptions(json_path)
+
+    def write():
+        write_prescriptions(prescriptions, write_path)
+
+    def store_open():
+        opened = PrescriptionStore(db_path)
+        opened.all()
+        opened.close()
+
+    def store_add_remove():
+        store.add(extra)
+        store.remove(extra.cf, extra.nre)
+
+    return {
+        'appointment_is_sooner_than_1000': is_sooner_than,
+        'appointment_date_is_valid_6': date_is_valid,
+        'slot_index_50_cycles_of_200': slot_index,
+        'util_center_long_text': center,
+        'prescription_str_500': prescription_str,
+        'pop_prescriptions_500': pop,
+        'write_prescriptions_500': write,
+        'store_open_500': store_open,
+        'store_add_remove_in_500': store_add_remove,
+    }
+
+def calibration() -> None:
+    """Fixed mix of the operations the benchmarks are made of"""
+    counts = {}
+    for i in range(2000):
+        key = f'{i % 97:02}/{i % 12:02}'
+        counts[key] = counts.get(key, 0) + i * 3 // 7
+        key.split('/')
+    sorted(counts.items())
+
+def measure(fn, repeat: int) -> float:
+    """Returns the best time in seconds of one call to `fn`"""
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='benchmark',
+        description='Microbenchmark delle funzioni usate ad ogni ciclo')
+    parser.add_argument('--baseline', default=default_baseline, metavar='FILE')
+    parser.add_argument('--salva', action='store_true',
+        help='Salva i risultati come nuova baseline')
+    parser.add_argument('--soglia', type=float, default=0.25,
+        help='Rallentamento massimo tollerato rispetto alla baseline, '+
+             'ad esempio 0.25 per il 25%%')
+    parser.add_argument('--ripetizioni', type=int, default=5)
+    parser.add_argument('--filtro', default='', metavar='TESTO',
+        help='Esegui solo i benchmark il cui nome contiene TESTO')
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    # older baselines hold seconds measured on some other machine
+    if baseline and 'calibrazione' not in baseline:
+        if not args.salva:
+            print("La baseline contiene tempi assoluti, salvane una nuova "+
+                  "con --salva.")
+            return 1
+        baseline = {}
+    # the time of the calibration loop itself is only informative
+    baseline.pop('calibrazione', None)
+
+    # timed before and after, in case the CPU changed speed in between
+    unit = measure(calibration, args.ripetizioni)
+    results = {}
+    regressions = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, fn in benchmarks(tmp_dir).items():
+            if args.filtro not in name:
+                continue
+            results[name] = measure(fn, args.ripetizioni)
+        unit = min(unit, measure(calibration, args.ripetizioni))
+    print(f'{"calibrazione":<40}{unit * 1e6:>12.1f} us\n')
+
+    for name, seconds in results.items():
+        results[name] = seconds / unit
+        line = f'{name:<40}{seconds * 1e6:>12.1f} us{results[name]:>10.4f}u'
+        if name in baseline:
+            ratio = results[name] / baseline[name]
+            line += f'{ratio:>8.2f}x'
+            if ratio > 1 + args.soglia:
+                regressions.append(name)
+                line += '  RALLENTATO'
+        print(line)
+
+    if args.salva:
+        baseline.update(results)
+        baseline['calibrazione'] = unit
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=4)
+        print(f'\nBaseline salvata in {os.path.realpath(args.baseline)}')
+        return 0
+
+    if regressions:
+        print(f'\n{len(regressions)} benchmark oltre la soglia del '+
+              f'{args.soglia:.0%}: ' + ', '.join(regressions))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+"""
+Saves the state of a watch at the end of every cycle, so that a watch
+interrupted by a crash or a reboot can be resumed with --riprendi from
+where it was, without prompts and without losing the earliest appointment
+found, the date moved forward by the user or the counters.
+
+The checkpoint is a small JSON file, by default one per prescription so
+that several watches don't overwrite each other's, written to a temporary
+file and then renamed over the old one, so that it's never found half written. Every
+checkpoint carries a version number, and older versions are migrated on
+load by the functions in `MIGRATIONS`.
+
+See Also
+--------
+:py:mod:`monitor`
+"""
+
+import os
+import glob
+import json
+from time import time
+
+VERSION = 1
+# version n mapped to the function converting a checkpoint of version n
+# into one of version n+1; add one here whenever VERSION is increased
+MIGRATIONS = {}
+
+class CheckpointError(ValueError):
+    """Raised with a readable message when a checkpoint can't be used."""
+    pass
+
+def save_checkpoint(path: str, cf: str, nre: str, ldate: str,
+                    monitor_state: dict) -> None:
+    """
+    Write the checkpoint atomically.
+
+    Parameters
+    ----------
+    path : str
+        The checkpoint file.
+    cf : str, nre : str
+        The credentials of the tracked prescription.
+    ldate : str
+        The notification date as shown in the statistics.
+    monitor_state : dict
+        As returned by `Monitor.state`.
+    """
+    data = {'versione': VERSION, 't': time(), 'cf': cf, 'nre': nre,
+            'ldate': ldate, 'monitor': monitor_state}
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, separators=(',', ':'), ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def checkpoint_path(directory: str, nre: str) -> str:
+    """Returns the default checkpoint of the watch of `nre`"""
+    return os.path.join(directory, f'stato-{nre.strip().upper()}.json')
+
+def find_checkpoint(directory: str, nre: str = '') -> str:
+    """
+    Returns the default checkpoint to resume: the one of `nre`, or the
+    only one in `directory` if `nre` is empty.
+
+    Raises
+    ------
+    CheckpointError
+        If `nre` is empty and there's no checkpoint or more than one.
+    """
+    if nre != '':
+        return checkpoint_path(directory, nre)
+    found = glob.glob(os.path.join(glob.escape(directory), 'stato-*.json'))
+    # the single file written by earlier versions
+    legacy = os.path.join(directory, 'stato.json')
+    if not found and os.path.isfile(legacy):
+        found = [legacy]
+    if not found:
+        raise CheckpointError("non c'e' nessun monitoraggio da riprendere")
+    if len(found) > 1:
+        nres = sorted(os.path.basename(f)[6:-5] for f in found)
+        raise CheckpointError("ci sono piu' monitoraggi da riprendere, "+
+                              "indica quale con --riprendi NRE: "+
+                              ', '.join(nres))
+    return found[0]
+
+def migrate(data: dict) -> dict:
+    """Bring a checkpoint of any known version up to `VERSION`"""
+    version = data.get('versione', 0)
+    if version > VERSION:
+        raise CheckpointError("il file di stato e' stato scritto da una "+
+                              "versione piu' recente di SaniDrive")
+    while version < VERSION:
+        if version not in MIGRATIONS:
+            raise CheckpointError(f"il file di stato ha una versione, "+
+                                  f"{version}, che non puo' essere convertita")
+        data = MIGRATIONS[version](data)
+        version += 1
+        data['versione'] = version
+    return data
+
+def load_checkpoint(path: str) -> dict:
+    """
+    Read and migrate a checkpoint.
+
+    Raises
+    ------
+    CheckpointError
+        If the file is missing, damaged or of an unknown version.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        raise CheckpointError("non c'e' nessun monitoraggio da riprendere")
+    except (OSError, json.decoder.JSONDecodeError):
+        raise CheckpointError("il file di stato e' illeggibile o danneggiato")
+    if not isinstance(data, dict):
+        raise CheckpointError("il file di stato e' illeggibile o danneggiato")
+    data = migrate(data)
+    for key in ('cf', 'nre', 'ldate', 'monitor'):
+        if key not in data:
+            raise CheckpointError("il file di stato e' incompleto")
+    return data
@@ -0,0 +1,494 @@
+"""
+Spreads the watch of many prescriptions over several worker processes,
+on one machine or many, since a machine can only run so many browsers.
+
+A coordinator owns the prescription store and the schedule. Workers ask
+it for a lease on a prescription, watch it with their own browser, post
+the list of every cycle and send heartbeats; a lease not renewed in time,
+because its worker died or lost the network, expires and the prescription
+is leased to another worker. The coordinator compares the lists of every
+prescription and notifies the new appointments sooner than the date.
+
+The protocol is JSON over HTTP, authenticated by a shared key:
+
+- `POST /lease` `{"lavoratore"}` returns a lease `{"lease", "cf", "nre",
+  "intervallo", "durata"}`, or 204 if there's nothing to lease
+- `POST /heartbeat` `{"lavoratore", "lease": [...]}` renews the leases,
+  returns the ones that are lost `{"persi": [...]}`
+- `POST /risultato` `{"lavoratore", "lease", "appuntamenti"}` renews the
+  lease and hands over a list, 409 if the lease is lost
+- `POST /rilascia` `{"lavoratore", "lease"}` gives the lease back
+- `GET /stato` the leases, the workers and the latest lists
+
+Start the coordinator with `py cluster.py coordinatore` and each worker
+with `py cluster.py lavoratore http://HOST:PORTA`, with the same --chiave.
+The coordinator only listens on 127.0.0.1 unless told otherwise with
+--indirizzo, and refuses any other address without a key; across
+machines, use it on a trusted network only, since the leases carry the
+credentials. `clustertest.py` tries the whole protocol on one machine.
+
+See Also
+--------
+:py:mod:`monitor`, :py:mod:`prescription`
+"""
+
+import os
+import sys
+import hmac
+import json
+import uuid
+import socket
+import ipaddress
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from time import time, sleep, monotonic, strftime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from appointment import Appointment, send_notif
+from prescription import Prescription, read_prescriptions
+from monitor import Monitor
+
+root = os.path.dirname(os.path.realpath(__file__))
+default_cred_path = os.path.join(root, '../../data/credenziali.json')
+default_driver_path = os.path.join(
+    root, '../../data/chromedriver-win64/chromedriver.exe')
+KEY_HEADER = 'X-SaniDrive-Chiave'
+_print_lock = threading.Lock()
+
+def say(message: str) -> None:
+    """Print a timestamped line, whole even when threads print at once"""
+    with _print_lock:
+        print(f"[{strftime('%H:%M:%S')}] {message}")
+        sys.stdout.flush()
+
+def is_loopback(host: str) -> bool:
+    """Returns True if `host` can only be reached from this machine"""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+class LeaseLost(Exception):
+    """Raised by a worker when the coordinator took its lease back."""
+    pass
+
+class Lease:
+    """The lease of a prescription to a worker."""
+    __slots__ = ('id', 'key', 'worker', 'expires')
+
+    def __init__(self, key: tuple[str, str], worker: str, expires: float):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.worker = worker
+        self.expires = expires
+
+class Coordinator:
+    """
+    Class that leases prescriptions to workers and collects their lists.
+
+    Parameters
+    ----------
+    prescrs : list[Prescription]
+        The prescriptions to watch.
+    latest : Appointment
+        Appointments sooner than this are notified.
+    interval : float
+        Seconds between two polls of the same prescription.
+    lease_seconds : float
+        Seconds after which a lease not renewed expires.
+
+    Attributes
+    ----------
+    leases : dict[str, Lease]
+        The active leases by id.
+    monitors : dict[tuple[str, str], Monitor]
+        The state of every prescription, by (cf, nre).
+    workers : dict[str, float]
+        The workers, by id, and when they were last heard from.
+    reassigned : int
+        Leases expired and available to other workers.
+
+    Methods
+    -------
+    lease(worker)
+        Returns a new lease for `worker`, or None.
+    heartbeat(worker, ids)
+        Renew the leases, returns the ids of the lost ones.
+    result(worker, id, appointments)
+        Renew a lease and compare its list, returns False if lost.
+    release(worker, id)
+        End a lease.
+    """
+    def __init__(self, prescrs: list[Prescription], latest: Appointment,
+                 interval: float = 30, lease_seconds: float = 90):
+        self.prescrs = {p.get_creds(): p for p in prescrs}
+        self.interval = interval
+        self.lease_seconds = lease_seconds
+        self.monitors = {k: Monitor(latest) for k in self.prescrs}
+        self.leases = {}
+        self.holder = {}
+        self.last_result = dict.fromkeys(self.prescrs, 0.0)
+        self.workers = {}
+        self.reassigned = 0
+        self.lock = threading.Lock()
+
+    def _reap(self, now: float) -> None:
+        """Drop the expired leases, must be called with the lock held"""
+        for lease in [l for l in self.leases.values() if l.expires <= now]:
+            del self.leases[lease.id]
+            del self.holder[lease.key]
+            self.reassigned += 1
+            say(f"Lease di {lease.key[1]} scaduto, {lease.worker} non "+
+                "risponde.")
+
+    def lease(self, worker: str) -> dict | None:
+        now = monotonic()
+        with self.lock:
+            self.workers[worker] = time()
+            self._reap(now)
+            free = [k for k in self.prescrs if k not in self.holder]
+            if not free:
+                return None
+            # the one without a list for the longest time first
+            key = min(free, key=lambda k: self.last_result[k])
+            lease = Lease(key, worker, now + self.lease_seconds)
+            self.leases[lease.id] = lease
+            self.holder[key] = lease.id
+        say(f"{key[1]} affidata a {worker}.")
+        return {'lease': lease.id, 'cf': key[0], 'nre': key[1],
+                'intervallo': self.interval, 'durata': self.lease_seconds}
+
+    def _renew(self, worker: str, lease_id: str, now: float) -> Lease | None:
+        lease = self.leases.get(lease_id)
+        if lease is None or lease.worker != worker:
+            return None
+        lease.expires = now + self.lease_seconds
+        return lease
+
+    def heartbeat(self, worker: str, ids: list[str]) -> list[str]:
+        now = monotonic()
+        with self.lock:
+            self.workers[worker] = time()
+            self._reap(now)
+            return [i for i in ids if self._renew(worker, i, now) is None]
+
+    def result(self, worker: str, lease_id: str,
+               appointments: list[Appointment]) -> bool:
+        now = monotonic()
+        with self.lock:
+            self.workers[worker] = time()
+            self._reap(now)
+            lease = self._renew(worker, lease_id, now)
+            if lease is None:
+                return False
+            self.last_result[lease.key] = time()
+            monitor = self.monitors[lease.key]
+            monitor.update(appointments)
+            monitor.advance()
+            added, removed = len(monitor.added), len(monitor.removed)
+            qualifying = monitor.qualifying
+        nre = lease.key[1]
+        if added or removed:
+            say(f"{nre}: {len(appointments)} appuntamenti, {added} nuovi, "+
+                f"{removed} spariti.")
+        if qualifying:
+            say(f"{nre}: trovato {' '.join(str(qualifying[0]).split())}")
+            try:
+                send_notif(qualifying[0], len(qualifying) - 1)
+            except Exception:
+                # no desktop on a headless coordinator
+                pass
+        return True
+
+    def release(self, worker: str, lease_id: str) -> None:
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if lease is not None and lease.worker == worker:
+                del self.leases[lease_id]
+                del self.holder[lease.key]
+
+    def state(self) -> dict:
+        with self.lock:
+            self._reap(monotonic())
+            now = monotonic()
+            return {
+                'lavoratori': self.workers,
+                'lease': [{'nre': l.key[1], 'lavoratore': l.worker,
+                           'scade_tra': round(l.expires - now, 1)}
+                          for l in self.leases.values()],
+                'riassegnati': self.reassigned,
+                'impegnative': {k[1]: {
+                    'ultimo_risultato': self.last_result[k],
+                    'appuntamenti': [[a.place, a.date, a.time, a.notes]
+                                     for a in m.old_appointments]}
+                    for k, m in self.monitors.items()},
+            }
+
+    def serve(self, host: str, port: int, key: str) -> ThreadingHTTPServer:
+        """
+        Serve the protocol from daemon threads.
+
+        Raises
+        ------
+        ValueError
+            If `host` is reachable from other machines and `key` is empty.
+        """
+        if key == '' and not is_loopback(host):
+            raise ValueError("senza una chiave il coordinatore puo' "+
+                             "ascoltare solo su 127.0.0.1")
+        coordinator = self
+        expected = key.encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            def reply(self, code: int, data=None):
+                body = b'' if data is None else json.dumps(data).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def authorized(self) -> bool:
+                given = self.headers.get(KEY_HEADER, '').encode()
+                if hmac.compare_digest(given, expected):
+                    return True
+                self.reply(403, {'errore': 'chiave errata'})
+                return False
+
+            def do_GET(self):
+                if not self.authorized():
+                    return
+                if self.path != '/stato':
+                    self.reply(404)
+                    return
+                self.reply(200, coordinator.state())
+
+            def do_POST(self):
+                if not self.authorized():
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    data = json.loads(self.rfile.read(length))
+                    worker = str(data['lavoratore'])
+                    if self.path == '/lease':
+                        lease = coordinator.lease(worker)
+                        self.reply(204 if lease is None else 200, lease)
+                    elif self.path == '/heartbeat':
+                        lost = coordinator.heartbeat(worker,
+                                                     list(data['lease']))
+                        self.reply(200, {'persi': lost})
+                    elif self.path == '/risultato':
+                        appointments = [Appointment(*a) for a
+                                        in data['appuntamenti']]
+                        if coordinator.result(worker, data['lease'],
+                                              appointments):
+                            self.reply(200, {})
+                        else:
+                            self.reply(409, {'errore': 'lease perso'})
+                    elif self.path == '/rilascia':
+                        coordinator.release(worker, data['lease'])
+                        self.reply(200, {})
+                    else:
+                        self.reply(404)
+                except (ValueError, KeyError, TypeError, IndexError):
+                    self.reply(400, {'errore': 'richiesta non valida'})
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+def browser_watch(driver_path: str):
+    """
+    Returns the function watching a prescription with its own headless
+    browser, as used by `Worker`.
+    """
+    def watch(cf: str, nre: str, deliver, stop: threading.Event) -> None:
+        # imported here so the coordinator doesn't need Selenium
+        import driver as cup
+        browser = cup.init_driver(driver_path, False, debug_port=0,
+                                  verbose=False)
+        cookies = cup.CookieKeeper()
+        try:
+            while not stop.is_set():
+                cup.get_appointments_page(browser, cf, nre, cookies)
+                cup.expand_list(browser)
+                deliver(cup.extract_appointments(browser))
+                cookies.purge(browser)
+        finally:
+            browser.quit()
+    return watch
+
+class Worker:
+    """
+    Class that leases prescriptions from a coordinator and watches them.
+
+    Parameters
+    ----------
+    url : str
+        The address of the coordinator.
+    key : str
+        The key shared with the coordinator.
+    capacity : int
+        Prescriptions watched at once, i.e. browsers.
+    watch : Callable[[str, str, Callable, threading.Event], None]
+        Watches a prescription until the event is set, handing every list
+        to the callable, which sleeps for the interval; see
+        `browser_watch`.
+
+    Methods
+    -------
+    run()
+        Lease and watch prescriptions until interrupted.
+    """
+    def __init__(self, url: str, key: str, capacity: int, watch):
+        self.url = url.rstrip('/')
+        self.key = key
+        self.capacity = capacity
+        self.watch = watch
+        self.id = f'{socket.gethostname()}-{os.getpid()}'
+        self.active = {}
+        self.lock = threading.Lock()
+
+    def call(self, path: str, data: dict) -> tuple[int, dict | None]:
+        request = urllib.request.Request(self.url + path, method='POST',
+            data=json.dumps({'lavoratore': self.id} | data).encode(),
+            headers={'Content-Type': 'application/json',
+                     KEY_HEADER: self.key})
+        try:
+            with urllib.request.urlopen(request, timeout=15) as response:
+                body = response.read()
+                return response.status, json.loads(body) if body else None
+        except urllib.error.HTTPError as e:
+            return e.code, None
+
+    def _watch_lease(self, lease: dict, stop: threading.Event) -> None:
+        """Body of the thread of a lease"""
+        def deliver(appointments: list[Appointment]) -> None:
+            code, _ = self.call('/risultato', {'lease': lease['lease'],
+                'appuntamenti': [[a.place, a.date, a.time, a.notes]
+                                 for a in appointments]})
+            if code == 409:
+                raise LeaseLost()
+            stop.wait(lease['intervallo'])
+
+        try:
+            self.watch(lease['cf'], lease['nre'], deliver, stop)
+        except LeaseLost:
+            say(f"{lease['nre']}: lease perso, ora e' di un altro.")
+        except (Exception, SystemExit) as e:
+            # a failed login or a dead browser: give it back to someone else
+            say(f"{lease['nre']}: errore, lease restituito ({e!r}).")
+            try:
+                self.call('/rilascia', {'lease': lease['lease']})
+            except OSError:
+                pass
+            # keep the place taken for a while, not to fail in a loop
+            sleep(lease['intervallo'])
+        finally:
+            with self.lock:
+                self.active.pop(lease['lease'], None)
+
+    def _heartbeat(self, interval: float) -> None:
+        while True:
+            sleep(interval)
+            with self.lock:
+                ids = list(self.active)
+            try:
+                code, data = self.call('/heartbeat', {'lease': ids})
+            except OSError:
+                continue
+            for lost in (data or {}).get('persi', []):
+                with self.lock:
+                    stop = self.active.get(lost)
+                if stop is not None:
+                    stop.set()
+
+    def run(self, poll_every: float = 5) -> None:
+        heartbeat = None
+        while True:
+            with self.lock:
+                free = len(self.active) < self.capacity
+            lease = None
+            if free:
+                try:
+                    code, lease = self.call('/lease', {})
+                except OSError as e:
+                    say(f"Coordinatore non raggiungibile: {e}.")
+                    lease = None
+            if lease is None:
+                sleep(poll_every)
+                continue
+            if heartbeat is None:
+                heartbeat = threading.Thread(target=self._heartbeat,
+                    args=(lease['durata'] / 3,), daemon=True)
+                heartbeat.start()
+            say(f"Controllo di {lease['nre']} affidato a questo lavoratore.")
+            stop = threading.Event()
+            with self.lock:
+                self.active[lease['lease']] = stop
+            threading.Thread(target=self._watch_lease, args=(lease, stop),
+                             daemon=True).start()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='cluster',
+        description='Distribuisce il controllo delle impegnative su piu\' '+
+                    'processi o computer')
+    parser.add_argument('--chiave', default=os.environ.get(
+        'SANIDRIVE_CHIAVE', ''), help='Chiave condivisa da coordinatore e '+
+        'lavoratori, anche dalla variabile SANIDRIVE_CHIAVE')
+    modes = parser.add_subparsers(dest='mode', required=True)
+    coord = modes.add_parser('coordinatore')
+    coord.add_argument('--file', '-f', default=default_cred_path,
+                       metavar='FILE')
+    coord.add_argument('--indirizzo', default='127.0.0.1', metavar='HOST')
+    coord.add_argument('--porta', type=int, default=8765, metavar='PORTA')
+    coord.add_argument('--intervallo', type=float, default=30,
+                       metavar='SECONDI')
+    coord.add_argument('--durata-lease', type=float, default=90,
+                       metavar='SECONDI')
+    coord.add_argument('--data', '-d', nargs='*', default=[], metavar='DATA')
+    work = modes.add_parser('lavoratore')
+    work.add_argument('url', metavar='URL')
+    work.add_argument('--driver', default=default_driver_path, metavar='FILE')
+    work.add_argument('--capacita', type=int, default=1, metavar='N')
+    args = parser.parse_args()
+
+    try:
+        if args.mode == 'coordinatore':
+            latest = Appointment.latest(args.data)
+            if latest is None:
+                print("La data specificata non e' valida.")
+                sys.exit(1)
+            store = read_prescriptions(os.path.abspath(args.file))
+            prescrs = store.all()
+            if not prescrs:
+                print("Non ci sono impegnative da controllare.")
+                sys.exit(1)
+            coordinator = Coordinator(prescrs, latest, args.intervallo,
+                                      args.durata_lease)
+            try:
+                coordinator.serve(args.indirizzo, args.porta, args.chiave)
+            except ValueError as e:
+                print(f"Impossibile avviare il coordinatore: {e}. Indica "+
+                      "una chiave con --chiave o SANIDRIVE_CHIAVE.")
+                sys.exit(1)
+            print(f"Coordinatore in ascolto su {args.indirizzo}:"+
+                  f"{args.porta}, {len(prescrs)} impegnative.")
+            while True:
+                sleep(3600)
+        else:
+            if not os.path.isfile(args.driver):
+                print(f"ChromeDriver non trovato in {args.driver}.")
+                sys.exit(1)
+            Worker(args.url, args.chiave, args.capacita,
+                   browser_watch(os.path.abspath(args.driver))).run()
+    except KeyboardInterrupt:
+        print('')
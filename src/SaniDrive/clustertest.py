@@ -0,0 +1,157 @@
+"""
+Tries the coordinator and the workers of :py:mod:`cluster` on one machine,
+without browsers or the website.
+
+A coordinator is started in this process with made up prescriptions and a
+short lease, and every worker is a separate process running `Worker` with
+a watch that makes up its lists. Once every prescription is leased, the
+worker holding the most leases is killed: the test passes if its
+prescriptions are leased to the others and their lists keep arriving.
+
+Example: `py clustertest.py --lavoratori 3 --impegnative 6`
+"""
+
+import os
+import sys
+import random
+import secrets
+import argparse
+import subprocess
+from time import time, sleep, monotonic
+from datetime import date, timedelta
+
+from config import MONTH
+from appointment import Appointment
+from prescription import Prescription
+from cluster import Coordinator, Worker, say
+
+# dummy credentials, nobody logs in with them
+CF = 'RSSMRA80A01B354S'
+WEEKDAYS = ('Lunedì', 'Martedì', 'Mercoledì', 'Giovedì', 'Venerdì', 'Sabato',
+            'Domenica')
+PLACES = ('Via Roma 12, 09124 Cagliari (CA)',
+          'Viale San Pietro 43, 07100 Sassari (SS)',
+          'Via Demurtas 1, 08100 Nuoro (NU)')
+HTNOM = {v: k for k, v in MONTH.items()}
+
+def fake_watch(size: int = 10, churn: float = 0.3):
+    """
+    Returns a function with the interface of `cluster.browser_watch` that
+    makes up a list of `size` slots per prescription, replacing one of
+    them with probability `churn` every cycle.
+    """
+    def new_slot(rng: random.Random) -> Appointment:
+        d = date.today() + timedelta(rng.randint(1, 365))
+        return Appointment(rng.choice(PLACES), ' '.join([
+            WEEKDAYS[d.weekday()], str(d.day), HTNOM[d.month], str(d.year)]),
+            f'{rng.randint(8, 18):02}:{rng.choice((0, 15, 30, 45)):02}', '')
+
+    def watch(cf: str, nre: str, deliver, stop) -> None:
+        rng = random.Random(nre)
+        slots = [new_slot(rng) for _ in range(size)]
+        while not stop.is_set():
+            if rng.random() < churn:
+                slots[rng.randrange(size)] = new_slot(rng)
+            deliver(list(slots))
+    return watch
+
+def wait_for(condition, timeout: float) -> bool:
+    """Returns True as soon as `condition()` is, False after `timeout`"""
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        if condition():
+            return True
+        sleep(0.2)
+    return False
+
+def run_test(workers: int, prescriptions: int, capacity: int,
+             interval: float, lease_seconds: float, verbose: bool) -> bool:
+    """Returns True if the leases of a killed worker were taken over"""
+    prescrs = [Prescription(CF, f'2000A{n:010d}', f'Prova {n}', '')
+               for n in range(1, prescriptions + 1)]
+    latest = Appointment.latest([date.today().strftime('%d-%m-%Y')])
+    coordinator = Coordinator(prescrs, latest, interval, lease_seconds)
+    key = secrets.token_hex(16)
+    server = coordinator.serve('127.0.0.1', 0, key)
+    url = f'http://127.0.0.1:{server.server_port}'
+    say(f"Coordinatore su {url}, {prescriptions} impegnative, lease di "+
+        f"{lease_seconds:g} secondi.")
+
+    output = None if verbose else subprocess.DEVNULL
+    procs = {}
+    try:
+        for _ in range(workers):
+            proc = subprocess.Popen([sys.executable, __file__, '--lavoratore',
+                url, '--chiave', key, '--capacita', str(capacity)],
+                stdout=output, stderr=output)
+            procs[proc.pid] = proc
+
+        def holders() -> dict[tuple[str, str], int]:
+            with coordinator.lock:
+                return {l.key: int(l.worker.rsplit('-', 1)[1])
+                        for l in coordinator.leases.values()}
+
+        needed = min(prescriptions, workers * capacity)
+        if not wait_for(lambda: len(holders()) >= needed, 30):
+            say(f"ERRORE: affidate {len(holders())} impegnative su "+
+                f"{needed}.")
+            return False
+
+        # kill the busiest worker, without letting it release anything
+        held = holders()
+        pid = max(procs, key=lambda p: sum(h == p for h in held.values()))
+        orphans = [k for k, h in held.items() if h == pid]
+        procs.pop(pid).kill()
+        killed_at = time()
+        say(f"Terminato il lavoratore {pid}, che controllava "+
+            f"{len(orphans)} impegnative.")
+
+        def recovered() -> bool:
+            now = holders()
+            with coordinator.lock:
+                return all(now.get(k) not in (None, pid) and
+                           coordinator.last_result[k] > killed_at
+                           for k in orphans)
+        # expiry, then a free worker polling for leases, then one cycle
+        if not wait_for(recovered, 2 * lease_seconds + interval + 15):
+            say("ERRORE: le impegnative del lavoratore terminato non sono "+
+                "state riassegnate.")
+            return False
+        say(f"Impegnative riassegnate in {time() - killed_at:.1f} secondi, "+
+            f"lease scaduti: {coordinator.reassigned}.")
+        return True
+    finally:
+        for proc in procs.values():
+            proc.kill()
+        server.shutdown()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='clustertest',
+        description='Prova coordinatore e lavoratori su un solo computer')
+    parser.add_argument('--lavoratori', type=int, default=3, metavar='N')
+    parser.add_argument('--impegnative', type=int, default=6, metavar='N')
+    parser.add_argument('--capacita', type=int, default=3, metavar='N')
+    parser.add_argument('--intervallo', type=float, default=1,
+                        metavar='SECONDI')
+    parser.add_argument('--durata-lease', type=float, default=6,
+                        metavar='SECONDI')
+    parser.add_argument('--verboso', action='store_true',
+                        help='Mostra anche i messaggi dei lavoratori')
+    # used by the test itself to start the workers
+    parser.add_argument('--lavoratore', metavar='URL', help=argparse.SUPPRESS)
+    parser.add_argument('--chiave', default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    try:
+        if args.lavoratore is not None:
+            Worker(args.lavoratore, args.chiave, args.capacita,
+                   fake_watch()).run(poll_every=0.5)
+        if args.lavoratori < 2:
+            print("Servono almeno 2 lavoratori.")
+            sys.exit(1)
+        passed = run_test(args.lavoratori, args.impegnative, args.capacita,
+                          args.intervallo, args.durata_lease, args.verboso)
+        print("Prova superata." if passed else "Prova non superata.")
+        sys.exit(0 if passed else 1)
+    except KeyboardInterrupt:
+        print('')
@@ -0,0 +1,115 @@
+"""
+Shares the appointment list of a prescription between all the SaniDrive
+processes watching it, so that the same CF and NRE registered by several
+people cost one login per interval instead of one per person.
+
+Processes watching the same pair meet in a shared directory, in a lock
+file and a result file named after a hash of the pair. A process about to
+poll takes the lock: if the result file is younger than its interval it
+uses that list, otherwise it polls the website itself, while still
+holding the lock, and writes the result for the others. Processes that
+arrive during a poll wait for it and get its list, so a list is fetched
+once however many are watching. If the process that polls dies, its lock
+is released by the system and the next one polls in its place.
+
+Each process applies its own date, rules and distance to the list, since
+the list is the same for everyone and only the decisions differ.
+
+See Also
+--------
+:py:mod:`limiter` for the locks.
+"""
+
+import os
+import json
+import hashlib
+from time import time
+
+from appointment import Appointment
+from limiter import _lock, _unlock
+
+class SharedPoll:
+    """
+    Class that polls a prescription at most once per interval across all
+    the processes using the same directory.
+
+    Parameters
+    ----------
+    directory : str
+        The directory shared by the processes, created if it doesn't exist.
+    cf : str, nre : str
+        The credentials of the prescription.
+    max_age : float
+        Seconds for which a list fetched by any process is used instead of
+        polling again, usually the interval of this process.
+
+    Attributes
+    ----------
+    fetched : int
+        Lists fetched by this process.
+    received : int
+        Lists fetched by other processes and used by this one.
+    leader : bool
+        True if the last list was fetched by this process.
+
+    Methods
+    -------
+    fetch(poll)
+        Returns the current list, calling `poll` only if nobody fetched
+        it recently.
+    """
+    def __init__(self, directory: str, cf: str, nre: str, max_age: float):
+        os.makedirs(directory, exist_ok=True)
+        key = hashlib.sha1(f'{cf.upper()}\x1f{nre.upper()}'.encode()
+                           ).hexdigest()
+        self.lock_path = os.path.join(directory, key + '.lock')
+        self.result_path = os.path.join(directory, key + '.json')
+        self.max_age = max_age
+        self.fetched = 0
+        self.received = 0
+        self.leader = False
+
+    def _read(self) -> list[Appointment] | None:
+        """Returns the shared list if it's recent enough"""
+        try:
+            with open(self.result_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if time() - data['t'] >= self.max_age:
+                return None
+            return [Appointment(*a) for a in data['appointments']]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write(self, appointments: list[Appointment]) -> None:
+        data = {'t': time(), 'pid': os.getpid(), 'appointments':
+                [[a.place, a.date, a.time, a.notes] for a in appointments]}
+        tmp_path = f'{self.result_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, separators=(',', ':'), ensure_ascii=False)
+            os.replace(tmp_path, self.result_path)
+        except OSError:
+            # the others will simply poll themselves
+            pass
+
+    def fetch(self, poll) -> list[Appointment]:
+        """
+        Parameters
+        ----------
+        poll : Callable[[], list[Appointment]]
+            Fetches the list from the website.
+        """
+        with open(self.lock_path, 'a+') as lock:
+            _lock(lock)
+            try:
+                appointments = self._read()
+                self.leader = appointments is None
+                if self.leader:
+                    appointments = poll()
+                    self._write(appointments)
+                    self.fetched += 1
+                else:
+                    self.received += 1
+            finally:
+                _unlock(lock)
+        return appointments
@@ -1,4 +1,21 @@
-"""Defines global variables and a setter for each variable."""
+"""
+Defines global variables and a setter for each variable, and the layered
+configuration of the command-line options.
+
+Every option can also be set in a TOML file, with the name of its long
+flag as key, e.g. `intervallo = 20` or `casa = "Oristano"`, and through an
+environment variable named after it, e.g. `SANIDRIVE_INTERVALLO=20` or
+`SANIDRIVE_DISTANZA_MASSIMA=40`. The flags given on the command line win
+over the environment, which wins over the file, which wins over the
+defaults of `parse_arguments`.
+
+The file is checked for changes at the end of every cycle, by its mtime
+only, and the options in `RELOADABLE` apply from the next cycle.
+"""
+
+import os
+import tomllib
+import argparse
 
 # Static lookup tables
 MONTH = {
@@ -6,6 +23,13 @@ MONTH = {
     'Luglio':7, 'Agosto':8, 'Settembre':9, 'Ottobre':10, 'Novembre':11, 'Dicembre':12
 }
 DAYS = {1:31, 2:28, 3:31, 4:30, 5:31, 6:30, 7:31, 8:31, 9:30, 10:31, 11:30, 12:31}
+ENV_PREFIX = 'SANIDRIVE_'
+TRUE = ('1', 'true', 'si', 'sì', 'yes', 'on')
+FALSE = ('0', 'false', 'no', 'off', '')
+# options, by dest, that a running watch picks up from the file; the
+# others need a restart, e.g. the browser visibility
+RELOADABLE = ('interval', 'latestDate', 'nonstop', 'audioFile', 'rulesFile',
+              'digestWindow', 'notifPerHour', 'notifBurst', 'flapToggles')
 
 # Variables
 line_width = 120
@@ -13,4 +37,188 @@ line_width = 120
 # Setters
 def set_line_width(n : int) -> None:
     global line_width
-    line_width = n
\ No newline at end of file
+    line_width = n
+
+class ConfigError(ValueError):
+    """Raised with a readable message when the configuration is invalid."""
+    pass
+
+def stamp(path: str) -> tuple[int, int] | None:
+    """Returns what tells whether a file changed, or None if missing"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def _convert(action: argparse.Action, value, where: str):
+    """Returns `value` as if it had been given on the command line"""
+    if isinstance(action, argparse._StoreTrueAction):
+        if isinstance(value, str) and value.strip().lower() in TRUE + FALSE:
+            return value.strip().lower() in TRUE
+        if isinstance(value, bool):
+            return value
+        raise ConfigError(f"{where} deve essere vero o falso")
+    if action.nargs == '?' and isinstance(value, bool):
+        # an option with an optional value, e.g. riprendi = true
+        return action.const if value else action.default
+    if action.nargs == '*':
+        if isinstance(value, str):
+            return value.split()
+        if isinstance(value, list):
+            return [str(v) for v in value]
+        raise ConfigError(f"{where} deve essere una stringa o una lista")
+    if isinstance(value, (list, dict, bool)):
+        raise ConfigError(f"{where} deve essere un numero o una stringa")
+    try:
+        return str(value) if action.type is None else action.type(value)
+    except (TypeError, ValueError):
+        raise ConfigError(f"{where} non e' valida: '{value}'")
+
+class Configuration:
+    """
+    Class that layers the configuration file and the environment over the
+    command-line options, and reloads the file when it changes.
+
+    Parameters
+    ----------
+    parser : argparse.ArgumentParser
+        The parser of the command line.
+    argv : list[str]
+        The arguments of the command line.
+    path : str | None
+        The configuration file, None if there's none. A missing file is
+        read as empty, and read when it's created.
+    environ : dict[str, str], optional
+        The environment, `os.environ` if not given.
+
+    Attributes
+    ----------
+    options : dict[str, argparse.Action]
+        The options that can be configured, by key, e.g. 'intervallo'.
+    explicit : set[str]
+        The dests given on the command line.
+    source : dict[str, str]
+        Where the value of every dest comes from: 'default', 'file',
+        'ambiente' or 'linea di comando'.
+
+    Methods
+    -------
+    apply(args)
+        Set in `args` the values of the file and the environment.
+    reload(args)
+        Set in `args` the values of the file if it changed, returns them.
+    """
+    def __init__(self, parser: argparse.ArgumentParser, argv: list[str],
+                 path: str | None = None, environ: dict | None = None):
+        self.path = path
+        self.options = {}
+        for action in parser._actions:
+            longs = [o for o in action.option_strings if o.startswith('--')]
+            if longs and action.dest not in ('help', 'configFile'):
+                self.options[longs[0][2:]] = action
+        self.explicit = self._explicit(parser, argv)
+        environ = os.environ if environ is None else environ
+        self.env = {}
+        for key, action in self.options.items():
+            name = ENV_PREFIX + key.upper().replace('-', '_')
+            if name in environ:
+                self.env[action.dest] = _convert(action, environ[name],
+                    f"la variabile d'ambiente {name}")
+        self.stamp = None
+        self.source = {}
+
+    @staticmethod
+    def _explicit(parser: argparse.ArgumentParser,
+                  argv: list[str]) -> set[str]:
+        """Parse again with every default suppressed, so that only the
+        dests given on the command line are set"""
+        defaults = [(a, a.default) for a in parser._actions]
+        try:
+            for action, _ in defaults:
+                action.default = argparse.SUPPRESS
+            return set(vars(parser.parse_args(argv)))
+        finally:
+            for action, default in defaults:
+                action.default = default
+
+    def read(self) -> dict:
+        """
+        Returns the values of the file by dest.
+
+        Raises
+        ------
+        ConfigError
+            If the file isn't valid TOML or has an unknown or invalid key.
+        """
+        self.stamp = stamp(self.path) if self.path is not None else None
+        if self.stamp is None:
+            return {}
+        try:
+            with open(self.path, 'rb') as f:
+                data = tomllib.load(f)
+        except OSError:
+            raise ConfigError("il file di configurazione non e' leggibile")
+        except tomllib.TOMLDecodeError as e:
+            raise ConfigError("il file di configurazione non e' un file "+
+                              f"TOML valido: {e}")
+        values = {}
+        for key, value in data.items():
+            if key not in self.options:
+                raise ConfigError(f"l'opzione '{key}' del file di "+
+                                  "configurazione non esiste")
+            action = self.options[key]
+            values[action.dest] = _convert(action, value,
+                                           f"l'opzione '{key}'")
+        return values
+
+    def apply(self, args: argparse.Namespace) -> None:
+        values = self.read()
+        for action in self.options.values():
+            dest = action.dest
+            if dest in self.explicit:
+                self.source[dest] = 'linea di comando'
+            elif dest in self.env:
+                setattr(args, dest, self.env[dest])
+                self.source[dest] = 'ambiente'
+            elif dest in values:
+                setattr(args, dest, values[dest])
+                self.source[dest] = 'file'
+            else:
+                self.source[dest] = 'default'
+
+    def reload(self, args: argparse.Namespace) -> tuple[dict, list[str]]:
+        """
+        Returns
+        -------
+        dict[str, Any]
+            The reloadable options, by dest, whose value changed; they're
+            already set in `args`. Empty if the file didn't change.
+        list[str]
+            The keys of the other options that changed in the file, which
+            only apply after a restart.
+
+        Raises
+        ------
+        ConfigError
+            If the file changed but is invalid, in which case nothing
+            changes; the file is read again only when it changes again.
+        """
+        if self.path is None or stamp(self.path) == self.stamp:
+            return {}, []
+        values = self.read()
+        changed, restart = {}, []
+        for key, action in self.options.items():
+            dest = action.dest
+            if dest in self.explicit or dest in self.env:
+                continue
+            value = values.get(dest, action.default)
+            if value == getattr(args, dest):
+                continue
+            if dest in RELOADABLE:
+                setattr(args, dest, value)
+                self.source[dest] = 'file' if dest in values else 'default'
+                changed[dest] = value
+            else:
+                restart.append(key)
+        return changed, restart
@@ -3,11 +3,14 @@ Defines variables that store URLs and DOM object names and provides routines
 to navigate the CUP website and extract information from it using Selenium.
 """
 
+import metrics
 from util import backline, _fail
+from appointment import Appointment
+from locator import Locator, LayoutWatch
 
 import os
 import sys
-from time import sleep
+from time import sleep, perf_counter
 from threading import Timer
 from argparse import Namespace
 from selenium import webdriver
@@ -29,6 +32,92 @@ name_button_proceed = '_ricettaelettronica_WAR_cupprenotazione_:navigation-prest
 class_button_cookies = '.js-cookieBarAccept'
 name_button_expand_list = '_ricettaelettronica_WAR_cupprenotazione_:appuntamentiForm:_t439_button'
 name_class_appointment = 'appuntamento'
+# substrings identifying the cookies that tie the browser to a JSF session;
+# everything else (consent, language and other preferences) is kept
+session_cookie_markers = ('jsessionid', 'session', 'jsf', 'faces', 'viewstate')
+
+# cached lookups, the suffixes of the JSF ids are the most stable part
+locator_cf = Locator('Codice fiscale', [
+    (By.ID, id_cf), (By.CSS_SELECTOR, "input[id$=':CFInput']")])
+locator_nre = Locator('NRE', [
+    (By.ID, id_nre), (By.CSS_SELECTOR, "input[id$=':nreInput0']")])
+locator_submit = Locator('Cerca', [
+    (By.NAME, name_button_submit),
+    (By.CSS_SELECTOR, "[name$=':nreButton_button']")])
+# the id of this button changes, so its text is the first thing to look for
+locator_expand = Locator('Altre disponibilità', [
+    (By.XPATH, "//button[normalize-space(.)='Altre disponibilità']"),
+    (By.NAME, name_button_expand_list)], text='Altre disponibilità')
+layout_login = LayoutWatch('ricerca impegnativa', {
+    'campo codice fiscale': "input[id$=':CFInput']",
+    'campo NRE': "input[id$=':nreInput0']",
+    'bottone Cerca': "[name$=':nreButton_button']"})
+layout_list = LayoutWatch('lista appuntamenti', {
+    'appuntamenti': '.' + name_class_appointment,
+    'data appuntamento': '.captionAppointment-dateApp',
+    'indirizzo': '.unita-address'}, {
+    'bottone Altre disponibilità': 'Altre disponibilità'})
+
+class CookieKeeper:
+    """
+    Keeps the cookies set by the cookie banner between cycles and purges
+    only the session cookies that force the website to build a fresh
+    appointment list.
+
+    The consent cookies are learnt the first time the banner is accepted,
+    by comparing the cookies present before and after the click, so no
+    cookie name has to be hardcoded.
+
+    Attributes
+    ----------
+    consent : set[str]
+        Names of the cookies set by accepting the banner.
+    banner_seconds : float
+        Time spent the last time the banner had to be accepted.
+    skipped : int
+        Number of cycles in which the banner step was skipped.
+
+    Methods
+    -------
+    purge(driver)
+        Delete session cookies only, keeping everything else.
+    has_consent(driver)
+        Tell whether the consent cookies are still in the browser.
+    """
+    def __init__(self):
+        self.consent = set()
+        self.banner_seconds = 0.0
+        self.skipped = 0
+
+    @staticmethod
+    def is_session_cookie(name: str) -> bool:
+        """Returns True if the cookie name belongs to the JSF session"""
+        name = name.lower()
+        return any(marker in name for marker in session_cookie_markers)
+
+    def purge(self, driver: WebDriver) -> None:
+        """Delete session cookies, keeping consent and preferences."""
+        for cookie in driver.get_cookies():
+            if self.is_session_cookie(cookie['name']):
+                driver.delete_cookie(cookie['name'])
+
+    def has_consent(self, driver: WebDriver) -> bool:
+        """Returns True if every learnt consent cookie is still set"""
+        if not self.consent:
+            return False
+        names = {cookie['name'] for cookie in driver.get_cookies()}
+        return self.consent <= names
+
+    def learn(self, before: set[str], driver: WebDriver) -> None:
+        """Store as consent cookies those that appeared after the click."""
+        after = {cookie['name'] for cookie in driver.get_cookies()}
+        self.consent = {name for name in after - before
+                        if not self.is_session_cookie(name)}
+
+    @property
+    def seconds_saved(self) -> float:
+        """Estimate of the time saved by not waiting for the banner."""
+        return self.skipped * self.banner_seconds
 
 class RefreshTimer:
     """
@@ -80,23 +169,36 @@ class RefreshTimer:
             self.is_due = False
             Timer(self.interval, self._callback).start()
 
-def init_driver(path: str, visible: bool) -> WebDriver:
+def init_driver(path: str, visible: bool, network: bool = False,
+                debug_port: int = 9222, verbose: bool = True) -> WebDriver:
     """
     Create a new WebDriver instance with the correct parameters specified
     by the user from CLI and return it.
 
     Parameters
     ----------
-    args : Namespace
-        The Namespace object produced by argparse.
+    path : str
+        The path of the ChromeDriver executable.
+    visible : bool
+        Whether the browser window should be shown.
+    network : bool
+        Whether Chrome should log network events, which is needed to read
+        the appointments from the responses, see :py:mod:`network`.
+    debug_port : int
+        The remote debugging port of Chrome, 0 lets Chrome pick a free one
+        so that several drivers can run at once.
+    verbose : bool
+        Whether to print progress, turned off when drivers are started
+        from several threads.
 
     Returns
     -------
     WebDriver
         The instance of the Selenium ChromeDriver.
     """
-    print("Inizializzazione ChromeDriver... ", end='') # 33 characters in line
-    sys.stdout.flush()
+    if verbose:
+        print("Inizializzazione ChromeDriver... ", end='') # 33 characters
+        sys.stdout.flush()
     try:
         chrome_options = Options()
         #chrome_service = Service()
@@ -105,16 +207,22 @@ def init_driver(path: str, visible: bool) -> WebDriver:
             chrome_options.add_argument("--headless")
         
         chrome_options.add_argument("--log-level=3")
-        chrome_options.add_argument('--remote-debugging-port=9222')
+        chrome_options.add_argument(f'--remote-debugging-port={debug_port}')
         chrome_options.add_argument(f'--executable_path={path}')
+        if network:
+            chrome_options.set_capability('goog:loggingPrefs',
+                                          {'performance': 'ALL'})
         #chrome_service.log_output = os.path.abspath(args.logFile)
         # chrome_service isn't included as the second argument because
         # Selenium bugs out if it is as of version 4.20.0
         driver = webdriver.Chrome(chrome_options)
-        backline(1)
-        print("\x1b[1A\x1b[33Cfatto.")
-        sys.stdout.flush()
+        if verbose:
+            backline(1)
+            print("\x1b[1A\x1b[33Cfatto.")
+            sys.stdout.flush()
     except Exception as e:
+        if not verbose:
+            raise e
         print("non riuscita.\nQualcosa e' andato storto. Assicurati di aver "+
             "scaricato la giusta versione di ChromeDriver. La puoi trovare "+
             "qui: https://googlechromelabs.github.io/chrome-for-testing/ \n"+
@@ -124,7 +232,8 @@ def init_driver(path: str, visible: bool) -> WebDriver:
         raise e
     return driver
 
-def get_appointments_page(driver: WebDriver, cf: str, nre: str) -> None:
+def get_appointments_page(driver: WebDriver, cf: str, nre: str,
+                          cookies: CookieKeeper | None = None) -> None:
     """
     Core script that reaches the login page, navigates to where the list
     of appointments is given and extracts them into a list of objects
@@ -139,12 +248,87 @@ def get_appointments_page(driver: WebDriver, cf: str, nre: str) -> None:
         The WebDriver instance that's been initialized by `init_driver`
     cf : str, nre : str
         The credentials to be inserted in the page's input fields
+    cookies : CookieKeeper, optional
+        If given, the cookie banner step is skipped whenever the consent
+        cookies it learnt are still in the browser.
+    """
+    with metrics.stage('page_get'):
+        driver.get(login_page)
+
+    # the banner only needs accepting once if its cookies are kept
+    with metrics.stage('cookie_banner'):
+        if cookies is not None and cookies.has_consent(driver):
+            cookies.skipped += 1
+            # a quick look without waiting, in case the site shows it anyway
+            for button in driver.find_elements(By.CSS_SELECTOR,
+                                               class_button_cookies):
+                if button.is_displayed():
+                    button.click()
+        else:
+            accept_cookie_banner(driver, cookies)
+
+    with metrics.stage('credential_submit'):
+        # get input fields and submit button
+        print("Locazione input fields... ", end='')
+        sys.stdout.flush()
+        field_cf = locator_cf.find(driver)
+        field_nre = locator_nre.find(driver)
+        button_submit = locator_submit.find(driver)
+        if None in (field_cf, field_nre, button_submit):
+            report_layout_change(driver, layout_login)
+            _fail(reason='layout')
+        print("fatto.")
+        # the form is there, so this is what the working page looks like
+        if layout_login.known is None:
+            layout_login.learn(driver)
+
+        # input data in fields and proceed
+        print("Inserimento credenziali... ", end='')
+        sys.stdout.flush()
+        try:
+            field_cf.send_keys(cf.strip())
+            field_nre.send_keys(nre.strip())
+            button_submit.click()
+            print("fatto.")
+        except:
+            print("non riuscito.\nCrea una nuova prescrizione ed assicurati "+
+                "che le credenziali siano corrette.")
+            metrics.inc('failures')
+            metrics.end_cycle()
+            sys.exit(1)
+
+    # second page is useless, just wait for loading and proceed
+    with metrics.stage('proceed_wait'):
+        try:
+            WebDriverWait(driver, 60).until(
+                EC.element_to_be_clickable((By.NAME, name_button_proceed))
+            )
+            button_proceed = driver.find_element(By.NAME, name_button_proceed)
+            button_proceed.click()
+        except:
+            _fail(reason='layout')
+    return
+
+def accept_cookie_banner(driver: WebDriver,
+                         cookies: CookieKeeper | None = None) -> None:
     """
-    driver.get(login_page)
+    Wait for the cookie banner and accept it. If a CookieKeeper is given,
+    it learns which cookies the banner sets and how long the step took.
 
+    Parameters
+    ----------
+    driver : WebDriver
+        The driver, which must already be on the login page
+    cookies : CookieKeeper, optional
+        The instance that keeps track of consent cookies between cycles
+    """
     # get the damn cookie banner out the way so it doesn't break stuff
     print("Rimozione cookie banner... ", end='')
     sys.stdout.flush()
+    start = perf_counter()
+    before = set()
+    if cookies is not None:
+        before = {cookie['name'] for cookie in driver.get_cookies()}
     try:
         WebDriverWait(driver, 20).until(
             EC.element_to_be_clickable((By.CSS_SELECTOR, class_button_cookies))
@@ -155,40 +339,9 @@ def get_appointments_page(driver: WebDriver, cf: str, nre: str) -> None:
     except TimeoutException:
         _fail(reason='layout')
     sleep(1)
-
-    # get input fields and submit button
-    print("Locazione input fields... ", end='')
-    sys.stdout.flush()
-    try:
-        field_cf = driver.find_element(By.ID, id_cf)
-        field_nre = driver.find_element(By.ID, id_nre)
-        button_submit = driver.find_element(By.NAME, name_button_submit)
-        print("fatto.")
-    except:
-        _fail(reason='layout')
-    
-    # input data in fields and proceed
-    print("Inserimento credenziali... ", end='')
-    sys.stdout.flush()
-    try:
-        field_cf.send_keys(cf.strip())
-        field_nre.send_keys(nre.strip())
-        button_submit.click()
-        print("fatto.")
-    except:
-        print("non riuscito.\nCrea una nuova prescrizione ed assicurati che "+
-            "le credenziali siano corrette.")
-        sys.exit(1)
-
-    # second page is useless, just wait for loading and proceed
-    try:
-        WebDriverWait(driver, 60).until(
-            EC.element_to_be_clickable((By.NAME, name_button_proceed))
-        )
-        button_proceed = driver.find_element(By.NAME, name_button_proceed)
-        button_proceed.click()
-    except:
-        _fail(reason='layout')
+    if cookies is not None:
+        cookies.learn(before, driver)
+        cookies.banner_seconds = perf_counter() - start
     return
 
 def expand_list(driver: WebDriver):
@@ -202,25 +355,33 @@ def expand_list(driver: WebDriver):
     """
     print("Espansione lista appuntamenti... ", end='')
     sys.stdout.flush()
-    retries = 0; retry = True
+    retries = 0; retry = True; misses = 0
 
-    # unfortunately button names are dynamically assigned so we have to
-    # get every button and click the one that has text = 'Altre disponibilità'
+    # button names are dynamically assigned, so the locator looks for the
+    # one whose text is 'Altre disponibilità' and remembers how it found it
     while retry:
         try:
-            buttons = driver.find_elements(By.XPATH, './/button')
-            for b in buttons:
-                if b.text == 'Altre disponibilità':
-                    b.click()
-                    retry = False
-                    print('fatto.')
-                    sys.stdout.flush()
+            button = locator_expand.find(driver)
+            if button is not None:
+                # learnt before the click, which starts reloading the list
+                if layout_list.known is None:
+                    layout_list.learn(driver)
+                button.click()
+                retry = False
+                print('fatto.')
+                sys.stdout.flush()
+            else:
+                # give slow pages some time before suspecting the layout
+                misses += 1
+                if misses >= 3:
+                    report_layout_change(driver, layout_list)
             sleep(2)
         except ECI:
             driver.execute_script("window.scrollBy(0, -200);")
             sleep(0.2)
             pass
         except SERE:
+            locator_expand.forget()
             retries += 1
             if retries >= 5:
                 _fail(reason='session', masculine=False)
@@ -228,3 +389,122 @@ def expand_list(driver: WebDriver):
             _fail(reason='layout', masculine=False)
     return
 
+def report_layout_change(driver: WebDriver, watch: LayoutWatch) -> None:
+    """
+    Tell the user, once, which elements disappeared from a page that used
+    to work, then stop as for any other layout failure.
+
+    Nothing happens if the page still looks like it did when it worked,
+    which means it's just slow to load.
+    """
+    if watch.known is None:
+        return
+    missing = watch.check(driver)
+    if missing is None:
+        return
+    _fail(reason='layout', masculine=False, details="Il layout della "+
+          f"pagina '{watch.name}' e' cambiato, elementi mancanti: "+
+          ', '.join(missing)+'.')
+
+def extract_appointments(driver: WebDriver) -> list[Appointment]:
+    """
+    Wait for the appointment list to be rendered and convert each of its
+    elements into an Appointment instance.
+
+    Parameters
+    ----------
+    driver : WebDriver
+        The driver, which must already be on the expanded list page
+
+    Returns
+    -------
+    list[Appointment]
+        The appointments in the order they're shown on the page, including
+        the first one, which is repeated later in the list: the order and
+        the duplicates are dealt with by `monitor.SlotIndex`.
+    """
+    # the list is usually rendered already when the digest was computed
+    appnts = driver.find_elements(By.CLASS_NAME, name_class_appointment)
+    while len(appnts) == 0:
+        sleep(1)
+        appnts = driver.find_elements(By.CLASS_NAME, name_class_appointment)
+
+    appointments = []
+    for appnt in appnts:
+        # extract information
+        time_obj = appnt.find_element(By.CLASS_NAME,
+                                      'captionAppointment-dateApp')
+        time_fields = time_obj.find_elements(By.XPATH, './*')
+        place_obj = appnt.find_element(By.CLASS_NAME, 'unita-address')
+        place = place_obj.text
+        # note support to be added
+
+        # store information in new instance
+        appointments.append(Appointment(place, time_fields[0].text.strip(),
+                                        time_fields[2].text, ''))
+    return appointments
+
+def get_list_html(driver: WebDriver) -> str:
+    """
+    Returns the outer HTML of every `.appuntamento` block in a single round
+    trip. Only the blocks are taken, and not the surrounding form, because
+    the form carries the JSF view state, which changes on every login.
+    """
+    return driver.execute_script(
+        "return Array.from(document.getElementsByClassName(arguments[0]))"+
+        ".map(function (e) { return e.outerHTML; }).join('\\n');",
+        name_class_appointment)
+
+def wait_list_digest(driver: WebDriver, patience: float = 10) -> str:
+    """
+    Wait for the appointment list to be rendered and expanded, and return
+    a digest of its text computed by the browser, so that an unchanged
+    list costs a single round trip per check.
+
+    Parameters
+    ----------
+    driver : WebDriver
+        The driver, right after the list was expanded.
+    patience : float
+        Seconds after which a list whose 'Altre disponibilità' button is
+        still shown is taken as expanded, in case the website keeps it.
+
+    Returns
+    -------
+    str
+        The number of `.appuntamento` blocks and the 32-bit FNV-1a hash of
+        their text, e.g. '41:9c1f03a2'.
+    """
+    script = """
+        var nodes = document.getElementsByClassName(arguments[0]);
+        if (nodes.length < 2) return null;
+        // the short list, until the expanded one replaces it with the button
+        var buttons = arguments[2] ? document.getElementsByTagName('button')
+                                   : [];
+        for (var i = 0; i < buttons.length; i++) {
+            if (buttons[i].textContent.trim() === arguments[1] &&
+                buttons[i].offsetParent !== null) return null;
+        }
+        var h = 0x811c9dc5;
+        for (var i = 0; i < nodes.length; i++) {
+            var s = nodes[i].textContent + '\\n';
+            for (var j = 0; j < s.length; j++) {
+                h ^= s.charCodeAt(j);
+                h = Math.imul(h, 0x01000193) >>> 0;
+            }
+        }
+        return nodes.length + ':' + h.toString(16);
+    """
+    digest = None
+    start = perf_counter()
+    while digest is None:
+        sleep(1)
+        digest = driver.execute_script(script, name_class_appointment,
+                                       locator_expand.text,
+                                       perf_counter() - start < patience)
+    return digest
+
+def extraction_round_trips(n: int) -> int:
+    """Returns the ChromeDriver round trips `extract_appointments` needs to
+    read `n` appointments: one lookup plus six calls per appointment"""
+    return 1 + 6 * n
@@ -0,0 +1,309 @@
+"""
+Writes a structured log of the watch, one JSON object per line, and
+queries it.
+
+Every line has the time `t`, the kind of `evento` and the `ciclo` it
+happened in, plus fields depending on the kind:
+
+- `inizio_ciclo`, `fine_ciclo` with the `tempi` of its stages
+- `aggiunto`, `rimosso` for every slot appearing on or leaving the list
+- `notifica` with the slots of the digest
+- `errore` with its `motivo`, just before SaniDrive gives up
+- `ripresa` when the watch recovers, i.e. it's resumed from a checkpoint
+  or the browser is replaced
+- `configurazione` with the `opzioni` reloaded from the file
+- `eventi_persi` with the number of events dropped
+
+Events are handed to a background thread through a bounded queue, so a
+slow or stalled disk never holds up polling: when the queue is full the
+event is dropped and counted instead. The writer rotates the log when it
+grows past a size or an age, compresses the rotated file with gzip and
+keeps only the latest archives; at the defaults, a month of 30-second
+cycles takes a few MB.
+
+Query the log, archives included, with
+`py eventlog.py FILE [--evento EVENTO] [--dal DATA] [--al DATA]`.
+
+See Also
+--------
+:py:mod:`metrics`
+"""
+
+import os
+import re
+import sys
+import glob
+import gzip
+import json
+import queue
+import atexit
+import shutil
+import argparse
+import threading
+from time import time, strftime, localtime, mktime, strptime
+
+EVENTS = ('inizio_ciclo', 'fine_ciclo', 'aggiunto', 'rimosso', 'notifica',
+          'errore', 'ripresa', 'configurazione', 'eventi_persi')
+# suffix of the archives, the time the rotated file was started at
+ARCHIVE_TIME = '%Y%m%d-%H%M%S'
+ARCHIVE_PATTERN = re.compile(r'\.(\d{8}-\d{6})(?:-\d+)?\.jsonl\.gz$')
+
+class EventLog:
+    """
+    Class that writes events to a rotating JSON lines file from a
+    background thread.
+
+    Parameters
+    ----------
+    path : str
+        The current log, archives are written next to it.
+    max_bytes : int
+        Size above which the log is rotated, 0 for no limit.
+    max_seconds : float
+        Age above which the log is rotated, 0 for no limit.
+    keep : int
+        Number of archives kept, the oldest are deleted.
+    queue_size : int
+        Events waiting to be written above which new ones are dropped.
+
+    Attributes
+    ----------
+    dropped : int
+        Events dropped because the queue was full.
+    written : int
+        Events written.
+
+    Methods
+    -------
+    emit(event, **fields)
+        Queue an event, never blocks.
+    close(timeout)
+        Write the queued events and stop the writer.
+    """
+    def __init__(self, path: str, max_bytes: int = 10 * 2**20,
+                 max_seconds: float = 24 * 3600, keep: int = 45,
+                 queue_size: int = 10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.keep = keep
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.reported = 0
+        self.written = 0
+        self.file = None
+        self.started = None
+        self.size = 0
+        self._open()
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def emit(self, event: str, **fields) -> None:
+        record = {'t': round(time(), 3), 'evento': event} | fields
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout: float = 5) -> None:
+        if not self.thread.is_alive():
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
+
+    def _open(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.size = self.file.tell()
+        # a log left by an earlier run is as old as its first event
+        self.started = time()
+        if self.size > 0:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                try:
+                    self.started = json.loads(f.readline())['t']
+                except (ValueError, KeyError, TypeError):
+                    pass
+
+    def _write(self) -> None:
+        """Body of the writer thread"""
+        while True:
+            record = self.queue.get()
+            while record is not None:
+                if self.dropped > self.reported:
+                    # tell the reader where the log has holes
+                    lost = self.dropped - self.reported
+                    self.reported = self.dropped
+                    self._line({'t': record['t'], 'evento': 'eventi_persi',
+                                'n': lost})
+                self._line(record)
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            # flush in batches, once the queue is drained
+            try:
+                self.file.flush()
+            except OSError:
+                pass
+            if record is None:
+                self.file.close()
+                return
+            if self._due():
+                self._rotate()
+
+    def _line(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False,
+                          separators=(',', ':')) + '\n'
+        try:
+            self.file.write(line)
+        except OSError:
+            self.dropped += 1
+            return
+        self.size += len(line.encode('utf-8'))
+        self.written += 1
+
+    def _due(self) -> bool:
+        if self.max_bytes and self.size >= self.max_bytes:
+            return True
+        return bool(self.max_seconds) and self.size > 0 and \
+               time() - self.started >= self.max_seconds
+
+    def _rotate(self) -> None:
+        """Compress the current log into an archive and start a new one"""
+        self.file.close()
+        base = os.path.splitext(self.path)[0]
+        stamp = strftime(ARCHIVE_TIME, localtime(self.started))
+        archive = f'{base}.{stamp}.jsonl.gz'
+        n = 1
+        while os.path.exists(archive):
+            archive = f'{base}.{stamp}-{n}.jsonl.gz'
+            n += 1
+        try:
+            with open(self.path, 'rb') as src, \
+                 gzip.open(archive + '.tmp', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(archive + '.tmp', archive)
+            os.remove(self.path)
+        except OSError:
+            # keep appending to the current log, it's tried again later
+            self.file = open(self.path, 'a', encoding='utf-8')
+            self.started = time()
+            return
+        for old in archives(self.path)[:-self.keep or None]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+        self._open()
+
+def archives(path: str) -> list[str]:
+    """Returns the archives of the log `path`, oldest first"""
+    base = os.path.splitext(path)[0]
+    found = [p for p in glob.glob(glob.escape(base) + '.*.jsonl.gz')
+             if ARCHIVE_PATTERN.search(p)]
+    return sorted(found, key=lambda p: (ARCHIVE_PATTERN.search(p).group(1),
+                                        len(p), p))
+
+def slot_fields(appnt) -> dict:
+    """Returns the fields of an event about a slot, named as in the
+    decisions of snapshot.py"""
+    return {'data': appnt.date, 'ora': appnt.time, 'luogo': appnt.place}
+
+def read_events(path: str):
+    """Yields the events of the log `path`, archives first, skipping the
+    lines that can't be decoded, e.g. the last one after a crash"""
+    for file in archives(path) + ([path] if os.path.isfile(path) else []):
+        opener = gzip.open if file.endswith('.gz') else open
+        with opener(file, 'rt', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+# Variables
+log = None
+
+# Module-level shortcuts, no-ops until the log is enabled
+def enable(path: str, max_bytes: int = 10 * 2**20,
+           max_seconds: float = 24 * 3600, keep: int = 45) -> EventLog:
+    global log
+    log = EventLog(path, max_bytes, max_seconds, keep)
+    # queued events are written out however SaniDrive exits
+    atexit.register(log.close)
+    return log
+
+def emit(event: str, **fields) -> None:
+    if log is not None:
+        log.emit(event, **fields)
+
+def _timestamp(text: str) -> float:
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return mktime(strptime(text, fmt))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"data non valida: '{text}', usa il "+
+                                     "formato AAAA-MM-GG [HH:MM[:SS]]")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='eventlog',
+        description='Filtra il log degli eventi scritto con --eventi')
+    parser.add_argument('path', metavar='FILE')
+    parser.add_argument('--evento', '-e', action='append', choices=EVENTS,
+                        help='Mostra solo questi eventi, ripetibile')
+    parser.add_argument('--dal', type=_timestamp, default=None,
+                        metavar='DATA', help='AAAA-MM-GG [HH:MM[:SS]]')
+    parser.add_argument('--al', type=_timestamp, default=None,
+                        metavar='DATA', help='AAAA-MM-GG [HH:MM[:SS]]')
+    parser.add_argument('--impegnativa', metavar='NRE', default=None)
+    parser.add_argument('--cerca', metavar='TESTO', default=None,
+                        help='Mostra solo gli eventi che contengono TESTO')
+    parser.add_argument('--conta', action='store_true',
+                        help='Scrivi solo quanti eventi ci sono per tipo')
+    parser.add_argument('--json', action='store_true',
+                        help='Scrivi gli eventi in formato JSON lines')
+    args = parser.parse_args()
+
+    counts = {}
+    try:
+        for event in read_events(args.path):
+            if args.evento and event.get('evento') not in args.evento:
+                continue
+            if args.dal is not None and event.get('t', 0) < args.dal:
+                continue
+            if args.al is not None and event.get('t', 0) > args.al:
+                continue
+            if args.impegnativa is not None and \
+               event.get('nre') != args.impegnativa.upper():
+                continue
+            line = json.dumps(event, ensure_ascii=False)
+            if args.cerca is not None and args.cerca not in line:
+                continue
+            counts[event.get('evento')] = counts.get(event.get('evento'), 0)+1
+            if args.conta:
+                continue
+            if args.json:
+                print(line)
+            else:
+                fields = ' '.join(f'{k}={json.dumps(v, ensure_ascii=False)}'
+                                  for k, v in event.items()
+                                  if k not in ('t', 'evento'))
+                print(strftime('%Y-%m-%d %H:%M:%S',
+                               localtime(event.get('t', 0))),
+                      f"{event.get('evento', '?'):<13}", fields)
+    except BrokenPipeError:
+        # e.g. piped into head
+        sys.exit(0)
+    except OSError as e:
+        print(f"Impossibile leggere il log: {e}.")
+        sys.exit(1)
+
+    if args.conta:
+        for event, n in sorted(counts.items(), key=lambda x: -x[1]):
+            print(f'{event:<13} {n}')
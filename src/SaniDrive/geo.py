@@ -0,0 +1,207 @@
+"""
+Locates the facilities of the appointment list through a bundled offline
+gazetteer, and measures their distance from home to filter and rank slots.
+
+The gazetteer, `data/luoghi_sardegna.csv`, lists Sardinian towns and
+facilities with the approximate coordinates of their centre. An address
+is matched against the facilities first, then against the town in its
+postcode part, and finally against any known town it mentions. Each
+address is located once per session; the ones that can't be located are
+appended to `data/indirizzi_sconosciuti.txt`, so that they can be added
+to the gazetteer later.
+
+See Also
+--------
+:py:mod:`monitor`, :py:mod:`rules`
+"""
+
+import os
+import re
+import csv
+from math import radians, sin, cos, asin, sqrt
+
+from appointment import Appointment
+from rules import town_of
+
+root = os.path.dirname(os.path.realpath(__file__))
+default_gazetteer = os.path.join(root, '../../data/luoghi_sardegna.csv')
+default_unknown_log = os.path.join(root, '../../data/indirizzi_sconosciuti.txt')
+EARTH_RADIUS_KM = 6371.0
+
+class GazetteerError(ValueError):
+    """Raised with a readable message when a place can't be used."""
+    pass
+
+class Gazetteer:
+    """
+    Class that maps addresses to coordinates.
+
+    Parameters
+    ----------
+    path : str
+        The gazetteer, a CSV file with columns nome, tipo, provincia, lat
+        and lon, where tipo is 'comune' or 'struttura'.
+    unknown_log : str, optional
+        The file to append unknown addresses to, None to not log them.
+
+    Attributes
+    ----------
+    towns : dict[str, tuple[float, float]]
+        Lowercase town names mapped to their coordinates.
+    facilities : list[tuple[str, tuple[float, float]]]
+        Lowercase facility names and their coordinates.
+    located : dict[str, tuple[float, float] | None]
+        The addresses located so far, None if unknown.
+    """
+    def __init__(self, path: str = default_gazetteer,
+                 unknown_log: str | None = default_unknown_log):
+        self.towns = {}
+        self.facilities = []
+        with open(path, 'r', newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                point = (float(row['lat']), float(row['lon']))
+                name = row['nome'].strip().lower()
+                if row['tipo'] == 'struttura':
+                    self.facilities.append((name, point))
+                else:
+                    self.towns[name] = point
+        # whole words only, longest first so that the most specific wins
+        names = sorted(self.towns, key=len, reverse=True)
+        self.town_pattern = re.compile(
+            r'\b(' + '|'.join(re.escape(n) for n in names) + r')\b')
+        self.unknown_log = unknown_log
+        self.logged = set()
+        if unknown_log is not None and os.path.isfile(unknown_log):
+            with open(unknown_log, 'r', encoding='utf-8') as f:
+                self.logged = {line.strip() for line in f}
+        self.located = {}
+
+    def locate(self, place: str) -> tuple[float, float] | None:
+        """Returns the coordinates of an address, or None if unknown"""
+        if place in self.located:
+            return self.located[place]
+        lower = place.lower()
+        point = None
+        for name, facility in self.facilities:
+            if name in lower:
+                point = facility
+                break
+        if point is None:
+            point = self.towns.get(town_of(place))
+        if point is None:
+            found = self.town_pattern.search(lower)
+            if found is not None:
+                point = self.towns[found.group(1)]
+        if point is None:
+            self._log_unknown(place)
+        self.located[place] = point
+        return point
+
+    def home(self, where: str) -> tuple[float, float]:
+        """
+        Returns the coordinates of the home location given with --casa,
+        either a town in the gazetteer or 'lat,lon'.
+
+        Raises
+        ------
+        GazetteerError
+            If `where` is neither.
+        """
+        try:
+            lat, lon = (float(x) for x in where.split(','))
+            return lat, lon
+        except ValueError:
+            pass
+        point = self.towns.get(where.strip().lower())
+        if point is None:
+            raise GazetteerError(f"il comune '{where}' non e' nell'elenco "+
+                "dei luoghi conosciuti, indica le coordinate nel formato "+
+                "latitudine,longitudine")
+        return point
+
+    def _log_unknown(self, place: str) -> None:
+        if self.unknown_log is None or place in self.logged:
+            return
+        self.logged.add(place)
+        try:
+            with open(self.unknown_log, 'a', encoding='utf-8') as f:
+                f.write(place + '\n')
+        except OSError:
+            pass
+
+def distances_km(home: tuple[float, float],
+                 points: list[tuple[float, float]]) -> list[float]:
+    """
+    Great-circle distances from `home` to every point, with the haversine
+    formula. The terms that only depend on `home` are computed once for
+    the whole batch.
+    """
+    lat0, lon0 = radians(home[0]), radians(home[1])
+    cos0 = cos(lat0)
+    distances = []
+    for lat, lon in points:
+        lat, lon = radians(lat), radians(lon)
+        h = sin((lat - lat0) / 2) ** 2 + \
+            cos0 * cos(lat) * sin((lon - lon0) / 2) ** 2
+        distances.append(2 * EARTH_RADIUS_KM * asin(sqrt(h)))
+    return distances
+
+class DistanceFilter:
+    """
+    Class that measures the distance of slots from home, once per address,
+    and tells whether they're close enough to be notified.
+
+    Parameters
+    ----------
+    gazetteer : Gazetteer
+        Used to locate the addresses.
+    home : tuple[float, float]
+        Latitude and longitude of home.
+    max_km : float | None
+        Slots farther than this aren't notified, None to only measure.
+
+    Attributes
+    ----------
+    km : dict[str, float | None]
+        The distance of every address measured so far, None if unknown.
+    """
+    def __init__(self, gazetteer: Gazetteer, home: tuple[float, float],
+                 max_km: float | None = None):
+        self.gazetteer = gazetteer
+        self.home = home
+        self.max_km = max_km
+        self.km = {}
+
+    def measure(self, appointments: list[Appointment]) -> None:
+        """Measure, in a single batch, the addresses not measured yet"""
+        new = {a.place for a in appointments if a.place not in self.km}
+        located = {}
+        for place in new:
+            point = self.gazetteer.locate(place)
+            if point is None:
+                self.km[place] = None
+            else:
+                located[place] = point
+        places = list(located)
+        for place, km in zip(places, distances_km(
+                self.home, [located[p] for p in places])):
+            self.km[place] = km
+
+    def distance(self, appnt: Appointment) -> float | None:
+        if appnt.place not in self.km:
+            self.measure([appnt])
+        return self.km[appnt.place]
+
+    def allows(self, appnt: Appointment) -> bool:
+        """Unknown addresses are allowed, better a useless notification
+        than a missed one"""
+        km = self.distance(appnt)
+        return self.max_km is None or km is None or km <= self.max_km
+
+    def rank(self, appointments: list[Appointment]) -> list[Appointment]:
+        """Returns the appointments closest first, unknown ones last,
+        earliest first at the same distance"""
+        self.measure(appointments)
+        far = float('inf')
+        return sorted(appointments, key=lambda a: (
+            far if self.km[a.place] is None else self.km[a.place], a.key))
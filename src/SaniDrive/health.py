@@ -0,0 +1,264 @@
+"""
+Checks every stored prescription against the CUP website before monitoring
+starts, so that expired, already booked or mistyped ones are found once
+and for all instead of after a full login in the middle of a watch.
+
+Checks run concurrently, each worker with its own headless browser, while
+a shared pacer keeps logins to the same host a minimum interval apart.
+Outcomes are cached in the prescription store and prescriptions known to
+be unusable are skipped until their outcome expires.
+
+See Also
+--------
+:py:mod:`prescription`, :py:mod:`driver`
+"""
+
+import sys
+import queue
+import threading
+from time import sleep, perf_counter
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+from selenium.webdriver.chrome.webdriver import WebDriver
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException, WebDriverException
+
+import driver as cup
+from prescription import Prescription, PrescriptionStore
+
+# Outcomes of a check, as stored in the database
+VALID = 'valida'
+EXPIRED = 'scaduta'
+BOOKED = 'prenotata'
+INVALID = 'errata'
+# not stored, the check has to be repeated
+UNKNOWN = 'sconosciuto'
+BAD = (EXPIRED, BOOKED, INVALID)
+DESCRIPTION = {
+    VALID: "valida",
+    EXPIRED: "scaduta",
+    BOOKED: "gia' prenotata",
+    INVALID: "credenziali errate",
+    UNKNOWN: "non verificata",
+}
+# lowercase fragments of the messages shown by the website after a login
+# that doesn't lead to the list, checked in this order
+MESSAGES = (
+    (BOOKED, ('gia\' prenotat', 'già prenotat', 'risulta prenotat',
+              'gia\' stata prenotata', 'già stata prenotata')),
+    (EXPIRED, ('scadut', 'non piu\' valid', 'non più valid')),
+    (INVALID, ('non trovat', 'non valid', 'errat', 'inesistent',
+               'non corrispond')),
+)
+
+class HostPacer:
+    """
+    Class that spaces out the requests made to the same host by several
+    threads, by handing out the next free start time under a lock.
+
+    Parameters
+    ----------
+    interval : float
+        Minimum seconds between two requests to the same host.
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_start = {}
+
+    def wait(self, url: str) -> None:
+        """Sleep until a request to the host of `url` is polite"""
+        host = urlsplit(url).netloc
+        with self.lock:
+            now = perf_counter()
+            start = max(now, self.next_start.get(host, now))
+            self.next_start[host] = start + self.interval
+        sleep(start - now)
+
+def classify_page(driver: WebDriver) -> str | None:
+    """
+    Returns the outcome of a login from the page it led to, or None if
+    the page doesn't tell yet.
+    """
+    if driver.find_elements(By.NAME, cup.name_button_proceed):
+        return VALID
+    text = driver.find_element(By.TAG_NAME, 'body').text.lower()
+    for status, fragments in MESSAGES:
+        if any(fragment in text for fragment in fragments):
+            return status
+    return None
+
+def check_prescription(driver: WebDriver, prescr: Prescription,
+                       pacer: HostPacer, timeout: float = 30) -> str:
+    """
+    Log in with the credentials of `prescr` and classify the outcome.
+
+    Parameters
+    ----------
+    driver : WebDriver
+        A driver used only by the calling thread.
+    prescr : Prescription
+        The prescription to check.
+    pacer : HostPacer
+        Shared between the threads checking at the same time, or anything
+        with the same `wait`, e.g. a `limiter.HostLimiter`.
+    timeout : float
+        Seconds to wait for the website to answer the login.
+
+    Returns
+    -------
+    str
+        One of VALID, EXPIRED, BOOKED, INVALID or UNKNOWN.
+    """
+    # malformed credentials don't need a login to be told apart
+    if not prescr.is_valid()[0]:
+        return INVALID
+
+    pacer.wait(cup.login_page)
+    try:
+        driver.get(cup.login_page)
+        for button in driver.find_elements(By.CSS_SELECTOR,
+                                           cup.class_button_cookies):
+            if button.is_displayed():
+                button.click()
+        field_cf = cup.locator_cf.find(driver)
+        field_nre = cup.locator_nre.find(driver)
+        button_submit = cup.locator_submit.find(driver)
+        if None in (field_cf, field_nre, button_submit):
+            return UNKNOWN
+        field_cf.send_keys(prescr.cf)
+        field_nre.send_keys(prescr.nre)
+        url = driver.current_url
+        button_submit.click()
+        # the login page itself may contain the fragments looked for, so
+        # it's classified only once the website answered
+        wait = WebDriverWait(driver, timeout)
+        wait.until(lambda d: d.current_url != url or
+                   EC.staleness_of(button_submit)(d))
+        return wait.until(classify_page)
+    except (TimeoutException, WebDriverException):
+        return UNKNOWN
+    finally:
+        # every check must start from a fresh session, unless the browser
+        # is gone, which the caller finds out with `browser_alive`
+        try:
+            driver.delete_all_cookies()
+        except WebDriverException:
+            pass
+
+def browser_alive(driver: WebDriver) -> bool:
+    """Returns False if the browser or ChromeDriver stopped answering"""
+    try:
+        driver.current_url
+        return True
+    except WebDriverException:
+        return False
+
+def quit_driver(driver: WebDriver) -> None:
+    """Quit a driver whose browser may already be dead"""
+    try:
+        driver.quit()
+    except WebDriverException:
+        pass
+
+def verify_prescriptions(prescrs: list[Prescription], store: PrescriptionStore,
+                         driver_path: str, workers: int = 3,
+                         interval: float = 2.0, ttl: float = 12 * 3600,
+                         limiter=None) -> dict[tuple[str, str], str]:
+    """
+    Check the prescriptions whose outcome isn't cached, printing each
+    outcome as soon as it's known, and cache the conclusive ones.
+
+    Parameters
+    ----------
+    prescrs : list[Prescription]
+        The prescriptions to check.
+    store : PrescriptionStore
+        The store holding the cached outcomes.
+    driver_path : str
+        The path of the ChromeDriver executable.
+    workers : int
+        Maximum number of browsers running at once.
+    interval : float
+        Minimum seconds between two logins, across all workers.
+    ttl : float
+        Seconds after which a cached outcome is checked again.
+    limiter : limiter.HostLimiter, optional
+        Spaces out the logins together with the other SaniDrive processes,
+        in place of `interval`.
+
+    Returns
+    -------
+    dict[tuple[str, str], str]
+        The outcome of every prescription, keyed by (cf, nre).
+    """
+    cached = store.statuses(ttl)
+    results = {}
+    pending = queue.Queue()
+    for prescr in prescrs:
+        key = (prescr.cf, prescr.nre)
+        if key in cached:
+            results[key] = cached[key]
+        else:
+            pending.put(prescr)
+
+    print(f"{len(results)} impegnative gia' verificate, "+
+          f"{pending.qsize()} da verificare.")
+    if pending.empty():
+        return results
+
+    pacer = HostPacer(interval) if limiter is None else limiter
+    print_lock = threading.Lock()
+
+    def worker():
+        driver = cup.init_driver(driver_path, False, debug_port=0,
+                                 verbose=False)
+        try:
+            while True:
+                try:
+                    prescr = pending.get_nowait()
+                except queue.Empty:
+                    return
+                status = check_prescription(driver, prescr, pacer)
+                if status == UNKNOWN and not browser_alive(driver):
+                    # a dead browser says nothing about the prescription,
+                    # which is checked again with a new one
+                    quit_driver(driver)
+                    driver = None
+                    driver = cup.init_driver(driver_path, False,
+                                             debug_port=0, verbose=False)
+                    status = check_prescription(driver, prescr, pacer)
+                with print_lock:
+                    results[(prescr.cf, prescr.nre)] = status
+                    print(f"  {prescr.cf}  {prescr.nre}  "+
+                          f"{prescr.name[:24]:<24}  {DESCRIPTION[status]}")
+                    sys.stdout.flush()
+        finally:
+            if driver is not None:
+                quit_driver(driver)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(worker)
+                   for _ in range(min(workers, pending.qsize()))]
+    for future in futures:
+        if future.exception() is not None:
+            print("Non e' stato possibile avviare tutti i browser: "+
+                  str(future.exception()).splitlines()[0])
+    # left in the queue, or lost with a browser that couldn't be replaced
+    unchecked = [p for p in prescrs if (p.cf, p.nre) not in results]
+    for prescr in unchecked:
+        results[(prescr.cf, prescr.nre)] = UNKNOWN
+    if unchecked:
+        print(f"{len(unchecked)} impegnative non verificate, lo saranno al "+
+              "prossimo avvio.")
+
+    # SQLite connections belong to the thread that made them
+    for prescr in prescrs:
+        status = results.get((prescr.cf, prescr.nre))
+        if status is not None and status != UNKNOWN and \
+           (prescr.cf, prescr.nre) not in cached:
+            store.set_status(prescr, status)
+    return results
@@ -0,0 +1,110 @@
+"""
+Remembers which slots were already announced, so that restarts and other
+instances watching the same prescription don't notify them again.
+
+The ledger is a SQLite database in WAL mode, shared by every SaniDrive
+process on the machine. A notification is claimed by inserting the
+fingerprint of its slot: the insert succeeds for exactly one process,
+which is the one that dispatches it. Entries expire after a TTL, and the
+table is kept below a maximum size by dropping the oldest entries, so a
+lookup stays a single primary key search however long SaniDrive runs.
+
+See Also
+--------
+:py:mod:`appointment`
+"""
+
+import sqlite3
+import hashlib
+from time import time
+
+from appointment import Appointment
+
+class NotificationLedger:
+    """
+    Class that records the notifications already dispatched.
+
+    Parameters
+    ----------
+    path : str
+        The database file, created if it doesn't exist.
+    ttl : float
+        Seconds after which a slot can be notified again.
+    max_entries : int
+        Entries above which the oldest ones are dropped.
+    clock : callable, optional
+        Returns the current time in seconds, `time.time` by default.
+
+    Attributes
+    ----------
+    suppressed : int
+        Notifications not dispatched in this session because already
+        claimed.
+
+    Methods
+    -------
+    fingerprint(nre, appnt)
+        Static method that returns the key of a slot.
+    claim(nre, appnt)
+        Returns True if the slot wasn't notified within the TTL, in which
+        case it's now recorded as notified.
+    """
+    def __init__(self, path: str, ttl: float = 24 * 3600,
+                 max_entries: int = 10000, clock=time):
+        self.path = path
+        self.clock = clock
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.suppressed = 0
+        self.claims = 0
+        # the timeout makes concurrent writers wait instead of failing
+        self.conn = sqlite3.connect(path, timeout=10)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS notifiche ('+
+                'impronta TEXT PRIMARY KEY, t REAL NOT NULL, '+
+                'scade REAL NOT NULL) WITHOUT ROWID')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS notifiche_scade '+
+                'ON notifiche (scade)')
+        self.prune()
+
+    def __len__(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM notifiche'
+                                 ).fetchone()[0]
+
+    @staticmethod
+    def fingerprint(nre: str, appnt: Appointment) -> str:
+        data = '\x1f'.join((nre, appnt.place, appnt.date, appnt.time))
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def claim(self, nre: str, appnt: Appointment) -> bool:
+        now = self.clock()
+        key = self.fingerprint(nre, appnt)
+        with self.conn:
+            self.conn.execute('DELETE FROM notifiche WHERE impronta = ? '+
+                              'AND scade <= ?', (key, now))
+            cursor = self.conn.execute('INSERT OR IGNORE INTO notifiche '+
+                '(impronta, t, scade) VALUES (?, ?, ?)',
+                (key, now, now + self.ttl))
+        claimed = cursor.rowcount == 1
+        if not claimed:
+            self.suppressed += 1
+            return False
+        self.claims += 1
+        if self.claims % 100 == 0:
+            self.prune()
+        return True
+
+    def prune(self) -> None:
+        """Drop expired entries, then the oldest ones above the limit"""
+        with self.conn:
+            self.conn.execute('DELETE FROM notifiche WHERE scade <= ?',
+                              (self.clock(),))
+            excess = len(self) - self.max_entries
+            if excess > 0:
+                self.conn.execute('DELETE FROM notifiche WHERE impronta IN '+
+                    '(SELECT impronta FROM notifiche ORDER BY scade LIMIT ?)',
+                    (excess,))
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,222 @@
+"""
+Keeps long watches healthy by measuring the memory of the browser every
+cycle and replacing it with a fresh one when it has served long enough.
+
+Chrome reloading the same JSF application every few seconds grows in
+memory for days. The WebDriver is recycled after a number of cycles, a
+time budget or a memory ceiling, whichever comes first. The new browser
+reaches the appointment list before the old one is closed, so the
+replacement never costs a poll.
+
+Memory is measured over the whole process tree of ChromeDriver, i.e.
+Chrome and its renderers, with psutil if installed and through /proc
+otherwise. Where neither is available, it's simply not measured.
+
+See Also
+--------
+:py:mod:`driver`
+"""
+
+import os
+from time import perf_counter
+from collections import deque
+
+try:
+    import psutil
+except ImportError:
+    # optional, /proc is read instead where it exists
+    psutil = None
+
+# characters used to draw the memory history in the terminal
+SPARKS = '▁▂▃▄▅▆▇█'
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+# seconds before a failed replacement is tried again, doubling with every
+# failure in a row up to the maximum
+RETRY_BASE = 60
+RETRY_MAX = 3600
+
+def _proc_tree_rss(pid: int) -> int | None:
+    """Sums the resident memory of `pid` and its descendants from /proc"""
+    if not os.path.isdir('/proc'):
+        return None
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # the name in parentheses may contain spaces, the ppid follows it
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f'/proc/{current}/statm', 'r') as f:
+                total += int(f.read().split()[1]) * PAGE_SIZE
+        except OSError:
+            continue
+    return total
+
+def process_tree_rss(pid: int) -> int | None:
+    """
+    Returns the resident memory in bytes of a process and all of its
+    descendants, or None if it can't be measured on this system.
+    """
+    if psutil is None:
+        return _proc_tree_rss(pid)
+    try:
+        root = psutil.Process(pid)
+        processes = [root] + root.children(recursive=True)
+    except psutil.Error:
+        return None
+    total = 0
+    for process in processes:
+        try:
+            total += process.memory_info().rss
+        except psutil.Error:
+            continue
+    return total
+
+def sparkline(values: list[float]) -> str:
+    """Returns a one-line chart of `values`, scaled to their range"""
+    if not values:
+        return ''
+    low, high = min(values), max(values)
+    span = (high - low) or 1
+    return ''.join(SPARKS[int((v - low) / span * (len(SPARKS) - 1))]
+                   for v in values)
+
+class BrowserLifecycle:
+    """
+    Class that owns the WebDriver of a watch and decides when to replace it.
+
+    Parameters
+    ----------
+    factory : Callable[[], WebDriver]
+        Starts a new driver, called once here and once per recycle.
+    max_cycles : int
+        Cycles after which the driver is recycled, 0 for no limit.
+    max_mb : float
+        Memory of the browser in MB above which it's recycled, 0 for no
+        limit.
+    max_seconds : float
+        Seconds after which the driver is recycled, 0 for no limit.
+    history : int
+        Number of memory samples kept for the chart.
+
+    Attributes
+    ----------
+    driver : WebDriver
+        The driver in use.
+    cycles : int
+        Cycles run by the current driver.
+    recycles : int
+        Number of times the driver was replaced.
+    failures : int
+        Number of times a new driver couldn't be started.
+    retry_after : float
+        `perf_counter` time before which no replacement is due, after a
+        failed one.
+    memory : deque[float]
+        The latest memory samples in MB.
+
+    Methods
+    -------
+    measure()
+        Sample the memory of the current browser, returns MB or None.
+    due()
+        Returns the reason the driver should be recycled, or None.
+    recycle(prepare)
+        Replace the driver with a new one made ready by `prepare`.
+    """
+    def __init__(self, factory, max_cycles: int = 0, max_mb: float = 0,
+                 max_seconds: float = 0, history: int = 60):
+        self.factory = factory
+        self.max_cycles = max_cycles
+        self.max_mb = max_mb
+        self.max_seconds = max_seconds
+        self.driver = factory()
+        self.started = perf_counter()
+        self.cycles = 0
+        self.recycles = 0
+        self.failures = 0
+        self.failed_in_row = 0
+        self.retry_after = 0.0
+        self.memory = deque(maxlen=history)
+
+    def measure(self) -> float | None:
+        """Count a cycle and sample the memory of the browser"""
+        self.cycles += 1
+        try:
+            pid = self.driver.service.process.pid
+        except AttributeError:
+            return None
+        rss = process_tree_rss(pid)
+        if rss is None:
+            return None
+        self.memory.append(rss / 2**20)
+        return self.memory[-1]
+
+    def due(self) -> str | None:
+        """Returns a readable reason if the driver should be recycled"""
+        if perf_counter() < self.retry_after:
+            return None
+        if self.max_cycles and self.cycles >= self.max_cycles:
+            return f"dopo {self.cycles} aggiornamenti"
+        if self.max_mb and self.memory and self.memory[-1] > self.max_mb:
+            return f"memoria oltre {self.max_mb:.0f} MB"
+        if self.max_seconds and \
+           perf_counter() - self.started >= self.max_seconds:
+            return f"dopo {(perf_counter() - self.started) / 3600:.1f} ore"
+        return None
+
+    def recycle(self, prepare) -> bool:
+        """
+        Start a new driver, bring it where the old one was with `prepare`,
+        then close the old one.
+
+        Parameters
+        ----------
+        prepare : Callable[[WebDriver], None]
+            Reaches the appointment list with the given driver.
+
+        Returns
+        -------
+        bool
+            False if the new driver couldn't be started, in which case the
+            old one is kept and tried again after another full budget, or
+            after a backoff for the memory ceiling.
+        """
+        try:
+            new = self.factory()
+        except Exception:
+            self.failures += 1
+            self.failed_in_row += 1
+            self.cycles = 0
+            self.started = perf_counter()
+            # memory stays over the ceiling, so it would be due every cycle
+            self.retry_after = self.started + min(
+                RETRY_MAX, RETRY_BASE * 2 ** (self.failed_in_row - 1))
+            return False
+        try:
+            prepare(new)
+        except BaseException:
+            new.quit()
+            raise
+        old, self.driver = self.driver, new
+        try:
+            old.quit()
+        except Exception:
+            pass
+        self.cycles = 0
+        self.started = perf_counter()
+        self.failed_in_row = 0
+        self.recycles += 1
+        return True
@@ -0,0 +1,129 @@
+"""
+Limits the logins to the CUP website made by all the SaniDrive processes
+running on the same computer, so that watches started independently, each
+with its own interval, don't log in all at the same moment and get
+throttled.
+
+The limiter is a token bucket in the form of the generic cell rate
+algorithm: a small state file holds, per host, the theoretical arrival
+time of the next login. Under an exclusive lock on the file, a process
+reserves the earliest start allowed by the rate and the burst and moves
+the arrival time forward, then releases the lock and sleeps until its
+start. Reservations are handed out in the order processes ask for them,
+so waiting is fair and nobody starves, and the lock is only held for the
+few microseconds of the update.
+
+See Also
+--------
+:py:mod:`health` for the pacer of the threads of a single process.
+"""
+
+import json
+import threading
+from time import time, sleep
+from urllib.parse import urlsplit
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+def _lock(f) -> None:
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return
+    f.seek(0)
+    while True:
+        try:
+            # retries for 10 seconds before failing
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+def _unlock(f) -> None:
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        return
+    f.seek(0)
+    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+class HostLimiter:
+    """
+    Class that spaces out the logins of every process on the computer, by
+    handing out the next free start time under a file lock.
+
+    Parameters
+    ----------
+    path : str
+        The state file shared by the processes, created if it doesn't
+        exist.
+    per_minute : float
+        Logins per minute allowed to each host, on average.
+    burst : int
+        Logins allowed at once after a quiet period.
+
+    Attributes
+    ----------
+    last_wait : float
+        Seconds waited by the last call to `wait`.
+    waited : float
+        Seconds waited in total by this process.
+    calls : int
+        Number of calls to `wait`.
+
+    Methods
+    -------
+    wait(url)
+        Sleep until a login to the host of `url` is allowed, returns the
+        seconds waited.
+    """
+    def __init__(self, path: str, per_minute: float, burst: int = 1):
+        self.path = path
+        self.interval = 60 / per_minute
+        # how far ahead of its arrival time a login may start
+        self.tolerance = (max(burst, 1) - 1) * self.interval
+        self.lock = threading.Lock()
+        self.last_wait = 0.0
+        self.waited = 0.0
+        self.calls = 0
+
+    def reserve(self, host: str) -> float:
+        """Returns the time at which a login to `host` may start"""
+        with self.lock, open(self.path, 'a+', encoding='utf-8') as f:
+            _lock(f)
+            try:
+                f.seek(0)
+                try:
+                    arrivals = json.loads(f.read() or '{}')
+                except ValueError:
+                    arrivals = {}
+                now = time()
+                tat = arrivals.get(host, now)
+                # a clock set back, or a state from the far future
+                if tat > now + self.tolerance + 100 * self.interval:
+                    tat = now
+                start = max(now, tat - self.tolerance)
+                arrivals[host] = max(tat, now) + self.interval
+                # forget hosts nobody logged into for a while
+                arrivals = {h: t for h, t in arrivals.items()
+                            if t > now - 3600}
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(arrivals))
+                f.flush()
+            finally:
+                _unlock(f)
+        return start
+
+    def wait(self, url: str) -> float:
+        """Sleep until a login to the host of `url` is polite"""
+        start = self.reserve(urlsplit(url).netloc)
+        delay = max(0.0, start - time())
+        sleep(delay)
+        self.last_wait = delay
+        self.waited += delay
+        self.calls += 1
+        return delay
@@ -0,0 +1,192 @@
+"""
+End-to-end benchmark of the polling pipeline against the local fake CUP
+website of :py:mod:`mockcup`.
+
+For every combination of polling interval and list size, a fresh fake
+website and ChromeDriver are started and a number of cycles is run through
+the same routines used by SaniDrive, measuring cycle time, the time from
+the appearance of a slot to its notification and the memory used by
+ChromeDriver and the browser, sampled after every cycle of the scenario.
+
+Example: `py loadtest.py --intervalli 0 5 --dimensioni 10 200 --cicli 20`
+"""
+
+import io
+import json
+import argparse
+import statistics
+from time import time, sleep, perf_counter
+from contextlib import redirect_stdout
+
+import driver as cup
+from mockcup import MockCup
+from monitor import Monitor
+from appointment import Appointment
+from lifecycle import process_tree_rss
+from driver import init_driver, get_appointments_page, expand_list
+from driver import extract_appointments, CookieKeeper
+
+# dummy credentials, the fake website accepts anything that isn't empty
+CF = 'RSSMRA80A01B354S'
+NRE = '2000A0000000001'
+
+def browser_mb(driver) -> float | None:
+    """Returns the resident memory of ChromeDriver and the browsers it
+    started, in MB"""
+    try:
+        pid = driver.service.process.pid
+    except AttributeError:
+        return None
+    rss = process_tree_rss(pid)
+    return None if rss is None else rss / 2**20
+
+def percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def run_scenario(driver_path: str, visible: bool, size: int, interval: float,
+                 cycles: int, latency: float, jitter: float,
+                 failure_rate: float, churn: float,
+                 seed: int | None) -> dict:
+    """
+    Run `cycles` polling cycles against a fresh fake website.
+
+    Notifications follow what happens when the user keeps pressing Enter
+    without booking: each notified slot becomes the new threshold, so only
+    strictly sooner slots notify again.
+
+    Returns
+    -------
+    dict
+        The measurements of the scenario.
+    """
+    mock = MockCup(size=size, latency=latency, jitter=jitter,
+                   failure_rate=failure_rate, churn=churn, seed=seed)
+    cup.login_page = mock.start()
+    quiet = io.StringIO()
+    with redirect_stdout(quiet):
+        driver = init_driver(driver_path, visible)
+    cookies = CookieKeeper()
+    monitor = Monitor(Appointment('', '', '', ''))
+
+    cycle_times = []
+    notification_latencies = []
+    detection_latencies = []
+    failures = 0
+    seen = set()
+    # the memory of this scenario's browser only, once the first page is up
+    memory = []
+    try:
+        for n in range(cycles):
+            start = perf_counter()
+            try:
+                with redirect_stdout(quiet):
+                    get_appointments_page(driver, CF, NRE, cookies)
+                    expand_list(driver)
+                    appointments = extract_appointments(driver)
+            except SystemExit:
+                # _fail() exits on broken pages, count it and poll again
+                failures += 1
+                cookies.purge(driver)
+                continue
+            cycle_times.append(perf_counter() - start)
+            now = time()
+            mb = browser_mb(driver)
+            if mb is not None:
+                memory.append(mb)
+
+            # how long new slots took to be seen, and notified
+            appeared = {(s['date'], s['time'], s['place']): s['appeared']
+                        for s in mock.state()['slots']}
+            keys = {(a.date, a.time, a.place) for a in appointments}
+            for key in keys - seen:
+                if n > 0 and key in appeared:
+                    detection_latencies.append(now - appeared[key])
+            seen = keys
+
+            notify = monitor.update(appointments)
+            if notify is not None:
+                key = (notify.date, notify.time, notify.place)
+                if monitor.refresh_counter > 0 and key in appeared:
+                    notification_latencies.append(now - appeared[key])
+                monitor.postpone(notify)
+            monitor.advance()
+
+            quiet.seek(0); quiet.truncate()
+            cookies.purge(driver)
+            sleep(interval)
+    finally:
+        driver.quit()
+        mock.stop()
+
+    return {
+        'size': size,
+        'interval': interval,
+        'cycles': len(cycle_times),
+        'failures': failures,
+        'requests': mock.requests,
+        'cycle_mean': statistics.fmean(cycle_times) if cycle_times else None,
+        'cycle_p50': percentile(cycle_times, 0.5),
+        'cycle_p95': percentile(cycle_times, 0.95),
+        'detection_mean': statistics.fmean(detection_latencies)
+                          if detection_latencies else None,
+        'notification_mean': statistics.fmean(notification_latencies)
+                             if notification_latencies else None,
+        'notification_max': max(notification_latencies, default=None),
+        'notifications': len(notification_latencies),
+        'memory_start_mb': memory[0] if memory else None,
+        'memory_peak_mb': max(memory, default=None),
+        'memory_end_mb': memory[-1] if memory else None,
+        'memory_growth_mb': memory[-1] - memory[0] if memory else None,
+    }
+
+def print_results(results: list[dict]) -> None:
+    fmt = lambda v: '-' if v is None else f'{v:.2f}'
+    print(f"{'Righe':>6} {'Interv.':>8} {'Cicli':>6} {'Errori':>7} "+
+          f"{'Ciclo':>7} {'p95':>7} {'Rilev.':>7} {'Notif.':>7} "+
+          f"{'Mem MB':>8} {'Picco':>8} {'Cresc.':>8}")
+    for r in results:
+        print(f"{r['size']:>6} {r['interval']:>8} {r['cycles']:>6} "+
+              f"{r['failures']:>7} {fmt(r['cycle_mean']):>7} "+
+              f"{fmt(r['cycle_p95']):>7} {fmt(r['detection_mean']):>7} "+
+              f"{fmt(r['notification_mean']):>7} "+
+              f"{fmt(r['memory_end_mb']):>8} "+
+              f"{fmt(r['memory_peak_mb']):>8} "+
+              f"{fmt(r['memory_growth_mb']):>8}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='loadtest',
+        description='Misura i tempi di SaniDrive contro un finto sito CUP')
+    parser.add_argument('--driver', default='', metavar='FILE',
+        help="Percorso dell'eseguibile di ChromeDriver")
+    parser.add_argument('--visibile', '-v', dest='visible',
+                        action='store_true')
+    parser.add_argument('--intervalli', type=float, nargs='+', default=[0],
+        metavar='SECONDI')
+    parser.add_argument('--dimensioni', type=int, nargs='+', default=[20],
+        metavar='N', help='Numero di appuntamenti nella lista')
+    parser.add_argument('--cicli', type=int, default=10)
+    parser.add_argument('--latenza', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--guasti', type=float, default=0.0,
+        help='Probabilita\' che una pagina sia servita rotta')
+    parser.add_argument('--churn', type=float, default=0.3,
+        help='Probabilita\' che un appuntamento cambi ad ogni aggiornamento')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', '-o', default=None, metavar='FILE',
+        help='Salva i risultati in formato JSON')
+    args = parser.parse_args()
+
+    results = []
+    for size in args.dimensioni:
+        for interval in args.intervalli:
+            results.append(run_scenario(args.driver, args.visible, size,
+                                        interval, args.cicli, args.latenza,
+                                        args.jitter, args.guasti, args.churn,
+                                        args.seed))
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,172 @@
+"""
+Provides cached element lookup and page fingerprinting for the CUP pages,
+whose element ids are partly assigned dynamically.
+
+A `Locator` tries a list of strategies once, remembers the one that worked
+and keeps using it for the rest of the session, rescanning only when the
+cached selector stops matching. A `LayoutWatch` reduces a page to the
+presence of the elements SaniDrive needs, so that a change of layout can be
+told apart from a slow page and reported once.
+
+See Also
+--------
+:py:mod:`driver`
+"""
+
+import json
+import hashlib
+
+from selenium.webdriver.chrome.webdriver import WebDriver
+from selenium.webdriver.remote.webelement import WebElement
+from selenium.webdriver.common.by import By
+
+class Locator:
+    """
+    Class that finds an element through the first working strategy and
+    caches it for the session.
+
+    Parameters
+    ----------
+    name : str
+        Readable name, used when reporting.
+    strategies : list[tuple[str, str]]
+        Pairs of Selenium `By` and selector, most specific first.
+    text : str, optional
+        If given, as a last resort every button is scanned for this text
+        and, if found, its id or name becomes the cached strategy.
+
+    Attributes
+    ----------
+    cached : tuple[str, str] | None
+        The strategy that worked last.
+    scans : int
+        How many times the strategies had to be tried from scratch.
+    """
+    def __init__(self, name: str, strategies: list[tuple[str, str]],
+                 text: str | None = None):
+        self.name = name
+        self.strategies = strategies
+        self.text = text
+        self.cached = None
+        self.scans = 0
+
+    def find(self, driver: WebDriver) -> WebElement | None:
+        """
+        Returns the element, or None if no strategy finds it. The cached
+        strategy costs a single ChromeDriver round trip.
+        """
+        if self.cached is not None:
+            found = driver.find_elements(*self.cached)
+            if found:
+                return found[0]
+            self.cached = None
+
+        self.scans += 1
+        for strategy in self.strategies:
+            found = driver.find_elements(*strategy)
+            if found:
+                self.cached = strategy
+                return found[0]
+
+        # slow path, one round trip per button as SaniDrive used to do
+        if self.text is not None:
+            for button in driver.find_elements(By.TAG_NAME, 'button'):
+                if button.text == self.text:
+                    self._cache_attribute(button)
+                    return button
+        return None
+
+    def forget(self) -> None:
+        """Drop the cached strategy, e.g. after a stale element."""
+        self.cached = None
+
+    def _cache_attribute(self, element: WebElement) -> None:
+        element_id = element.get_attribute('id')
+        if element_id:
+            self.cached = (By.ID, element_id)
+            return
+        element_name = element.get_attribute('name')
+        if element_name:
+            self.cached = (By.NAME, element_name)
+
+class LayoutWatch:
+    """
+    Class that fingerprints a page by the presence of the elements that
+    SaniDrive needs, learns the fingerprint of a working page and reports a
+    different one only once.
+
+    Parameters
+    ----------
+    name : str
+        Readable name of the page.
+    selectors : dict[str, str]
+        Readable element names mapped to CSS selectors.
+    texts : dict[str, str]
+        Readable element names mapped to the exact text of a button.
+
+    Attributes
+    ----------
+    known : str | None
+        Fingerprint of the page when it last worked.
+    reported : set[str]
+        Fingerprints already reported to the user.
+    """
+    _script = """
+        if (document.readyState !== 'complete') return null;
+        var selectors = arguments[0], texts = arguments[1], out = {};
+        for (var k in selectors)
+            out[k] = document.querySelector(selectors[k]) !== null;
+        var buttons = Array.from(document.getElementsByTagName('button'));
+        for (var k in texts)
+            out[k] = buttons.some(function (b) {
+                return b.textContent.trim() === texts[k]; });
+        return out;
+    """
+
+    def __init__(self, name: str, selectors: dict[str, str],
+                 texts: dict[str, str] | None = None):
+        self.name = name
+        self.selectors = selectors
+        self.texts = texts or {}
+        self.known = None
+        self.reported = set()
+
+    def presence(self, driver: WebDriver) -> dict[str, bool] | None:
+        """Returns which elements are on the page, in one round trip, or
+        None if the page is still loading"""
+        return driver.execute_script(self._script, self.selectors, self.texts)
+
+    @staticmethod
+    def fingerprint(presence: dict[str, bool]) -> str:
+        data = json.dumps(presence, sort_keys=True).encode()
+        return hashlib.sha1(data).hexdigest()[:12]
+
+    def learn(self, driver: WebDriver) -> None:
+        """Remember the fingerprint of the page, which is known to work."""
+        presence = self.presence(driver)
+        if presence is not None:
+            self.known = self.fingerprint(presence)
+
+    def check(self, driver: WebDriver) -> list[str] | None:
+        """
+        Compare the current page with the one that last worked.
+
+        Returns
+        -------
+        list[str]
+            The missing elements, the first time a changed layout is seen.
+        None
+            If the layout is the known one, was already reported, or the
+            page is still loading.
+        """
+        presence = self.presence(driver)
+        if presence is None:
+            return None
+        fingerprint = self.fingerprint(presence)
+        if fingerprint == self.known or fingerprint in self.reported:
+            return None
+        missing = [k for k, present in presence.items() if not present]
+        if not missing:
+            return None
+        self.reported.add(fingerprint)
+        return missing
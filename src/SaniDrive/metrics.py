@@ -0,0 +1,263 @@
+"""
+Collects per-stage timings and counters of the polling pipeline and exports
+them as a Prometheus text file, a tiny local `/metrics` HTTP endpoint and
+JSON lines.
+
+Metrics are disabled until `enable` is called; while disabled, `stage`
+returns a shared no-op context manager and the other module-level routines
+return immediately, so instrumenting `run()` costs next to nothing.
+"""
+
+import os
+import json
+import threading
+from time import time, perf_counter
+from bisect import bisect_left
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Static lookup tables
+STAGES = (
+    'driver_init', 'login_wait', 'page_get', 'cookie_banner',
+    'credential_submit', 'proceed_wait', 'list_expansion', 'extraction',
+    'comparison', 'notification', 'render'
+)
+COUNTERS = ('refreshes', 'changes', 'failures', 'notifications', 'recycles',
+            'duplicates_suppressed', 'rate_limited', 'flapping_suppressed')
+# upper bounds in seconds of the histogram buckets, +Inf is implicit
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets, as used by Prometheus.
+
+    Attributes
+    ----------
+    counts : list[int]
+        Observations per bucket, the last one being +Inf.
+    total : float
+        Sum of all observed values.
+    n : int
+        Number of observations.
+    """
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.n = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.n += 1
+
+class _Stage:
+    """Internal context manager that times a stage of the current cycle,
+    leaving out the time of the stages nested in it"""
+    __slots__ = ('registry', 'name', 'start', 'outer')
+
+    def __init__(self, registry: 'Metrics', name: str):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        now = perf_counter()
+        self.outer = self.registry.active
+        if self.outer is not None:
+            # the outer stage stops counting while this one runs
+            self.outer._add(now)
+        self.registry.active = self
+        self.registry.current = self.name
+        self.start = now
+        return self
+
+    def __exit__(self, *exc):
+        now = perf_counter()
+        self._add(now)
+        self.registry.active = self.outer
+        if self.outer is None:
+            self.registry.current = None
+        else:
+            self.outer.start = now
+            self.registry.current = self.outer.name
+        return False
+
+    def _add(self, now: float) -> None:
+        cycle = self.registry.cycle
+        cycle[self.name] = cycle.get(self.name, 0.0) + now - self.start
+
+class Metrics:
+    """
+    Registry of stage histograms and counters, plus their exporters.
+
+    Stage timings are summed within a cycle, so that a stage timed in more
+    than one block counts once, and are observed into the histograms when
+    `end_cycle` is called. A stage started inside another is timed on its
+    own and left out of the outer one, so the stages never overlap, e.g.
+    a login done while extracting isn't counted as extraction.
+
+    Parameters
+    ----------
+    prom_path : str, optional
+        Path of the Prometheus text file rewritten at the end of each cycle.
+    jsonl_path : str, optional
+        Path of the file to which one JSON line per cycle is appended.
+    port : int, optional
+        If given, serve the Prometheus text on http://127.0.0.1:port/metrics
+
+    Attributes
+    ----------
+    current : str | None
+        The innermost stage being timed, None between stages.
+
+    Methods
+    -------
+    stage(name)
+        Return a context manager timing stage `name` of the current cycle.
+    inc(name, n)
+        Increase counter `name` by `n`.
+    gauge(name, value)
+        Set gauge `name`, a value that can go up and down, to `value`.
+    end_cycle()
+        Fold the current cycle into the histograms and export everything.
+    """
+    def __init__(self, prom_path: str | None = None,
+                 jsonl_path: str | None = None, port: int | None = None):
+        self.prom_path = prom_path
+        self.jsonl_path = jsonl_path
+        self.histograms = {name: Histogram() for name in STAGES}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.gauges = {}
+        self.cycle = {}
+        self.last_cycle = {}
+        self.current = None
+        self.active = None
+        self.lock = threading.Lock()
+        self.server = None
+        if port is not None:
+            self.serve(port)
+
+    def stage(self, name: str) -> _Stage:
+        return _Stage(self, name)
+
+    def inc(self, name: str, n: int = 1) -> None:
+        # a new key would break an export iterating from another thread
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name: str, value: float) -> None:
+        with self.lock:
+            self.gauges[name] = value
+
+    def end_cycle(self) -> None:
+        with self.lock:
+            for name, elapsed in self.cycle.items():
+                if name not in self.histograms:
+                    self.histograms[name] = Histogram()
+                self.histograms[name].observe(elapsed)
+            self.last_cycle = self.cycle
+            self.cycle = {}
+        self.export()
+
+    def prometheus(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format"""
+        lines = ['# HELP sanidrive_stage_seconds Time spent in each stage '+
+                 'of a polling cycle.',
+                 '# TYPE sanidrive_stage_seconds histogram']
+        with self.lock:
+            for name, h in self.histograms.items():
+                cumulative = 0
+                for bound, count in zip(h.buckets + ('+Inf',), h.counts):
+                    cumulative += count
+                    lines.append(f'sanidrive_stage_seconds_bucket{{stage='+
+                                 f'"{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'sanidrive_stage_seconds_sum{{stage="{name}"}} '+
+                             f'{h.total:.6f}')
+                lines.append(f'sanidrive_stage_seconds_count{{stage="{name}"}}'+
+                             f' {h.n}')
+            for name, value in self.counters.items():
+                lines.append(f'# TYPE sanidrive_{name}_total counter')
+                lines.append(f'sanidrive_{name}_total {value}')
+            for name, value in self.gauges.items():
+                lines.append(f'# TYPE sanidrive_{name} gauge')
+                lines.append(f'sanidrive_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        """Returns the counters, the gauges and the stage timings of the
+        last cycle and on average, as a JSON serialisable dict"""
+        with self.lock:
+            stages = {name: {'last': self.last_cycle.get(name),
+                             'mean': h.total / h.n if h.n else None,
+                             'count': h.n}
+                      for name, h in self.histograms.items()}
+            return {'counters': dict(self.counters),
+                    'gauges': dict(self.gauges), 'stages': stages}
+
+    def export(self) -> None:
+        """Write the Prometheus text file and append a JSON line."""
+        if self.prom_path is not None:
+            # write and rename so scrapers never read a half-written file
+            tmp_path = self.prom_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(self.prometheus())
+            os.replace(tmp_path, self.prom_path)
+        if self.jsonl_path is not None:
+            with self.lock:
+                record = {'time': time(), 'stages': self.last_cycle,
+                          'counters': dict(self.counters),
+                          'gauges': dict(self.gauges)}
+            with open(self.jsonl_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def serve(self, port: int) -> None:
+        """Serve the metrics on localhost from a daemon thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # keep the terminal clean, it's redrawn every cycle
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+# Variables
+registry = None
+_disabled = nullcontext()
+
+# Module-level shortcuts, no-ops until metrics are enabled
+def enable(prom_path: str | None = None, jsonl_path: str | None = None,
+           port: int | None = None) -> Metrics:
+    global registry
+    registry = Metrics(prom_path, jsonl_path, port)
+    return registry
+
+def stage(name: str):
+    if registry is None:
+        return _disabled
+    return registry.stage(name)
+
+def inc(name: str, n: int = 1) -> None:
+    if registry is not None:
+        registry.inc(name, n)
+
+def gauge(name: str, value: float) -> None:
+    if registry is not None:
+        registry.gauge(name, value)
+
+def end_cycle() -> None:
+    if registry is not None:
+        registry.end_cycle()
@@ -0,0 +1,302 @@
+"""
+Local stand-in for the CUP website, reproducing only the page shapes that
+SaniDrive relies on: the cookie bar, the login form, the proceed button,
+the 'Altre disponibilità' button and the `.appuntamento` blocks.
+
+Latency, failures and the churn of the available slots are configurable,
+so that SaniDrive can be tested and benchmarked without touching the real
+website or real prescriptions.
+
+Run it standalone with `py mockcup.py --porta 8765` and point SaniDrive's
+`driver.login_page` at the printed address, or start it from Python with
+`MockCup(...).start()` as done by :py:mod:`loadtest`.
+"""
+
+import sys
+import json
+import random
+import argparse
+import threading
+from time import time, sleep
+from datetime import date, timedelta
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import MONTH
+import driver as cup
+
+# Static lookup tables
+WEEKDAYS = ('Lunedì', 'Martedì', 'Mercoledì', 'Giovedì', 'Venerdì', 'Sabato',
+            'Domenica')
+HTNOM = {v: k for k, v in MONTH.items()}
+PLACES = (
+    'Via Roma 12, 09124 Cagliari (CA)',
+    'Viale San Pietro 43, 07100 Sassari (SS)',
+    'Via Demurtas 1, 08100 Nuoro (NU)',
+    'Via Carducci 35, 09170 Oristano (OR)',
+    'Via Bellini 4, 09013 Carbonia (SU)',
+    'Via Azuni 3, 07026 Olbia (SS)',
+    'Via Emilia 1, 09045 Quartu Sant\'Elena (CA)',
+)
+# messages shown instead of the list for unusable prescriptions
+LOGIN_MESSAGES = {
+    'scaduta': 'La ricetta risulta scaduta.',
+    'prenotata': 'La ricetta risulta già prenotata.',
+    'errata': 'Ricetta non trovata: verificare i dati inseriti.',
+}
+# how many appointments are shown before 'Altre disponibilità' is clicked
+FIRST_PAGE_SIZE = 3
+
+login_path = urlsplit(cup.login_page).path
+
+class MockCup:
+    """
+    The fake website, its slots and its HTTP server.
+
+    Parameters
+    ----------
+    port : int
+        Port to listen to on localhost, 0 picks a free one.
+    size : int
+        Number of slots in the appointment list.
+    latency : float
+        Seconds to wait before answering each request.
+    jitter : float
+        Maximum random seconds added to `latency`.
+    failure_rate : float
+        Probability, from 0 to 1, that a page is served broken.
+    churn : float
+        Probability, checked once per list request, that a slot is
+        replaced with a new one; new slots are often the earliest.
+    seed : int, optional
+        Seed for the random generator, for reproducible runs.
+    states : dict[str, str], optional
+        NREs mapped to 'scaduta', 'prenotata' or 'errata', answered with
+        the matching message instead of the list, see :py:mod:`health`.
+
+    Attributes
+    ----------
+    slots : dict[tuple, float]
+        Every slot currently available, as (date, time, place), mapped
+        to the time.time() at which it appeared.
+    requests : int
+        Number of requests served.
+    failures : int
+        Number of pages deliberately served broken.
+
+    Methods
+    -------
+    start()
+        Start serving from a daemon thread, returns the login page URL.
+    stop()
+        Shut the server down.
+    """
+    def __init__(self, port: int = 0, size: int = 20, latency: float = 0.0,
+                 jitter: float = 0.0, failure_rate: float = 0.0,
+                 churn: float = 0.0, seed: int | None = None,
+                 states: dict[str, str] | None = None):
+        self.size = size
+        self.states = states or {}
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.churn = churn
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.slots = {}
+        while len(self.slots) < size:
+            self.slots[self._new_slot(10, 365)] = time()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port),
+                                          self._handler_class())
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_port}{login_path}'
+
+    def start(self) -> str:
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _new_slot(self, min_days: int, max_days: int) -> tuple[str, str, str]:
+        """Returns a random (date, time, place) slot in the given range"""
+        d = date.today() + timedelta(self.random.randint(min_days, max_days))
+        date_str = ' '.join([WEEKDAYS[d.weekday()], str(d.day),
+                             HTNOM[d.month], str(d.year)])
+        time_str = f'{self.random.randint(8, 18):02}:' + \
+                   f'{self.random.choice((0, 15, 30, 45)):02}'
+        return date_str, time_str, self.random.choice(PLACES)
+
+    def _churn(self) -> None:
+        """Replace a random slot, the new one is sooner half of the time."""
+        if self.random.random() >= self.churn:
+            return
+        with self.lock:
+            old = self.random.choice(list(self.slots))
+            del self.slots[old]
+            if self.random.random() < 0.5:
+                new = self._new_slot(1, 9)
+            else:
+                new = self._new_slot(10, 365)
+            self.slots.setdefault(new, time())
+
+    def sorted_slots(self) -> list[tuple[str, str, str]]:
+        """Returns the slots earliest first, as the website lists them"""
+        def key(slot):
+            tokens = slot[0].split()
+            return (int(tokens[3]), MONTH[tokens[2]], int(tokens[1]), slot[1])
+        with self.lock:
+            return sorted(self.slots, key=key)
+
+    def _handler_class(self) -> type:
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, body: str, status: int = 200,
+                      content_type: str = 'text/html; charset=utf-8',
+                      headers: dict | None = None):
+                data = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _delay_or_fail(self) -> bool:
+                """Apply latency, returns True if the page must break"""
+                with mock.lock:
+                    mock.requests += 1
+                sleep(mock.latency + mock.random.random() * mock.jitter)
+                if mock.random.random() < mock.failure_rate:
+                    with mock.lock:
+                        mock.failures += 1
+                    self._send(page('Servizio non disponibile', ''), 503)
+                    return True
+                return False
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path == '/_mock/stato':
+                    self._send(json.dumps(mock.state()),
+                               content_type='application/json')
+                    return
+                if self._delay_or_fail():
+                    return
+                if url.path == login_path:
+                    cookies = self.headers.get('Cookie', '')
+                    self._send(login_html('COOKIE_CONSENT=' in cookies))
+                elif url.path == '/appuntamenti':
+                    mock._churn()
+                    everything = 'tutti' in parse_qs(url.query)
+                    self._send(list_html(mock.sorted_slots(), everything))
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                if self._delay_or_fail():
+                    return
+                if urlsplit(self.path).path == '/login':
+                    length = int(self.headers.get('Content-Length', 0))
+                    form = parse_qs(self.rfile.read(length).decode())
+                    if not form.get(cup.id_cf) or not form.get(cup.id_nre):
+                        self._send(page('Credenziali non valide', ''))
+                        return
+                    state = mock.states.get(form[cup.id_nre][0])
+                    if state in LOGIN_MESSAGES:
+                        self._send(page('Ricetta elettronica',
+                                        f'<p>{LOGIN_MESSAGES[state]}</p>'))
+                        return
+                    session = f'{mock.random.getrandbits(64):x}'
+                    self._send(proceed_html(), headers={
+                        'Set-Cookie': f'JSESSIONID={session}; Path=/'})
+                else:
+                    self.send_error(404)
+
+        return Handler
+
+    def state(self) -> dict:
+        """Returns the slots and counters, served on /_mock/stato"""
+        with self.lock:
+            return {
+                'slots': [{'date': d, 'time': t, 'place': p, 'appeared': a}
+                          for (d, t, p), a in self.slots.items()],
+                'requests': self.requests,
+                'failures': self.failures,
+            }
+
+def page(title: str, body: str) -> str:
+    return ('<!DOCTYPE html><html><head><meta charset="utf-8">'+
+            f'<title>{title}</title></head><body>{body}</body></html>')
+
+def login_html(consent: bool) -> str:
+    """Returns the login page, with the cookie bar unless already accepted"""
+    cookie_bar = ''
+    if not consent:
+        cookie_bar = '''
+<div id="cookieBar" style="position:fixed;bottom:0;width:100%">
+  <button class="js-cookieBarAccept" onclick="document.cookie=
+    'COOKIE_CONSENT=accepted; path=/';
+    document.getElementById('cookieBar').style.display='none'">Accetto</button>
+</div>'''
+    form = f'''
+<form method="post" action="/login">
+  <input type="text" id="{cup.id_cf}" name="{cup.id_cf}">
+  <input type="text" id="{cup.id_nre}" name="{cup.id_nre}">
+  <button type="submit" name="{cup.name_button_submit}">Cerca</button>
+</form>'''
+    return page('Ricetta elettronica', cookie_bar + form)
+
+def proceed_html() -> str:
+    return page('Prestazioni', f'''
+<form method="get" action="/appuntamenti">
+  <button type="submit" name="{cup.name_button_proceed}">Avanti</button>
+</form>''')
+
+def appointment_html(slot: tuple[str, str, str]) -> str:
+    date_str, time_str, place = slot
+    return f'''
+<div class="appuntamento">
+  <div class="captionAppointment-dateApp"><span>{date_str} </span><span>ore</span><span>{time_str}</span></div>
+  <div class="unita-address">{place}</div>
+</div>'''
+
+def list_html(slots: list[tuple[str, str, str]], everything: bool) -> str:
+    """Returns the list page, with the earliest slot repeated at the top"""
+    shown = slots if everything else slots[:FIRST_PAGE_SIZE]
+    blocks = ''.join(appointment_html(s) for s in slots[:1] + shown)
+    button = ''
+    if not everything:
+        button = ('<form method="get" action="/appuntamenti">'+
+                  '<input type="hidden" name="tutti" value="1">'+
+                  '<button type="submit">Altre disponibilità</button></form>')
+    return page('Appuntamenti', f'<div id="appuntamenti">{blocks}</div>'+button)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='mockcup',
+        description='Finto sito CUP per provare SaniDrive in locale')
+    parser.add_argument('--porta', type=int, default=8765)
+    parser.add_argument('--appuntamenti', type=int, default=20)
+    parser.add_argument('--latenza', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--guasti', type=float, default=0.0)
+    parser.add_argument('--churn', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    mock = MockCup(args.porta, args.appuntamenti, args.latenza, args.jitter,
+                   args.guasti, args.churn, args.seed)
+    print(f'Finto CUP in ascolto su {mock.url}')
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,397 @@
+"""
+Keeps the state of a monitoring session and decides, cycle after cycle,
+whether the freshly extracted appointments deserve a notification.
+
+The logic is kept apart from Selenium and from the terminal so that the
+same decisions can be taken by `run()`, by the benchmark harness and when
+replaying recorded pages.
+
+See Also
+--------
+:py:mod:`appointment`
+"""
+
+import heapq
+
+from appointment import Appointment
+from rules import RuleSet
+from geo import DistanceFilter
+
+class SlotIndex:
+    """
+    Class that keeps the appointments currently on the list ordered in
+    time, both overall and per facility, whatever the order of the page.
+
+    Each slot is pushed on a heap once, when it appears. Slots that
+    disappear are only dropped from `live` and their heap entries are
+    discarded when they reach the top, so every update costs O(log n) per
+    slot that appeared or disappeared. Heaps are rebuilt when stale entries
+    outnumber live ones.
+
+    Attributes
+    ----------
+    live : dict[tuple[str, str, str], tuple[int, Appointment]]
+        The slots on the list, mapped to their heap entry number and
+        appointment.
+    facilities : dict[str, list]
+        One heap per facility, i.e. per `unita-address`.
+
+    Methods
+    -------
+    sync(appointments)
+        Make the index hold exactly `appointments`.
+    add(appnt), discard(slot)
+        Add or remove a single slot.
+    earliest()
+        Returns the earliest slot.
+    top(k)
+        Returns the k earliest slots, earliest first.
+    earliest_by_facility()
+        Returns the earliest slot of every facility.
+    ordered()
+        Returns every slot, earliest first.
+    """
+    def __init__(self):
+        self.live = {}
+        self.heap = []
+        self.facilities = {}
+        self.entries = 0
+
+    def __len__(self) -> int:
+        return len(self.live)
+
+    def sync(self, appointments: list[Appointment]
+             ) -> tuple[list[Appointment], list[Appointment]]:
+        """
+        Parameters
+        ----------
+        appointments : list[Appointment]
+            The appointments of the current cycle, in any order and
+            possibly repeated.
+
+        Returns
+        -------
+        tuple[list[Appointment], list[Appointment]]
+
+        added : list[Appointment]
+            The slots that weren't on the previous list.
+        removed : list[Appointment]
+            The slots that are no longer on the list.
+        """
+        current = {a.slot: a for a in appointments}
+        removed = [self.discard(slot) for slot in list(self.live)
+                   if slot not in current]
+        added = [appnt for appnt in current.values() if self.add(appnt)]
+        return added, removed
+
+    def add(self, appnt: Appointment) -> bool:
+        """Returns False if the slot was already in the index"""
+        if appnt.slot in self.live:
+            return False
+        self.entries += 1
+        entry = (appnt.key, self.entries, appnt)
+        self.live[appnt.slot] = (self.entries, appnt)
+        heapq.heappush(self.heap, entry)
+        heapq.heappush(self.facilities.setdefault(appnt.place, []), entry)
+        return True
+
+    def discard(self, slot: tuple[str, str, str]) -> Appointment | None:
+        """Remove a slot, returns its appointment if it was there"""
+        found = self.live.pop(slot, None)
+        if len(self.heap) > 2 * len(self.live) + 64:
+            self._rebuild()
+        return None if found is None else found[1]
+
+    def _is_live(self, entry: tuple) -> bool:
+        found = self.live.get(entry[2].slot)
+        return found is not None and found[0] == entry[1]
+
+    def _prune(self, heap: list) -> None:
+        """Drop stale entries from the top of `heap`"""
+        while heap and not self._is_live(heap[0]):
+            heapq.heappop(heap)
+
+    def _rebuild(self) -> None:
+        self.heap = [(a.key, n, a) for n, a in self.live.values()]
+        heapq.heapify(self.heap)
+        self.facilities = {}
+        for entry in self.heap:
+            self.facilities.setdefault(entry[2].place, []).append(entry)
+        for heap in self.facilities.values():
+            heapq.heapify(heap)
+
+    def earliest(self) -> Appointment | None:
+        self._prune(self.heap)
+        return self.heap[0][2] if self.heap else None
+
+    def top(self, k: int) -> list[Appointment]:
+        """Pops the k earliest live entries and pushes them back,
+        O(k log n)"""
+        popped = []
+        while self.heap and len(popped) < k:
+            entry = heapq.heappop(self.heap)
+            if self._is_live(entry):
+                popped.append(entry)
+        for entry in popped:
+            heapq.heappush(self.heap, entry)
+        return [entry[2] for entry in popped]
+
+    def earliest_by_facility(self) -> dict[str, Appointment]:
+        """Returns the earliest slot of every facility, earliest first"""
+        for place in list(self.facilities):
+            self._prune(self.facilities[place])
+            if not self.facilities[place]:
+                del self.facilities[place]
+        ordered = sorted(heap[0] for heap in self.facilities.values())
+        return {entry[2].place: entry[2] for entry in ordered}
+
+    def ordered(self) -> list[Appointment]:
+        return [a for n, a in sorted(self.live.values(),
+                                     key=lambda v: (v[1].key, v[0]))]
+
+class Monitor:
+    """
+    Class that stores the state of the main loop across cycles.
+
+    Attributes
+    ----------
+    latest : Appointment
+        Appointments sooner than this one produce a notification.
+    earliest : Appointment
+        The earliest appointment found since monitoring started.
+    found_on_refresh : int
+        The refresh during which `earliest` was found.
+    refresh_counter : int
+        Number of completed cycles.
+    change_counter : int
+        Number of cycles whose list differed from the previous one, minus
+        one, since the first list is always different from the empty one.
+    appointments : list[Appointment]
+        The appointments found in the current cycle.
+    old_appointments : list[Appointment]
+        The appointments found in the previous cycle.
+    index : SlotIndex
+        The slots currently on the list, ordered in time.
+    rules : RuleSet | None
+        If given, only slots matching one of the rules are notified.
+    distance : DistanceFilter | None
+        If given, only slots close enough to home are notified.
+    matched : SlotIndex
+        The slots currently on the list that pass the rules and the
+        distance filter.
+    added, removed : list[Appointment]
+        The slots that appeared and disappeared in the current cycle.
+    qualifying : list[Appointment]
+        The slots that appeared in the current cycle, pass the filters and
+        are sooner than `latest`, earliest first. In the first cycle after
+        `postpone` or `set_rules`, the slots already on the list as well.
+
+    Methods
+    -------
+    update(appointments, quiet)
+        Compare a new batch with the state, returns what to notify.
+    set_rules(rules)
+        Replace the notification rules.
+    postpone(appointment)
+        Use `appointment` as the new notification threshold.
+    advance()
+        Close the current cycle.
+    state()
+        Returns what's needed to resume monitoring, see :py:mod:`checkpoint`.
+    from_state(state, rules, distance)
+        Class method that restores a Monitor from `state()`.
+    """
+    def __init__(self, latest: Appointment, rules: RuleSet | None = None,
+                 distance: DistanceFilter | None = None):
+        self.latest = latest
+        self.rules = rules
+        self.distance = distance
+        self.earliest = Appointment('','','','')
+        self.found_on_refresh = 0
+        self.refresh_counter = 0
+        self.change_counter = -1
+        self.appointments = []
+        self.old_appointments = []
+        self.index = SlotIndex()
+        self.matched = SlotIndex()
+        self.added = []
+        self.removed = []
+        self.qualifying = []
+        self._changed = False
+        self._recheck = False
+
+    def update(self, appointments: list[Appointment],
+               quiet: bool = False) -> Appointment | None:
+        """
+        Store the appointments of the current cycle, track the earliest one
+        ever found and tell whether a notification is due.
+
+        Parameters
+        ----------
+        appointments : list[Appointment]
+            The appointments as extracted from the page, in any order.
+        quiet : bool
+            True if the list is known to be the same as the last cycle's,
+            see `ListGate`, in which case it isn't compared again.
+
+        Returns
+        -------
+        Appointment
+            The appointment to notify the user about.
+        None
+            If nothing is sooner than the `latest` threshold.
+        """
+        self.appointments = appointments
+
+        # find out if something changed, a different order doesn't count
+        if quiet:
+            added, removed = [], []
+        else:
+            added, removed = self.index.sync(appointments)
+        self.added, self.removed = added, removed
+        self._changed = len(added) > 0 or len(removed) > 0
+        if self._changed:
+            self.change_counter += 1
+
+        # store earliest found appointment separately and compare the new
+        # batch's earliest with it and the latest for notifications
+        first = self.index.earliest()
+        if first is not None and first.is_sooner_than(self.earliest):
+            self.earliest = first
+            self.found_on_refresh = self.refresh_counter
+
+        filtered = self.rules is not None or self.distance is not None
+        if filtered:
+            self._filter(added, removed)
+            added = [a for a in added if a.slot in self.matched.live]
+            first = self.matched.earliest()
+        if self._recheck:
+            # slots already listed may pass the new threshold or rules
+            self._recheck = False
+            added = (self.matched if filtered else self.index).ordered()
+        self.qualifying = sorted((a for a in added
+                                  if a.is_sooner_than(self.latest)),
+                                 key=lambda a: a.key)
+
+        if first is not None and first.is_sooner_than(self.latest):
+            return first
+        return None
+
+    def _filter(self, added: list[Appointment],
+                removed: list[Appointment]) -> None:
+        """
+        Keep `matched` in step with the index. Only new slots are filtered,
+        all of them again when the day changes since the minimum notice of
+        the rules moved.
+        """
+        if self.rules is not None and self.rules.new_day():
+            self.matched = SlotIndex()
+            added = self.index.ordered()
+        if self.distance is not None:
+            self.distance.measure(added)
+        for appnt in removed:
+            self.matched.discard(appnt.slot)
+        for appnt in added:
+            if (self.distance is None or self.distance.allows(appnt)) and \
+               (self.rules is None or self.rules.matches(appnt) is not None):
+                self.matched.add(appnt)
+
+    def set_rules(self, rules: RuleSet | None) -> None:
+        """Replace the rules, filtering again the slots on the list"""
+        self.rules = rules
+        self.matched = SlotIndex()
+        if self.rules is not None or self.distance is not None:
+            self._filter(self.index.ordered(), [])
+        self._recheck = True
+
+    def postpone(self, appointment: Appointment) -> None:
+        """Notify only appointments sooner than `appointment` from now on."""
+        self.latest = appointment
+        self._recheck = True
+
+    def advance(self) -> None:
+        """Close the current cycle, keeping its list for the next compare."""
+        self.old_appointments = self.appointments
+        self.appointments = []
+        self.refresh_counter += 1
+
+    def state(self) -> dict:
+        """Returns the state as a JSON serialisable dict, appointments as
+        [place, date, time, notes] lists to keep it compact"""
+        pack = lambda a: [a.place, a.date, a.time, a.notes]
+        return {
+            'latest': pack(self.latest),
+            'earliest': pack(self.earliest),
+            'found_on_refresh': self.found_on_refresh,
+            'refresh_counter': self.refresh_counter,
+            'change_counter': self.change_counter,
+            'appointments': [pack(a) for a in self.old_appointments],
+        }
+
+    @classmethod
+    def from_state(cls, state: dict, rules: RuleSet | None = None,
+                   distance: DistanceFilter | None = None) -> 'Monitor':
+        """Restore a Monitor as it was after the cycle `state` was taken
+        at, so that the next list is compared with the last one seen"""
+        monitor = cls(Appointment(*state['latest']), rules, distance)
+        monitor.earliest = Appointment(*state['earliest'])
+        monitor.found_on_refresh = state['found_on_refresh']
+        monitor.refresh_counter = state['refresh_counter']
+        monitor.change_counter = state['change_counter']
+        monitor.old_appointments = [Appointment(*a)
+                                    for a in state['appointments']]
+        monitor.index.sync(monitor.old_appointments)
+        if rules is not None or distance is not None:
+            monitor._filter(monitor.index.ordered(), [])
+        return monitor
+
+    @property
+    def changed(self) -> bool:
+        """True if the slots of the current list differ from the previous
+        one's"""
+        return self._changed
+
+class ListGate:
+    """
+    Class that compares the digest of each cycle's list with the previous
+    one, so that unchanged lists are neither extracted nor rendered again,
+    and keeps track of what that saved.
+
+    Attributes
+    ----------
+    digest : str | None
+        The digest of the last list that was extracted.
+    quiet_cycles : int
+        Cycles in which the list was unchanged.
+    seconds_saved : float
+        Extraction time saved, estimated from the last real extraction.
+    round_trips_saved : int
+        ChromeDriver round trips saved, likewise.
+
+    Methods
+    -------
+    is_quiet(digest)
+        Returns True if `digest` matches the last list's.
+    extracted(seconds, round_trips)
+        Store the cost of a real extraction.
+    """
+    def __init__(self):
+        self.digest = None
+        self.quiet_cycles = 0
+        self.seconds_saved = 0.0
+        self.round_trips_saved = 0
+        self.last_seconds = 0.0
+        self.last_round_trips = 0
+
+    def is_quiet(self, digest: str | None) -> bool:
+        if digest is not None and digest == self.digest:
+            self.quiet_cycles += 1
+            self.seconds_saved += self.last_seconds
+            self.round_trips_saved += self.last_round_trips
+            return True
+        self.digest = digest
+        return False
+
+    def extracted(self, seconds: float, round_trips: int) -> None:
+        self.last_seconds = seconds
+        self.last_round_trips = round_trips
@@ -0,0 +1,155 @@
+"""
+Reads the appointment list from the network responses captured by Chrome
+instead of the rendered page.
+
+The list reaches the browser inside the response to the page load or to
+the JSF/AJAX request fired by 'Altre disponibilità'. Chrome's performance
+log tells which responses arrived, and the DevTools Protocol returns their
+body, which is parsed offline with `appointment.parse_appointments`: no
+waiting for rendering and no DOM query per appointment.
+
+See Also
+--------
+:py:mod:`driver`
+"""
+
+import json
+import xml.etree.ElementTree as ET
+from time import sleep, perf_counter
+
+from selenium.webdriver.chrome.webdriver import WebDriver
+
+from appointment import Appointment, parse_appointments
+
+# the marker that tells a response carries the appointment list
+list_marker = 'captionAppointment-dateApp'
+# seconds to wait for the log to show responses, when none is in flight
+GRACE = 1.0
+
+class NetworkCapture:
+    """
+    Class that follows the performance log of a driver across calls, since
+    reading the log also empties it.
+
+    The driver must be created with the 'performance' logging preference,
+    see `driver.init_driver`.
+
+    Attributes
+    ----------
+    mismatches : int
+        Cycles in which `parity` found a difference with the DOM.
+    misses : int
+        Cycles in which no response carrying the list was captured.
+
+    Methods
+    -------
+    extract(driver, timeout)
+        Returns the appointments of the latest response carrying them.
+    parity(network, dom)
+        Compare with the DOM extraction of the same cycle.
+    """
+    def __init__(self):
+        self.responses = {}
+        self.finished = set()
+        # JSF partial responses, i.e. to the request of 'Altre disponibilità'
+        self.partial = set()
+        self.mismatches = 0
+        self.misses = 0
+
+    def _read_log(self, driver: WebDriver) -> None:
+        for entry in driver.get_log('performance'):
+            message = json.loads(entry['message'])['message']
+            method = message.get('method')
+            params = message.get('params', {})
+            if method == 'Network.responseReceived':
+                response = params['response']
+                mime = response.get('mimeType', '')
+                if 'html' in mime or 'xml' in mime:
+                    self.responses[params['requestId']] = response['url']
+                if 'xml' in mime:
+                    self.partial.add(params['requestId'])
+            elif method == 'Network.loadingFinished':
+                self.finished.add(params['requestId'])
+            elif method == 'Network.loadingFailed':
+                # it will never finish, nor carry the list
+                self.responses.pop(params['requestId'], None)
+
+    def extract(self, driver: WebDriver,
+                timeout: float = 10) -> list[Appointment] | None:
+        """
+        Parameters
+        ----------
+        driver : WebDriver
+            The driver, right after the list was expanded.
+        timeout : float
+            Seconds to wait at most for the request of the expanded list
+            to finish loading.
+
+        Returns
+        -------
+        list[Appointment]
+            The appointments in the latest response carrying the list.
+        None
+            If no such response arrived, in which case it's given up on as
+            soon as the expanded list isn't loading anymore.
+        """
+        start = perf_counter()
+        while perf_counter() - start < timeout:
+            self._read_log(driver)
+            # latest responses first, the expanded list comes after the
+            # short one served with the page, so wait for it to finish;
+            # anything else still loading mustn't hold up the list
+            expanding = False
+            for request_id in reversed(list(self.responses)):
+                if request_id not in self.finished:
+                    if request_id in self.partial:
+                        expanding = True
+                        break
+                    continue
+                html = self._body(driver, request_id)
+                if html is not None and list_marker in html:
+                    self._clear()
+                    return parse_appointments(html)
+            if not expanding and perf_counter() - start >= GRACE:
+                break
+            sleep(0.2)
+        self.misses += 1
+        self._clear()
+        return None
+
+    def _clear(self) -> None:
+        self.responses.clear()
+        self.finished.clear()
+        self.partial.clear()
+
+    def _body(self, driver: WebDriver, request_id: str) -> str | None:
+        try:
+            result = driver.execute_cdp_cmd('Network.getResponseBody',
+                                            {'requestId': request_id})
+        except Exception:
+            # bodies of old navigations are evicted by Chrome
+            return None
+        return partial_response_html(result.get('body', ''))
+
+    def parity(self, network: list[Appointment] | None,
+               dom: list[Appointment]) -> bool:
+        """Returns True if both extractions agree, counting mismatches"""
+        if network == dom:
+            return True
+        self.mismatches += 1
+        return False
+
+def partial_response_html(body: str) -> str:
+    """
+    Returns the HTML carried by a JSF partial response, i.e. the content
+    of its <update> elements, or `body` itself if it's a regular page.
+    """
+    if not body.lstrip().startswith('<?xml') and \
+       not body.lstrip().startswith('<partial-response'):
+        return body
+    try:
+        root = ET.fromstring(body)
+    except ET.ParseError:
+        return body
+    return '\n'.join(update.text or '' for update in root.iter('update')
+                     if 'ViewState' not in update.get('id', ''))
@@ -0,0 +1,188 @@
+"""
+Collects the slots worth a notification into digests, so that a batch of
+new slots or a slot that keeps appearing and disappearing doesn't produce
+a notification and a sound every cycle.
+
+Qualifying slots are held for a short window and then delivered as a
+single digest, best slot first. A slot strictly sooner than any delivered
+before skips the window and is delivered at once. Every channel, i.e.
+the desktop notification and the sound or program of --exec, draws from
+its own token bucket, and slots that toggled too many times within the
+flap window are left out until they settle.
+
+See Also
+--------
+:py:mod:`monitor`, :py:mod:`ledger`
+"""
+
+from time import monotonic
+from collections import deque
+
+from appointment import Appointment
+
+CHANNELS = ('desktop', 'audio')
+
+class TokenBucket:
+    """
+    Class that allows `burst` events at once and `per_hour` events per hour
+    on average, timed by `clock`.
+    """
+    def __init__(self, per_hour: float, burst: int, clock=monotonic):
+        self.rate = per_hour / 3600
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.last = clock()
+
+    def take(self) -> bool:
+        """Returns True and uses a token if one is available"""
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class Notifier:
+    """
+    Class that turns the qualifying slots of each cycle into digests.
+
+    Parameters
+    ----------
+    window : float
+        Seconds slots are collected for before their digest is delivered,
+        0 to deliver every cycle.
+    per_hour : float
+        Average notifications per hour allowed on each channel.
+    burst : int
+        Notifications allowed at once on each channel.
+    flap_toggles : int
+        Appearances and disappearances within `flap_window` after which a
+        slot is considered flapping, 0 to never consider it so.
+    flap_window : float
+        Seconds the toggles of a slot are counted over.
+    clock : callable, optional
+        Returns the current time in seconds, `time.monotonic` by default.
+        Replays pass the time each cycle was recorded at.
+
+    Attributes
+    ----------
+    pending : dict[tuple[str, str, str], Appointment]
+        Slots waiting for the window to close.
+    best : Appointment | None
+        The best slot ever delivered.
+    urgent : bool
+        True if the last digest was led by a slot better than any before,
+        in which case no rate limit applies to it.
+    delivered : int
+        Digests delivered.
+    limited : dict[str, int]
+        Digests not delivered on each channel because of its rate limit.
+    flapping : set[tuple[str, str, str]]
+        Slots currently considered flapping.
+
+    Methods
+    -------
+    observe(added, removed)
+        Count the toggles of the slots of a cycle.
+    offer(slots)
+        Add the qualifying slots of a cycle, returns a digest if one is due.
+    allow(channel)
+        Returns True if `channel` can deliver a digest now.
+    defer(digest)
+        Hold back a digest no channel could deliver, for the next window.
+    """
+    def __init__(self, window: float = 60, per_hour: float = 12,
+                 burst: int = 3, flap_toggles: int = 4,
+                 flap_window: float = 3600, clock=monotonic):
+        self.clock = clock
+        self.window = window
+        self.flap_toggles = flap_toggles
+        self.flap_window = flap_window
+        self.buckets = {c: TokenBucket(per_hour, burst, clock)
+                        for c in CHANNELS}
+        self.limited = dict.fromkeys(CHANNELS, 0)
+        self.pending = {}
+        self.window_start = None
+        self.best = None
+        self.urgent = False
+        self.delivered = 0
+        self.toggles = {}
+        self.flapping = set()
+
+    def observe(self, added: list[Appointment],
+                removed: list[Appointment]) -> None:
+        now = self.clock()
+        for appnt in added + removed:
+            times = self.toggles.setdefault(appnt.slot, deque())
+            times.append(now)
+        # forget toggles older than the window, and slots that settled
+        for slot in list(self.toggles):
+            times = self.toggles[slot]
+            while times and now - times[0] > self.flap_window:
+                times.popleft()
+            if not times:
+                del self.toggles[slot]
+                self.flapping.discard(slot)
+            elif self.flap_toggles and len(times) >= self.flap_toggles:
+                self.flapping.add(slot)
+            else:
+                self.flapping.discard(slot)
+        # a flapping slot may have gone away while waiting
+        for appnt in removed:
+            self.pending.pop(appnt.slot, None)
+
+    def offer(self, slots: list[Appointment]) -> list[Appointment] | None:
+        """
+        Parameters
+        ----------
+        slots : list[Appointment]
+            The slots of the cycle that deserve a notification.
+
+        Returns
+        -------
+        list[Appointment]
+            The digest to deliver now, best slot first.
+        None
+            If nothing has to be delivered in this cycle.
+        """
+        now = self.clock()
+        urgent = False
+        for appnt in slots:
+            if appnt.slot in self.flapping:
+                continue
+            if not self.pending:
+                self.window_start = now
+            self.pending[appnt.slot] = appnt
+            if self.best is None or appnt.key < self.best.key:
+                urgent = True
+        if not self.pending:
+            return None
+        if not urgent and now - self.window_start < self.window:
+            return None
+
+        digest = sorted(self.pending.values(), key=lambda a: a.key)
+        self.pending = {}
+        self.urgent = self.best is None or digest[0].key < self.best.key
+        if self.urgent:
+            self.best = digest[0]
+        self.delivered += 1
+        return digest
+
+    def allow(self, channel: str) -> bool:
+        """Urgent digests are always allowed, but still use a token"""
+        if self.buckets[channel].take() or self.urgent:
+            return True
+        self.limited[channel] += 1
+        return False
+
+    def defer(self, digest: list[Appointment]) -> None:
+        """Put the slots of a rate limited digest back among the pending,
+        so they're delivered once a channel allows it instead of lost"""
+        if not self.pending:
+            self.window_start = self.clock()
+        for appnt in digest:
+            self.pending.setdefault(appnt.slot, appnt)
+        self.delivered -= 1
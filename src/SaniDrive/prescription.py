@@ -11,12 +11,41 @@ import config
 from util import divider, backline, cls
 
 import os
+import re
+import csv
 import sys
 import json
+import sqlite3
+from time import time
 
 class FileEmptyError(Exception):
     pass
 
+# Static lookup tables for Codice Fiscale validation
+CF_PATTERN = re.compile(r'[A-Z]{6}[0-9LMNPQRSTUV]{2}[ABCDEHLMPRST]'+
+                        r'[0-9LMNPQRSTUV]{2}[A-Z][0-9LMNPQRSTUV]{3}[A-Z]')
+# values of the characters in odd (1st, 3rd...) positions, digits and
+# letters share the same values
+_odd = (1, 0, 5, 7, 9, 13, 15, 17, 19, 21, 2, 4, 18, 20, 11, 3, 6, 8, 12, 14,
+        16, 10, 22, 25, 24, 23)
+CF_ODD = {c: _odd[i] for i, c in enumerate('0123456789')} | \
+         {c: _odd[i] for i, c in enumerate('ABCDEFGHIJKLMNOPQRSTUVWXYZ')}
+CF_EVEN = {c: i for i, c in enumerate('0123456789')} | \
+          {c: i for i, c in enumerate('ABCDEFGHIJKLMNOPQRSTUVWXYZ')}
+OMOCODE = str.maketrans('LMNPQRSTUV', '0123456789')
+NRE_PREFIX = '2000A'
+# readable reasons returned by the validation methods
+CREDENTIAL_ERRORS = {
+    'cf_length': "il Codice Fiscale deve avere 16 caratteri",
+    'cf_format': "il Codice Fiscale non e' nel formato corretto",
+    'cf_day': "il giorno di nascita nel Codice Fiscale non e' valido",
+    'cf_checksum': "l'ultimo carattere del Codice Fiscale non corrisponde "+
+                   "agli altri, probabilmente c'e' un errore di battitura",
+    'nre_length': "il NRE deve avere 15 caratteri, senza spazi",
+    'nre_prefix': f"il NRE deve iniziare con {NRE_PREFIX}",
+    'nre_digits': f"dopo {NRE_PREFIX}, il NRE deve contenere solo cifre",
+}
+
 class Prescription:
     """
     Class used to store information on saved prescriptions.
@@ -45,11 +74,220 @@ class Prescription:
     def get_creds(self) -> tuple[str, str]:
         """Returns relevant information for login as tuple."""
         return self.cf, self.nre
+
+    def is_valid(self) -> tuple[bool, str]:
+        """Validate both credentials offline, see `cf_is_valid`. Case and
+        surrounding spaces are ignored, since earlier versions saved them
+        as typed."""
+        valid, reason = Prescription.cf_is_valid(self.cf.strip().upper())
+        if not valid:
+            return valid, reason
+        return Prescription.nre_is_valid(self.nre.strip().upper())
+
+    @staticmethod
+    def cf_is_valid(cf: str) -> tuple[bool, str]:
+        """
+        Static method that checks whether a Codice Fiscale is well formed,
+        omocodia included, and whether its check character is correct.
+
+        Parameters
+        ----------
+        cf : str
+            The Codice Fiscale, in upper case.
+
+        Returns
+        -------
+        tuple[bool, str]
+
+        valid : bool
+            True if the Codice Fiscale is valid, False otherwise
+        info : str
+            If `valid` == False, the reason, one of 'cf_length',
+            'cf_format', 'cf_day', 'cf_checksum'. Empty otherwise.
+        """
+        if len(cf) != 16:
+            return False, 'cf_length'
+        if CF_PATTERN.fullmatch(cf) is None:
+            return False, 'cf_format'
+        # women have 40 added to their day of birth
+        day = int(cf[9:11].translate(OMOCODE))
+        if not (1 <= day <= 31 or 41 <= day <= 71):
+            return False, 'cf_day'
+        total = sum(CF_ODD[c] for c in cf[0:15:2]) + \
+                sum(CF_EVEN[c] for c in cf[1:15:2])
+        if chr(ord('A') + total % 26) != cf[15]:
+            return False, 'cf_checksum'
+        return True, ''
+
+    @staticmethod
+    def nre_is_valid(nre: str) -> tuple[bool, str]:
+        """
+        Static method that checks the structure of a Numero di Ricetta
+        Elettronica: the regional prefix followed by ten digits.
+
+        Returns
+        -------
+        tuple[bool, str]
+
+        valid : bool
+            True if the NRE is valid, False otherwise
+        info : str
+            If `valid` == False, the reason, one of 'nre_length',
+            'nre_prefix', 'nre_digits'. Empty otherwise.
+        """
+        if len(nre) != 15:
+            return False, 'nre_length'
+        if not nre.startswith(NRE_PREFIX):
+            return False, 'nre_prefix'
+        if not nre[5:].isdigit() or not nre[5:].isascii():
+            return False, 'nre_digits'
+        return True, ''
     
-def read_prescriptions(path: str) -> list[Prescription]:
+class PrescriptionStore:
     """
-    Open file and populate prescriptions. Used to handle sending
-    correct messages to user depending on condition of the specified file.
+    Class that stores prescriptions in a SQLite database, so that looking
+    one up, adding, updating or removing it doesn't require reading or
+    rewriting all the others. Every change is its own atomic transaction.
+
+    Parameters
+    ----------
+    path : str
+        The path of the database file, created if it doesn't exist.
+
+    Methods
+    -------
+    all()
+        Returns every prescription, in the order they were added.
+    get(cf, nre)
+        Returns the prescription with the given credentials, if any.
+    by_cf(cf), by_nre(nre)
+        Return the prescriptions with the given CF or NRE.
+    add(prescr), add_many(prescrs)
+        Add prescriptions, skipping those already stored.
+    update(prescr)
+        Change name and note of a stored prescription.
+    remove(cf, nre)
+        Delete a prescription.
+    export_json(path)
+        Write every prescription to a .json file in the old layout.
+    set_status(prescr, status), statuses(ttl)
+        Store and read the outcome of the checks made with --verifica.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS prescrizioni ('+
+                'id INTEGER PRIMARY KEY, cf TEXT NOT NULL, nre TEXT NOT NULL, '+
+                "nome TEXT NOT NULL DEFAULT '', nota TEXT NOT NULL DEFAULT '', "+
+                'UNIQUE (cf, nre))')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS prescrizioni_nre '+
+                'ON prescrizioni (nre)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS verifiche ('+
+                'cf TEXT NOT NULL, nre TEXT NOT NULL, esito TEXT NOT NULL, '+
+                't REAL NOT NULL, PRIMARY KEY (cf, nre))')
+
+    def __len__(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM prescrizioni'
+                                 ).fetchone()[0]
+
+    def __contains__(self, prescr: Prescription) -> bool:
+        return self.get(prescr.cf, prescr.nre) is not None
+
+    def _select(self, where: str = '', params: tuple = ()
+                ) -> list[Prescription]:
+        rows = self.conn.execute('SELECT cf, nre, nome, nota FROM '+
+            f'prescrizioni {where} ORDER BY id', params)
+        return [Prescription(*row) for row in rows]
+
+    def all(self) -> list[Prescription]:
+        return self._select()
+
+    def get(self, cf: str, nre: str) -> Prescription | None:
+        found = self._select('WHERE cf = ? AND nre = ?', (cf, nre))
+        return found[0] if found else None
+
+    def by_cf(self, cf: str) -> list[Prescription]:
+        return self._select('WHERE cf = ?', (cf,))
+
+    def by_nre(self, nre: str) -> list[Prescription]:
+        return self._select('WHERE nre = ?', (nre,))
+
+    def add(self, prescr: Prescription) -> bool:
+        """Returns False if the prescription was already stored"""
+        return self.add_many([prescr]) == 1
+
+    def add_many(self, prescrs) -> int:
+        """
+        Add every prescription of an iterable in a single transaction.
+
+        Returns
+        -------
+        int
+            How many were actually added, i.e. weren't stored already.
+        """
+        before = self.conn.total_changes
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO prescrizioni '+
+                '(cf, nre, nome, nota) VALUES (?, ?, ?, ?)',
+                ((p.cf, p.nre, p.name, p.note) for p in prescrs))
+        return self.conn.total_changes - before
+
+    def update(self, prescr: Prescription) -> bool:
+        with self.conn:
+            cursor = self.conn.execute('UPDATE prescrizioni SET nome = ?, '+
+                'nota = ? WHERE cf = ? AND nre = ?',
+                (prescr.name, prescr.note, prescr.cf, prescr.nre))
+        return cursor.rowcount == 1
+
+    def remove(self, cf: str, nre: str) -> bool:
+        with self.conn:
+            cursor = self.conn.execute('DELETE FROM prescrizioni WHERE '+
+                'cf = ? AND nre = ?', (cf, nre))
+            self.conn.execute('DELETE FROM verifiche WHERE cf = ? AND nre = ?',
+                              (cf, nre))
+        return cursor.rowcount == 1
+
+    def set_status(self, prescr: Prescription, status: str) -> None:
+        """Store the outcome of checking `prescr` on the website"""
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO verifiche '+
+                '(cf, nre, esito, t) VALUES (?, ?, ?, ?)',
+                (prescr.cf, prescr.nre, status, time()))
+
+    def statuses(self, ttl: float) -> dict[tuple[str, str], str]:
+        """
+        Returns the outcomes of the checks made less than `ttl` seconds
+        ago, keyed by (cf, nre).
+        """
+        rows = self.conn.execute('SELECT cf, nre, esito FROM verifiche '+
+                                 'WHERE t > ?', (time() - ttl,))
+        return {(cf, nre): status for cf, nre, status in rows}
+
+    def export_json(self, path: str) -> None:
+        write_prescriptions(self.all(), path)
+
+    def close(self) -> None:
+        self.conn.close()
+
+def store_path(path: str) -> str:
+    """Returns the database path to use for the file given with --file:
+    the same path with a .db extension for the old .json files"""
+    root, ext = os.path.splitext(path)
+    if ext.lower() == '.json':
+        return root + '.db'
+    return path
+
+def read_prescriptions(path: str) -> PrescriptionStore:
+    """
+    Open the prescription store. Used to handle sending correct messages
+    to user depending on condition of the specified file.
+
+    If `path` is a .json file in the layout used by earlier versions and
+    there's no database next to it yet, its prescriptions are migrated to
+    a new database with the same name and a .db extension. The .json file
+    is left untouched.
 
     Parameters
     ----------
@@ -58,22 +296,20 @@ def read_prescriptions(path: str) -> list[Prescription]:
 
     Returns
     -------
-    list[Prescription]
-        The read prescriptions as returned from pop_prescription() function.
+    PrescriptionStore
+        The opened store.
     """
     prescriptions : Prescription = []
     print("Lettura impegnative... ", end='')
+    db_path = store_path(path)
+    migrate = db_path != path and not os.path.exists(db_path)
 
     try:
-        prescriptions = pop_prescriptions(path)
-        print("fatto.")
+        if migrate:
+            prescriptions = pop_prescriptions(path)
     except FileNotFoundError:
-        print(f"il file specificato non esiste.\nInserisci un'impegnativa nuova "+
-              f"al passaggio successivo per crearlo e salvarla.")
         pass
     except FileEmptyError:
-        print(f"il file specificato e' vuoto.\nInserisci un'impegnativa nuova "+
-              f"al passaggio successivo per salvarla nel file.")
         pass
     except json.decoder.JSONDecodeError:
         print(f"non riuscita.\nIl file specificato non contiene json valido.\n"+
@@ -87,7 +323,25 @@ def read_prescriptions(path: str) -> list[Prescription]:
     except Exception:
         print("non riuscita.\nQualcosa e' andato storto.")
         sys.exit(1)
-    return prescriptions
+
+    try:
+        store = PrescriptionStore(db_path)
+    except sqlite3.DatabaseError:
+        print(f"non riuscita.\nIl file specificato non e' un database di "+
+              f"impegnative valido. Specificane un altro oppure rimuovi il "+
+              f"parametro --file per usare il percorso di default.")
+        sys.exit(1)
+
+    if len(prescriptions) > 0:
+        n = store.add_many(prescriptions)
+        print(f"fatto.\n{n} impegnative importate da "+
+              f"{os.path.basename(path)} in {os.path.basename(db_path)}.")
+    elif len(store) == 0:
+        print(f"nessuna impegnativa salvata.\nInserisci un'impegnativa "+
+              f"nuova al passaggio successivo per salvarla.")
+    else:
+        print("fatto.")
+    return store
 
 def pop_prescriptions(path: str) -> list[Prescription]:
     """
@@ -129,12 +383,14 @@ def pop_prescriptions(path: str) -> list[Prescription]:
         for nre, meta in dict.items():
             name = meta['nome']
             note = meta['nota']
-            new_pre = Prescription(cf, nre, name, note)
+            new_pre = Prescription(cf.strip().upper(), nre.strip().upper(),
+                                   name, note)
             prescriptions.append(new_pre)
 
     return prescriptions
 
-def choose_prescription(prescrs: list[Prescription], path: str) -> int:
+def choose_prescription(prescrs: list[Prescription],
+                        store: PrescriptionStore) -> int:
     """
     Prints all prescriptions, takes user input to choose which one to
     select and start querying the website for. If there are no saved
@@ -144,9 +400,10 @@ def choose_prescription(prescrs: list[Prescription], path: str) -> int:
     Parameters
     ----------
     prescrs : list[Prescription]
-        The list of prescriptions as returned by read_prescriptions()
-    path : str
-        The path to the .json file to save the newly added prescriptions to
+        The list of prescriptions in the store returned by
+        read_prescriptions(), newly added ones are appended to it
+    store : PrescriptionStore
+        The store to save the newly added prescriptions to
 
     Returns
     -------
@@ -180,13 +437,16 @@ def choose_prescription(prescrs: list[Prescription], path: str) -> int:
         # if selection was 0 or if list is empty, add a new prescription
         if c == 0:
             divider('=', line_width, '\n')
-            prescrs.append(add_prescription())
+            new_prescr = add_prescription()
             cls()
             print("Nuova impegnativa definita con successo.")
             print("Salvataggio impegnative... ", end='')
             sys.stdout.flush()
-            write_prescriptions(prescrs, path)
-            print("fatto."); sys.stdout.flush()
+            if store.add(new_prescr):
+                prescrs.append(new_prescr)
+                print("fatto."); sys.stdout.flush()
+            else:
+                print("impegnativa gia' presente."); sys.stdout.flush()
 
     # subtract 1 from `c` so we can use it as index later
     c -= 1
@@ -204,13 +464,25 @@ def add_prescription() -> Prescription:
     """
 
     print("AGGIUNGI NUOVA IMPEGNATIVA".center(config.line_width), '\n')
-    cf = input("Inserisci il Codice Fiscale:\t\t\t\t\t").strip()
+    cf = input("Inserisci il Codice Fiscale:\t\t\t\t\t").strip().upper()
+    valid, reason = Prescription.cf_is_valid(cf)
+    while not valid:
+        backline(1)
+        cf = input(f"Errore: {CREDENTIAL_ERRORS[reason]}. Riprova:\t"
+                   ).strip().upper()
+        valid, reason = Prescription.cf_is_valid(cf)
 
     print("\n\nN.B: Il NRE deve includere 2000A e non contenere spazi!",
           end='')
     print("\x1b[F", end='')
 
     nre = input("Inserisci il Numero di Ricetta Elettronica:\t\t\t").strip()
+    valid, reason = Prescription.nre_is_valid(nre.upper())
+    while not valid:
+        backline(1)
+        nre = input(f"Errore: {CREDENTIAL_ERRORS[reason]}. Riprova:\t").strip()
+        valid, reason = Prescription.nre_is_valid(nre.upper())
+    nre = nre.upper()
     print("\x1b[2K", end='')
 
     print("\n\nN.B: Se scegli di dare un nome alla prescrizione,\n     non "+
@@ -225,11 +497,91 @@ def add_prescription() -> Prescription:
     p = Prescription(cf, nre, name, note)
     return p
 
+def import_prescriptions(path: str, store: PrescriptionStore
+                         ) -> tuple[int, int, list[tuple[int, str]]]:
+    """
+    Import prescriptions in bulk from a CSV or JSON lines file, streaming
+    it row by row and validating the credentials offline, so that invalid
+    ones never cost a login on the website.
+
+    CSV files must have a header with the columns `cf`, `nre` and optionally
+    `nome` and `nota`, separated by commas or semicolons. Files ending in
+    .jsonl or .ndjson must hold one object per line with the same keys.
+    Bad rows are reported and skipped, they don't stop the import.
+
+    Parameters
+    ----------
+    path : str
+        The file to import.
+    store : PrescriptionStore
+        The store to add the valid prescriptions to.
+
+    Returns
+    -------
+    tuple[int, int, list[tuple[int, str]]]
+
+    added : int
+        How many prescriptions were added.
+    duplicates : int
+        How many valid rows were already stored or repeated in the file.
+    errors : list[tuple[int, str]]
+        Line number and readable reason of every rejected row.
+    """
+    errors = []
+    valid_rows = 0
+
+    def rows(f):
+        if path.lower().endswith(('.jsonl', '.ndjson')):
+            for n, line in enumerate(f, 1):
+                if line.strip() == '':
+                    continue
+                try:
+                    yield n, json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    errors.append((n, "riga JSON non valida"))
+        else:
+            dialect = csv.Sniffer().sniff(f.readline(), ',;')
+            f.seek(0)
+            reader = csv.DictReader(f, dialect=dialect)
+            for row in reader:
+                yield reader.line_num, row
+
+    def prescriptions(f):
+        nonlocal valid_rows
+        for n, row in rows(f):
+            if not isinstance(row, dict):
+                errors.append((n, "riga JSON non valida"))
+                continue
+            # JSON values may be numbers, lists or objects
+            fields = {k: row.get(k) for k in ('cf', 'nre', 'nome', 'nota')}
+            wrong = [k for k, v in fields.items()
+                     if v is not None and not isinstance(v, str)]
+            if wrong:
+                errors.append((n, f"il campo '{wrong[0]}' deve essere "+
+                                  "un testo"))
+                continue
+            fields = {k: (v or '').strip() for k, v in fields.items()}
+            prescr = Prescription(fields['cf'].upper(), fields['nre'].upper(),
+                                  fields['nome'], fields['nota'])
+            valid, reason = prescr.is_valid()
+            if not valid:
+                errors.append((n, CREDENTIAL_ERRORS[reason]))
+                continue
+            valid_rows += 1
+            yield prescr
+
+    with open(path, 'r', newline='', encoding='utf-8-sig') as f:
+        added = store.add_many(prescriptions(f))
+    return added, valid_rows - added, errors
+
 def write_prescriptions(prescr_list: list[Prescription], path: str) -> None:
     """
     Starting from a list of read prescriptions, generate the correct
     dictionary object to write to .json file
 
+    The file is written to a temporary file first and then renamed, so it's
+    never left half-written.
+
     Parameters
     ----------
     list : list[Prescription]
@@ -237,33 +589,16 @@ def write_prescriptions(prescr_list: list[Prescription], path: str) -> None:
     path : str
         The file to which to write json data
     """
+    # keys are CFs, values are dicts whose keys are that CF's NREs
     bigdict = {} # lmao
-
-    # start with a dict where keys are CFs and values are n. of NRE
-    # associated with each CF
-    cfs = {}
     for prescr in prescr_list:
-        if prescr.cf in cfs:
-            cfs[prescr.cf] = cfs[prescr.cf] + 1
-        else:
-            cfs[prescr.cf] = 1
-
-    # loop over each unique CF
-    idx = 0
-    keys = list(cfs)
-    for cf in keys:
-        nres = {}
-        # loop for each occurrence of that CF
-        for i in range(0, cfs[cf]):
-            data = {}
-            data['nome'] = prescr_list[idx + i].name
-            data['nota'] = prescr_list[idx + i].note
-            nres[prescr_list[i].nre] = data
-        idx = i + 1
-        bigdict[cf] = nres
+        nres = bigdict.setdefault(prescr.cf, {})
+        nres[prescr.nre] = {'nome': prescr.name, 'nota': prescr.note}
 
     # dump dictionary to file and we're done
-    with open(path, 'w') as f:
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
         json.dump(bigdict, f, indent=4)
+    os.replace(tmp_path, path)
 
-    return
\ No newline at end of file
+    return
@@ -0,0 +1,180 @@
+"""
+Profiles every cycle of a watch with a sampling profiler and keeps the
+slowest ones, to tell whether a slow cycle was spent in Python, waiting on
+ChromeDriver or waiting on the website.
+
+A daemon thread looks at the stack of the polling thread a hundred times a
+second through `sys._current_frames`, so the polling thread itself runs
+untouched, and counts the stacks of the current cycle. Every stack starts
+with the stage it was taken in, e.g. `[page_get]`, and time spent waiting
+on ChromeDriver shows as socket reads under Selenium. At the end of a
+cycle, if it's among the K slowest so far, its stacks are written in the
+collapsed format read by flamegraph.pl and speedscope, next to a JSON file
+with its duration and stage timings; the files of the cycle it pushed out
+are deleted. Profiles left in the directory by earlier runs count among
+the K.
+
+Without --profile nothing is started, and `run()` only checks for None.
+
+See Also
+--------
+:py:mod:`metrics`
+"""
+
+import os
+import sys
+import glob
+import json
+import heapq
+import threading
+from time import time, sleep, perf_counter
+from collections import Counter
+
+import metrics
+
+class CycleProfiler:
+    """
+    Class that samples the polling thread during cycles and keeps the
+    profiles of the slowest.
+
+    Parameters
+    ----------
+    directory : str
+        Where the profiles are written, created if it doesn't exist.
+    keep : int
+        Number of slowest cycles kept.
+    interval : float
+        Seconds between two samples.
+
+    Attributes
+    ----------
+    kept : list[tuple[float, int, str]]
+        Heap of the (seconds, cycle, path without extension) of the cycles
+        kept, earlier runs included, fastest first.
+    samples : int
+        Samples taken in the current cycle.
+
+    Methods
+    -------
+    begin(cycle)
+        Start sampling cycle `cycle`.
+    end(stages)
+        Stop sampling, keep the profile if the cycle was among the slowest.
+    """
+    def __init__(self, directory: str, keep: int = 5,
+                 interval: float = 0.01):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.keep = keep
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.kept = []
+        self.counts = Counter()
+        self.samples = 0
+        self.cycle = None
+        self.start = None
+        self.labels = {}
+        # held while a sample is taken, so `end` never reads a half update
+        self.lock = threading.Lock()
+        self.active = threading.Event()
+        self._load()
+        threading.Thread(target=self._sample, daemon=True).start()
+
+    def _load(self) -> None:
+        """Count the profiles of earlier runs, dropping the excess"""
+        for info in glob.glob(os.path.join(glob.escape(self.directory),
+                                           'ciclo-*.json')):
+            try:
+                with open(info, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                entry = (float(data['secondi']), int(data['ciclo']),
+                         info[:-len('.json')])
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+            heapq.heappush(self.kept, entry)
+        while len(self.kept) > self.keep:
+            self._drop()
+
+    def _drop(self) -> None:
+        """Delete the fastest profile kept"""
+        _, _, path = heapq.heappop(self.kept)
+        for ext in ('.folded', '.json'):
+            try:
+                os.remove(path + ext)
+            except OSError:
+                pass
+
+    def _label(self, code) -> str:
+        label = self.labels.get(code)
+        if label is None:
+            label = f'{os.path.basename(code.co_filename)}:{code.co_name}'
+            self.labels[code] = label
+        return label
+
+    def _sample(self) -> None:
+        """Body of the sampling thread"""
+        while True:
+            self.active.wait()
+            with self.lock:
+                # the cycle may have ended while waiting for the lock
+                if not self.active.is_set():
+                    continue
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is not None:
+                    stack = []
+                    while frame is not None:
+                        stack.append(self._label(frame.f_code))
+                        frame = frame.f_back
+                    registry = metrics.registry
+                    stage = registry.current if registry is not None else None
+                    stack.append(f'[{stage or "altro"}]')
+                    self.counts[';'.join(reversed(stack))] += 1
+                    self.samples += 1
+                del frame
+            sleep(self.interval)
+
+    def begin(self, cycle: int) -> None:
+        with self.lock:
+            self.counts = Counter()
+            self.samples = 0
+        self.cycle = cycle
+        self.start = perf_counter()
+        self.active.set()
+
+    def end(self, stages: dict[str, float]) -> str | None:
+        """Returns the path of the profile if it was kept"""
+        if self.cycle is None:
+            return None
+        # waits for a sample being taken, none is taken after
+        with self.lock:
+            self.active.clear()
+            counts, samples = self.counts, self.samples
+        seconds = perf_counter() - self.start
+        cycle, self.cycle = self.cycle, None
+        if len(self.kept) >= self.keep:
+            # nothing is kept at all with keep = 0
+            if not self.kept or seconds <= self.kept[0][0]:
+                return None
+            self._drop()
+
+        path = self._path(cycle)
+        heapq.heappush(self.kept, (seconds, cycle, path))
+        with open(path + '.folded', 'w', encoding='utf-8') as f:
+            for stack, n in counts.most_common():
+                f.write(f'{stack} {n}\n')
+        with open(path + '.json', 'w', encoding='utf-8') as f:
+            json.dump({'ciclo': cycle, 't': time(), 'secondi': seconds,
+                       'campioni': samples,
+                       'intervallo_campioni': self.interval,
+                       'tempi': stages}, f, indent=1)
+        return path
+
+    def _path(self, cycle: int) -> str:
+        """Returns a path not used by the profiles kept, since the cycles
+        of an earlier run may have the same numbers"""
+        base = os.path.join(self.directory, f'ciclo-{cycle:06d}')
+        path, n = base, 1
+        while os.path.exists(path + '.json'):
+            path = f'{base}-{n}'
+            n += 1
+        return path
@@ -0,0 +1,252 @@
+"""
+Reads notification rules from a TOML file and compiles them, once at
+startup, into predicates over appointments.
+
+A slot sooner than the date given with --data produces a notification
+only if it also matches at least one of the rules that apply to the
+tracked prescription. With no rules, every such slot does, as before.
+
+Example of a rules file::
+
+    [[regola]]
+    nome = "Cagliari, mattina"
+    strutture = ["Cagliari", "Quartu"]
+    giorni = ["lunedi", "mercoledi", "venerdi"]
+    dalle = "08:00"
+    alle = 12:30:00               # or as a TOML time
+    preavviso = 2                 # giorni
+    escludi_comuni = ["Olbia"]
+    dopo_il = 2025-11-01
+    prima_del = 2026-03-31
+    impegnative = ["2000A1234567890"]
+
+Every key is optional. Within a rule all conditions must hold, while a
+slot needs to match a single rule. Rules without `impegnative` apply to
+every prescription, which can be listed by NRE or by codice fiscale.
+
+See Also
+--------
+:py:mod:`monitor`
+"""
+
+import re
+import tomllib
+from datetime import date, time, timedelta
+
+from appointment import Appointment
+
+# weekdays as written in rules, with and without accents
+WEEKDAY = {
+    'lunedi': 0, 'lunedì': 0, 'martedi': 1, 'martedì': 1, 'mercoledi': 2,
+    'mercoledì': 2, 'giovedi': 3, 'giovedì': 3, 'venerdi': 4, 'venerdì': 4,
+    'sabato': 5, 'domenica': 6,
+}
+KEYS = {'nome', 'strutture', 'comuni', 'escludi_comuni', 'giorni', 'dalle',
+        'alle', 'preavviso', 'dopo_il', 'prima_del', 'impegnative'}
+# the town in an address such as 'Via Roma 12, 09124 Cagliari (CA)'
+TOWN_PATTERN = re.compile(r'\b\d{5}\s+(.+?)\s*(?:\([A-Z]{2}\))?\s*$')
+
+class RuleError(ValueError):
+    """Raised with a readable message when a rules file is invalid."""
+    pass
+
+def town_of(place: str) -> str:
+    """Returns the lowercase town of an address, or the whole address
+    if it isn't in the usual 'street, postcode town (province)' form"""
+    found = TOWN_PATTERN.search(place)
+    return (found.group(1) if found else place).strip().lower()
+
+def day_key(day: date) -> int:
+    """Returns the lowest `Appointment.key` of a day"""
+    return (day.year * 10000 + day.month * 100 + day.day) * 10000
+
+class Rule:
+    """
+    Class that holds a compiled rule: integer bounds on `Appointment.key`,
+    checked first, and a tuple of predicates over the other fields.
+
+    Attributes
+    ----------
+    name : str
+        Readable name, shown in notifications.
+    low, high : int
+        Keys of the first and the last allowed minute, from the fixed dates.
+    notice : int
+        Minimum days between today and the appointment.
+    checks : tuple[Callable[[Appointment], bool], ...]
+        The remaining conditions, cheapest first.
+    prescriptions : set[str]
+        NREs and codici fiscali the rule applies to, empty for all.
+    """
+    def __init__(self, name: str, low: int, high: int, notice: int,
+                 checks: tuple, prescriptions: set[str]):
+        self.name = name
+        self.low = low
+        self.high = high
+        self.notice = notice
+        self.checks = checks
+        self.prescriptions = prescriptions
+
+    def applies_to(self, cf: str, nre: str) -> bool:
+        return not self.prescriptions or cf in self.prescriptions or \
+               nre in self.prescriptions
+
+    def matches(self, appnt: Appointment, low: int) -> bool:
+        """`low` is the lowest key allowed today, notice included"""
+        if not low <= appnt.key <= self.high:
+            return False
+        for check in self.checks:
+            if not check(appnt):
+                return False
+        return True
+
+class RuleSet:
+    """
+    Class that selects the rules of a prescription and matches slots
+    against them, updating the minimum notice once a day.
+
+    Methods
+    -------
+    matches(appnt)
+        Returns the first rule matched by `appnt`, or None.
+    """
+    def __init__(self, rules: list[Rule], cf: str, nre: str):
+        self.rules = [r for r in rules if r.applies_to(cf, nre)]
+        self.today = None
+        self.lows = []
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def new_day(self) -> bool:
+        """Recompute the notice bounds if the date changed, returns True
+        if it did, meaning that earlier matches must be checked again"""
+        today = date.today()
+        if today == self.today:
+            return False
+        self.today = today
+        self.lows = [max(r.low, day_key(today + timedelta(r.notice)))
+                     for r in self.rules]
+        return True
+
+    def matches(self, appnt: Appointment) -> Rule | None:
+        self.new_day()
+        for rule, low in zip(self.rules, self.lows):
+            if rule.matches(appnt, low):
+                return rule
+        return None
+
+def _minutes(value, key: str, n: int) -> int:
+    """Converts 'HH:MM', or a TOML time written without quotes, into the
+    hhmm integer used by `Appointment.key`"""
+    if isinstance(value, time):
+        return value.hour * 100 + value.minute
+    try:
+        hours, minutes = str(value).split(':')
+        hours, minutes = int(hours), int(minutes)
+    except ValueError:
+        raise RuleError(f"regola {n}: '{key}' deve avere il formato HH:MM")
+    if not (0 <= hours <= 23 and 0 <= minutes <= 59):
+        raise RuleError(f"regola {n}: '{key}' non e' un orario valido")
+    return hours * 100 + minutes
+
+def _strings(table: dict, key: str, n: int) -> list[str]:
+    value = table.get(key, [])
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list) or \
+       not all(isinstance(v, str) for v in value):
+        raise RuleError(f"regola {n}: '{key}' deve essere una lista di testi")
+    return [v.strip().lower() for v in value if v.strip() != '']
+
+def compile_rule(table: dict, n: int) -> Rule:
+    """
+    Compile the table of a single rule.
+
+    Parameters
+    ----------
+    table : dict
+        The rule as read from the file.
+    n : int
+        Position of the rule in the file, used in error messages.
+
+    Raises
+    ------
+    RuleError
+        If a key is unknown or a value is invalid.
+    """
+    unknown = set(table) - KEYS
+    if unknown:
+        raise RuleError(f"regola {n}: chiavi sconosciute: "+
+                        ', '.join(sorted(unknown)))
+    name = str(table.get('nome', f'regola {n}'))
+
+    # fixed dates become bounds on the integer key, checked first
+    low, high = 0, Appointment.sort_key('', '') - 1
+    for key in ('dopo_il', 'prima_del'):
+        if key in table and not isinstance(table[key], date):
+            raise RuleError(f"regola {n}: '{key}' deve essere una data "+
+                            "nel formato AAAA-MM-GG, senza virgolette")
+    if 'dopo_il' in table:
+        low = day_key(table['dopo_il'])
+    if 'prima_del' in table:
+        high = day_key(table['prima_del']) + 2359
+    notice = table.get('preavviso', 0)
+    if not isinstance(notice, int) or notice < 0:
+        raise RuleError(f"regola {n}: 'preavviso' deve essere un numero "+
+                        "intero di giorni")
+
+    # then the time window, cheap since it's part of the key
+    checks = []
+    if 'dalle' in table or 'alle' in table:
+        start = _minutes(table.get('dalle', '00:00'), 'dalle', n)
+        end = _minutes(table.get('alle', '23:59'), 'alle', n)
+        checks.append(lambda a: start <= a.key % 10000 <= end)
+
+    # then the weekday, from the key rather than the text of the page
+    days = _strings(table, 'giorni', n)
+    if days:
+        if any(d not in WEEKDAY for d in days):
+            raise RuleError(f"regola {n}: 'giorni' contiene un giorno "+
+                            "della settimana sconosciuto")
+        weekdays = {WEEKDAY[d] for d in days}
+        def weekday(a: Appointment) -> bool:
+            k = a.key // 10000
+            return date(k // 10000, k // 100 % 100, k % 100).weekday() \
+                   in weekdays
+        checks.append(weekday)
+
+    # string searches last
+    facilities = _strings(table, 'strutture', n)
+    if facilities:
+        checks.append(lambda a: any(f in a.place.lower() for f in facilities))
+    towns = set(_strings(table, 'comuni', n))
+    if towns:
+        checks.append(lambda a: town_of(a.place) in towns)
+    excluded = set(_strings(table, 'escludi_comuni', n))
+    if excluded:
+        checks.append(lambda a: town_of(a.place) not in excluded)
+
+    prescriptions = {p.upper() for p in _strings(table, 'impegnative', n)}
+    return Rule(name, low, high, notice, tuple(checks), prescriptions)
+
+def read_rules(path: str) -> list[Rule]:
+    """
+    Read and compile the rules of a TOML file.
+
+    Raises
+    ------
+    RuleError
+        If the file can't be read or a rule is invalid.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = tomllib.load(f)
+    except OSError:
+        raise RuleError("il file delle regole non esiste o non e' leggibile")
+    except tomllib.TOMLDecodeError as e:
+        raise RuleError(f"il file delle regole non e' un file TOML valido: {e}")
+    tables = data.get('regola', [])
+    if not isinstance(tables, list):
+        raise RuleError("le regole devono essere definite con [[regola]]")
+    return [compile_rule(table, n) for n, table in enumerate(tables, 1)]
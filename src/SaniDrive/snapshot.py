@@ -0,0 +1,280 @@
+"""
+Records the appointment list of every cycle and replays recordings offline
+through the same extraction, comparison and notification path used by
+`run()`.
+
+Snapshots are stored once per distinct content, named after their SHA-256
+hash and gzip-compressed, while an index file keeps one JSON line per
+cycle pointing at them. Since most cycles return the same list, a week of
+30-second polling costs little more than its index.
+
+Replay a recording with `py snapshot.py CARTELLA [--data GG MM AAAA]`.
+
+See Also
+--------
+:py:mod:`monitor`
+"""
+
+import os
+import sys
+import gzip
+import json
+import argparse
+import hashlib
+from time import time, perf_counter
+
+from appointment import Appointment, parse_appointments
+from monitor import Monitor
+from ledger import NotificationLedger
+from notifier import Notifier
+from rules import RuleSet, RuleError, read_rules
+
+class SnapshotRecorder:
+    """
+    Class that writes snapshots into a recording directory.
+
+    The directory contains `index.jsonl` and an `oggetti` folder with one
+    `<hash>.html.gz` file per distinct snapshot.
+
+    Attributes
+    ----------
+    path : str
+        The recording directory.
+    cycle : int
+        Number of snapshots recorded so far in this session.
+    stored : int
+        Number of snapshots actually written, i.e. not deduplicated.
+
+    Methods
+    -------
+    record(html, kind)
+        Store `html` unless identical content was already stored, and
+        append an entry to the index.
+    repeat()
+        Append an entry pointing at the last list, known to be unchanged.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.objects = os.path.join(path, 'oggetti')
+        os.makedirs(self.objects, exist_ok=True)
+        self.index_path = os.path.join(path, 'index.jsonl')
+        self.cycle = 0
+        self.stored = 0
+        self.last = None
+
+    def record(self, html: str, kind: str = 'lista') -> str:
+        """
+        Parameters
+        ----------
+        html : str
+            The snapshot to store.
+        kind : str
+            'lista' for the appointment list of a cycle, 'errore' for the
+            full page saved when a cycle fails.
+
+        Returns
+        -------
+        str
+            The content hash of the snapshot.
+        """
+        data = html.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        object_path = os.path.join(self.objects, digest + '.html.gz')
+        if not os.path.exists(object_path):
+            tmp_path = object_path + '.tmp'
+            with gzip.open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, object_path)
+            self.stored += 1
+        if kind == 'lista':
+            self.last = digest
+        self._index(digest, kind)
+        return digest
+
+    def repeat(self) -> None:
+        """Record that this cycle's list is the same as the last one."""
+        if self.last is not None:
+            self._index(self.last, 'lista')
+
+    def _index(self, digest: str, kind: str) -> None:
+        entry = {'t': time(), 'ciclo': self.cycle, 'hash': digest,
+                 'tipo': kind}
+        with open(self.index_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        self.cycle += 1
+
+def read_recording(path: str, kind: str = 'lista'):
+    """
+    Generator that yields the index entries of a recording together with
+    their snapshot, decompressing each distinct snapshot only once.
+
+    Yields
+    ------
+    tuple[dict, str]
+        The index entry and the HTML it points at.
+    """
+    cache = {}
+    with open(os.path.join(path, 'index.jsonl'), 'r') as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry['tipo'] != kind:
+                continue
+            digest = entry['hash']
+            if digest not in cache:
+                object_path = os.path.join(path, 'oggetti',
+                                           digest + '.html.gz')
+                with gzip.open(object_path, 'rb') as g:
+                    cache[digest] = g.read().decode('utf-8')
+            yield entry, cache[digest]
+
+def replay(path: str, latest: Appointment, nonstop: bool = True,
+           rules: RuleSet | None = None, window: float = 60,
+           per_hour: float = 12, burst: int = 3, flap_toggles: int = 4,
+           ledger_ttl: float = 24 * 3600, audio: bool = True,
+           nre: str = '') -> list[dict]:
+    """
+    Feed a recording through extraction, comparison and the notifier, as
+    fast as the CPU allows, and return the decisions taken on each cycle.
+
+    The digests are the ones `run()` would have dispatched: the window,
+    the rate limits and the ledger follow the time each cycle was recorded
+    at, and the ledger starts empty.
+
+    Parameters
+    ----------
+    path : str
+        The recording directory.
+    latest : Appointment
+        The notification threshold, as given with --data.
+    nonstop : bool
+        If False, the earliest slot notified becomes the new threshold, as
+        happens when the user presses Enter to keep searching.
+    rules : RuleSet, optional
+        The notification rules, as given with --regole.
+    window, per_hour, burst, flap_toggles
+        The options of the `Notifier`, as given with --notifiche-finestra,
+        --notifiche-ora, --notifiche-raffica and --instabile.
+    ledger_ttl : float
+        Seconds after which a slot can be notified again.
+    audio : bool
+        Whether the sound or the program of --exec is available, as the
+        second channel.
+    nre : str
+        The prescription the slots are claimed for in the ledger.
+
+    Returns
+    -------
+    list[dict]
+        One entry per recorded cycle, with the cycle number, the time it
+        was recorded, whether the list changed, the digest dispatched and
+        on which channels.
+    """
+    now = 0.0
+    clock = lambda: now
+    notifier = Notifier(window, per_hour, burst, flap_toggles, clock=clock)
+    ledger = NotificationLedger(':memory:', ledger_ttl, clock=clock)
+    monitor = Monitor(latest, rules)
+    parsed = {}
+    decisions = []
+    last = None
+    for entry, html in read_recording(path):
+        now = entry['t']
+        # identical snapshots parse to the same list, no need to do it twice
+        if entry['hash'] not in parsed:
+            parsed[entry['hash']] = parse_appointments(html)
+        # and one equal to the previous isn't compared, as in a quiet cycle
+        notify = monitor.update(parsed[entry['hash']], entry['hash'] == last)
+        last = entry['hash']
+
+        # as in run(), slots are claimed only once a channel takes them
+        notifier.observe(monitor.added, monitor.removed)
+        digest = notifier.offer(monitor.qualifying)
+        channels = []
+        if digest is not None:
+            channels = [c for c, on in (('desktop', True), ('audio', audio))
+                        if on and notifier.allow(c)]
+            if not channels:
+                notifier.defer(digest)
+                digest = None
+            else:
+                digest = [a for a in digest if ledger.claim(nre, a)]
+        decisions.append({
+            'ciclo': entry['ciclo'],
+            't': entry['t'],
+            'cambiato': monitor.changed,
+            'notifica': [{'data': a.date, 'ora': a.time, 'luogo': a.place}
+                         for a in digest] if digest else None,
+            'canali': channels if digest else [],
+        })
+        if notify is not None and not nonstop:
+            monitor.postpone(notify)
+        monitor.advance()
+    ledger.close()
+    return decisions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='snapshot',
+        description='Riproduce una registrazione fatta con --registra')
+    parser.add_argument('path', metavar='CARTELLA')
+    parser.add_argument('--data', '-d', dest='latestDate', nargs='*',
+                        default=[], metavar='DATA')
+    parser.add_argument('--nonstop', '-n', action='store_true')
+    parser.add_argument('--regole', metavar='FILE', default=None)
+    parser.add_argument('--impegnativa', metavar='NRE', default='',
+                        help='Applica solo le regole di questa impegnativa')
+    parser.add_argument('--notifiche-validita', dest='ledgerTtl',
+                        type=float, default=24, metavar='ORE')
+    parser.add_argument('--notifiche-finestra', dest='digestWindow',
+                        type=float, default=60, metavar='SECONDI')
+    parser.add_argument('--notifiche-ora', dest='notifPerHour', type=float,
+                        default=12, metavar='N')
+    parser.add_argument('--notifiche-raffica', dest='notifBurst', type=int,
+                        default=3, metavar='N')
+    parser.add_argument('--instabile', dest='flapToggles', type=int,
+                        default=4, metavar='N')
+    parser.add_argument('--muto', action='store_true',
+                        help='Come senza suono ne\' programma di --exec')
+    parser.add_argument('--json', action='store_true',
+                        help='Scrivi le decisioni in formato JSON lines')
+    args = parser.parse_args()
+
+    latest = Appointment.latest(args.latestDate)
+    if latest is None:
+        print("La data specificata non e' valida.")
+        sys.exit(1)
+
+    rules = None
+    if args.regole is not None:
+        try:
+            rules = RuleSet(read_rules(args.regole), '',
+                            args.impegnativa.upper())
+        except RuleError as e:
+            print(f"Errore: {e}.")
+            sys.exit(1)
+
+    start = perf_counter()
+    decisions = replay(args.path, latest, args.nonstop, rules,
+                       args.digestWindow, args.notifPerHour, args.notifBurst,
+                       args.flapToggles, args.ledgerTtl * 3600,
+                       not args.muto, args.impegnativa.upper())
+    elapsed = perf_counter() - start
+
+    changes = notifications = 0
+    for d in decisions:
+        changes += d['cambiato']
+        notifications += d['notifica'] is not None
+        if args.json:
+            print(json.dumps(d))
+        elif d['cambiato'] or d['notifica'] is not None:
+            line = f"ciclo {d['ciclo']}: "
+            line += 'lista cambiata' if d['cambiato'] else 'lista invariata'
+            if d['notifica'] is not None:
+                first = d['notifica'][0]
+                line += f", notifica ({', '.join(d['canali'])}): "+ \
+                        ' '.join(first.values())
+                if len(d['notifica']) > 1:
+                    line += f" e altri {len(d['notifica']) - 1}"
+            print(line)
+    print(f'\n{len(decisions)} cicli riprodotti in {elapsed:.2f} secondi, '+
+          f'{changes} cambiamenti, {notifications} notifiche.',
+          file=sys.stderr if args.json else sys.stdout)
@@ -8,6 +8,8 @@ import os
 import sys
 import json
 import config
+import metrics
+import eventlog
 import zipfile
 import requests
 import argparse
@@ -44,7 +46,9 @@ def parse_arguments() -> Namespace:
     parser.add_argument('--file', '-f', dest='credFile', default='', metavar='FILE',
         help=f'Specifica il percorso del file con le credenziali. E\' bene usare un percorso assoluto '+
         'per garantire l\'uso del file corretto. Il percorso di default e\' "../../data/credenziali.json", '+
-        'relativamente alla directory da cui e\' eseguito SaniDrive.\n')
+        'relativamente alla directory da cui e\' eseguito SaniDrive. Le impegnative di un file .json sono '+
+        'importate, la prima volta, in un database con lo stesso nome ed estensione .db, che e\' quello '+
+        'effettivamente usato.\n')
     parser.add_argument('--driver', dest='driverFile', default='', metavar='FILE',
         help='Specifica il percorso dell\'eseguibile di ChromeDriver. E\' bene usare un percorso assoluto '+
         'per garantire l\'uso del file corretto. Il percorso di default e\' "../../data/chromedriver-win64/chromedriver.exe", '+
@@ -84,14 +88,221 @@ def parse_arguments() -> Namespace:
         "file audio o aprire un collegamento a un video, ma eseguire un "+
         "file arbitrario puo' essere un modo di estendere le funzionalita' "+
         "di SaniDrive.", metavar='FILE')
+    parser.add_argument('--metriche', dest='metricsFile', default=None,
+        action='store', metavar='FILE', help="Specifica il percorso di un "+
+        "file di testo in formato Prometheus, riscritto ad ogni "+
+        "aggiornamento, con i tempi di ogni fase del ciclo e i contatori di "+
+        "aggiornamenti, cambiamenti, errori e notifiche.\n")
+    parser.add_argument('--metriche-porta', dest='metricsPort', default=None,
+        type=int, action='store', metavar='PORTA', help="Espone le stesse "+
+        "metriche all'indirizzo http://127.0.0.1:PORTA/metrics.\n")
+    parser.add_argument('--metriche-json', dest='metricsJson', default=None,
+        action='store', metavar='FILE', help="Specifica il percorso di un "+
+        "file a cui aggiungere una riga JSON con i tempi di ogni ciclo. Se "+
+        "nessuna delle opzioni --metriche e' usata, le metriche non sono "+
+        "raccolte.\n")
+    parser.add_argument('--registra', dest='recordDir', default=None,
+        action='store', metavar='CARTELLA', help="Salva nella cartella "+
+        "specificata la lista degli appuntamenti di ogni aggiornamento, e la "+
+        "pagina intera quando qualcosa va storto. Le liste identiche sono "+
+        "salvate una volta sola e compresse. Le registrazioni possono essere "+
+        "riprodotte con snapshot.py.\n")
+    parser.add_argument('--rete', dest='network', default=False,
+        action='store_true', help="Leggi gli appuntamenti direttamente "+
+        "dalle risposte ricevute dal browser anziche' dalla pagina "+
+        "visualizzata, che e' usata solo se la lista non viene trovata.\n")
+    parser.add_argument('--rete-verifica', dest='networkParity',
+        default=False, action='store_true', help="Come --rete, ma legge la "+
+        "lista anche dalla pagina ad ogni aggiornamento e conta le "+
+        "differenze tra i due metodi, usando quella della pagina.\n")
+    parser.add_argument('--estrai-sempre', dest='alwaysExtract',
+        default=False, action='store_true', help="Di default, la lista "+
+        "degli appuntamenti viene letta di nuovo solo se e' cambiata "+
+        "dall'aggiornamento precedente, cosa che il browser verifica "+
+        "calcolandone un'impronta. Con questa opzione la lista viene letta "+
+        "ad ogni aggiornamento.\n")
+    parser.add_argument('--importa', dest='importFile', default=None,
+        action='store', metavar='FILE', help="Importa le impegnative di un "+
+        "file CSV, con intestazione cf,nre,nome,nota, oppure JSON lines, con "+
+        "le stesse chiavi, nel file delle credenziali ed esci. Codice fiscale "+
+        "e NRE sono verificati, le righe non valide o gia' presenti sono "+
+        "segnalate e saltate.\n")
+    parser.add_argument('--verifica', dest='verify', default=False,
+        action='store_true', help="Prima di iniziare, verifica sul sito "+
+        "tutte le impegnative salvate, con piu' browser in parallelo, e "+
+        "segnala quelle scadute, gia' prenotate o con credenziali errate. "+
+        "L'esito e' ricordato per il tempo indicato da --verifica-validita, "+
+        "durante il quale le impegnative non utilizzabili non sono proposte "+
+        "e quelle gia' verificate non sono verificate di nuovo.\n")
+    parser.add_argument('--verifica-browser', dest='verifyWorkers', default=3,
+        action='store', metavar='N', help="Numero massimo di browser usati "+
+        "in parallelo da --verifica. Default: 3.\n")
+    parser.add_argument('--verifica-validita', dest='verifyTtl', default=12,
+        action='store', metavar='ORE', help="Per quante ore l'esito di una "+
+        "verifica resta valido. Default: 12.\n")
+    parser.add_argument('--regole', dest='rulesFile', default=None,
+        action='store', metavar='FILE', help="File TOML con le regole che "+
+        "un appuntamento deve soddisfare, oltre ad essere prima della data "+
+        "specificata, per essere notificato: strutture, comuni da escludere, "+
+        "giorni della settimana, fascia oraria, preavviso minimo, anche "+
+        "diverse per ogni impegnativa. Basta che un appuntamento soddisfi una "+
+        "sola regola. La sintassi e' descritta nel README.\n")
+    parser.add_argument('--casa', dest='home', default=None, action='store',
+        metavar='LUOGO', help="Il comune in cui abiti, oppure le sue "+
+        "coordinate nel formato latitudine,longitudine. Le strutture sono "+
+        "mostrate con la loro distanza da casa, dalla piu' vicina. Gli "+
+        "indirizzi che SaniDrive non riesce a localizzare sono salvati in "+
+        "data/indirizzi_sconosciuti.txt.\n")
+    parser.add_argument('--distanza-massima', dest='maxDistance', default=None,
+        action='store', metavar='KM', help="Con --casa, non avvisare per "+
+        "appuntamenti in strutture piu' lontane di KM chilometri. Gli "+
+        "appuntamenti in strutture che non e' stato possibile localizzare "+
+        "sono notificati comunque.\n")
+    parser.add_argument('--riavvia-ogni', dest='recycleCycles', default=0,
+        action='store', metavar='N', help="Sostituisci il browser con uno "+
+        "nuovo ogni N aggiornamenti. Il nuovo browser raggiunge la lista "+
+        "prima che il vecchio venga chiuso, quindi nessun aggiornamento va "+
+        "perso. Default: 0, cioe' mai.\n")
+    parser.add_argument('--riavvia-dopo', dest='recycleHours', default=12,
+        action='store', metavar='ORE', help="Sostituisci il browser dopo "+
+        "ORE ore di funzionamento. 0 per non sostituirlo mai. Default: 12.\n")
+    parser.add_argument('--memoria-massima', dest='maxMemory', default=1024,
+        action='store', metavar='MB', help="Sostituisci il browser quando la "+
+        "memoria usata da ChromeDriver, Chrome e le sue schede supera MB "+
+        "megabyte. 0 per non sostituirlo mai. Default: 1024.\n")
+    parser.add_argument('--porta-debug', dest='debugPort', default=9222,
+        action='store', metavar='PORTA', help="Porta di debug remoto di "+
+        "Chrome. Durante una sostituzione i due browser usano PORTA e "+
+        "PORTA+1; con 0 la porta e' scelta automaticamente. Default: 9222.\n")
+    parser.add_argument('--stato', dest='stateFile', default='',
+        action='store', metavar='FILE', help="File in cui salvare lo stato "+
+        "del monitoraggio alla fine di ogni aggiornamento, per poterlo "+
+        "riprendere con --riprendi. Il percorso di default e' "+
+        "\"../../data/stato-NRE.json\", uno per impegnativa, relativamente "+
+        "alla directory da cui e' eseguito SaniDrive.\n")
+    parser.add_argument('--riprendi', dest='resume', default=None,
+        nargs='?', const='', metavar='NRE', help="Riprendi il monitoraggio "+
+        "interrotto, per esempio da un riavvio del computer, dallo stato "+
+        "salvato: stessa impegnativa, stessa data, stesso appuntamento piu' "+
+        "vicino e stesse statistiche, senza alcuna domanda. Se ci sono piu' "+
+        "monitoraggi da riprendere, indica l'NRE di quello voluto. Le altre "+
+        "opzioni vanno ripetute.\n")
+    parser.add_argument('--notifiche', dest='ledgerFile', default='',
+        action='store', metavar='FILE', help="Database in cui sono ricordati "+
+        "gli appuntamenti gia' notificati, condiviso da tutte le istanze di "+
+        "SaniDrive, cosi' che nessun appuntamento venga notificato due volte, "+
+        "nemmeno dopo un riavvio. Il percorso di default e' "+
+        "\"../../data/notifiche.db\", relativamente alla directory da cui e' "+
+        "eseguito SaniDrive.\n")
+    parser.add_argument('--notifiche-validita', dest='ledgerTtl', default=24,
+        action='store', metavar='ORE', help="Dopo quante ore un appuntamento "+
+        "gia' notificato puo' esserlo di nuovo. Default: 24.\n")
+    parser.add_argument('--notifiche-finestra', dest='digestWindow',
+        default=60, action='store', metavar='SECONDI', help="Per quanti "+
+        "secondi raccogliere i nuovi appuntamenti in una sola notifica, con "+
+        "il migliore in testa. Un appuntamento migliore di tutti quelli gia' "+
+        "notificati e' notificato subito. 0 per notificare a ogni "+
+        "aggiornamento. Default: 60.\n")
+    parser.add_argument('--notifiche-ora', dest='notifPerHour', default=12,
+        action='store', metavar='N', help="Quante notifiche all'ora, in "+
+        "media, possono essere inviate sul desktop e con il suono o il "+
+        "programma di --exec, ciascuno per conto suo. Default: 12.\n")
+    parser.add_argument('--notifiche-raffica', dest='notifBurst', default=3,
+        action='store', metavar='N', help="Quante notifiche possono essere "+
+        "inviate una dopo l'altra prima che si applichi il limite di "+
+        "--notifiche-ora. Default: 3.\n")
+    parser.add_argument('--instabile', dest='flapToggles', default=4,
+        action='store', metavar='N', help="Dopo quante comparse e sparizioni "+
+        "in un'ora un appuntamento non e' piu' notificato, finche' non smette "+
+        "di comparire e sparire. 0 per notificarlo sempre. Default: 4.\n")
+    parser.add_argument('--api', dest='apiPort', default=None, type=int,
+        action='store', metavar='PORTA', help="Espone lo stato del "+
+        "monitoraggio all'indirizzo http://127.0.0.1:PORTA: appuntamenti, "+
+        "appuntamento piu' vicino, contatori e tempi in JSON, e un flusso di "+
+        "eventi (server-sent events) per ogni appuntamento che compare o "+
+        "sparisce. Vedi il README per i dettagli.\n")
+    parser.add_argument('--eventi', dest='eventsFile', default=None,
+        action='store', metavar='FILE', help="Scrivi nel file specificato "+
+        "un log degli eventi in formato JSON lines: inizio e fine di ogni "+
+        "aggiornamento con i tempi delle fasi, appuntamenti comparsi e "+
+        "spariti, notifiche, errori e riprese. Il log e' archiviato e "+
+        "compresso quando diventa troppo grande o vecchio, e puo' essere "+
+        "consultato con eventlog.py.\n")
+    parser.add_argument('--eventi-dimensione', dest='eventsMb', default=10,
+        action='store', metavar='MB', help="Dimensione oltre la quale il log "+
+        "degli eventi e' archiviato. Default: 10.\n")
+    parser.add_argument('--eventi-ore', dest='eventsHours', default=24,
+        action='store', metavar='ORE', help="Dopo quante ore il log degli "+
+        "eventi e' archiviato. Default: 24.\n")
+    parser.add_argument('--eventi-archivi', dest='eventsKeep', default=45,
+        action='store', metavar='N', help="Quanti archivi del log degli "+
+        "eventi conservare, i piu' vecchi sono cancellati. Default: 45.\n")
+    parser.add_argument('--condividi', dest='shareDir', default=None,
+        action='store', metavar='CARTELLA', help="Condividi la lista degli "+
+        "appuntamenti con le altre istanze di SaniDrive che controllano la "+
+        "stessa impegnativa e usano la stessa cartella: la lista e' letta dal "+
+        "sito una sola volta per intervallo e ricevuta da tutte, ognuna con "+
+        "la propria data e le proprie regole.\n")
+    parser.add_argument('--limite-accessi', dest='hostRate', default=0,
+        action='store', metavar='N', help="Quanti accessi al minuto al sito "+
+        "del CUP sono permessi a tutte le istanze di SaniDrive in esecuzione "+
+        "sul computer messe insieme, che si mettono in fila per rispettarlo. "+
+        "0 per nessun limite. Default: 0.\n")
+    parser.add_argument('--limite-raffica', dest='hostBurst', default=1,
+        action='store', metavar='N', help="Quanti accessi possono avvenire "+
+        "uno dopo l'altro, dopo un periodo di quiete, prima che si applichi "+
+        "--limite-accessi. Default: 1.\n")
+    parser.add_argument('--limite-file', dest='hostLimitFile', default='',
+        action='store', metavar='FILE', help="File condiviso dalle istanze "+
+        "per rispettare --limite-accessi. Il percorso di default e' "+
+        "\"../../data/limite.json\", relativamente alla directory da cui e' "+
+        "eseguito SaniDrive.\n")
+    parser.add_argument('--profila', '--profile', dest='profile',
+        default=False, action='store_true', help="Profila ogni "+
+        "aggiornamento campionando lo stack di SaniDrive e conserva i profili "+
+        "degli aggiornamenti piu' lenti, pronti per un flame graph, con i "+
+        "tempi di ogni fase.\n")
+    parser.add_argument('--profila-cartella', dest='profileDir', default='',
+        action='store', metavar='CARTELLA', help="Dove scrivere i profili. "+
+        "Il percorso di default e' \"../../data/profili\", relativamente "+
+        "alla directory da cui e' eseguito SaniDrive.\n")
+    parser.add_argument('--profila-cicli', dest='profileKeep', default=5,
+        type=int, action='store', metavar='N', help="Quanti degli aggiornamenti piu' "+
+        "lenti conservare. Default: 5.\n")
+    parser.add_argument('--config', '-c', dest='configFile', default=None,
+        action='store', metavar='FILE', help="Specifica il percorso del file "+
+        "di configurazione, in formato TOML, con le opzioni da usare quando "+
+        "non sono date da linea di comando o con una variabile d'ambiente "+
+        "SANIDRIVE_. Il percorso di default e' \"../../data/sanidrive.toml\", "+
+        "relativamente alla directory da cui e' eseguito SaniDrive, e il file "+
+        "puo' mancare. Alcune opzioni, come --intervallo, --data e --regole, "+
+        "sono rilette dal file mentre SaniDrive e' in esecuzione.\n")
     parser.add_argument('--aiuto', '-a', dest='help', default=False,
         action='store_true', help='Scrivi questo messaggio di aiuto ed esci.')
-    args = parser.parse_args()
+    argv = sys.argv[1:]
+    args = parser.parse_args(argv)
     
     if args.help:
         parser.print_help()
         exit(0)
 
+    # layer the configuration file and the environment below the flags
+    root = os.path.dirname(os.path.realpath(__file__))
+    path = args.configFile or os.environ.get(config.ENV_PREFIX + 'CONFIG')
+    if path is None:
+        path = os.path.join(root, '../../data/sanidrive.toml')
+    elif not os.path.isfile(path):
+        print(f"\nIl file di configurazione {path} non esiste.")
+        exit(1)
+    try:
+        configuration = config.Configuration(parser, argv,
+                                             os.path.abspath(path))
+        configuration.apply(args)
+    except config.ConfigError as e:
+        print(f"\nErrore nella configurazione: {e}.")
+        exit(1)
+    args.configuration = configuration
+
     return args
 
 def download_chromedriver(dir_path: str) -> str:
@@ -338,7 +549,7 @@ def _center(string: str, n: int, center_last: bool = False,
 
     return lines_printed
 
-def _fail(reason: str = '', masculine: bool = True) -> None:
+def _fail(reason: str = '', masculine: bool = True, details: str = '') -> None:
     """
     Internal function that prints info on failure for user
     
@@ -346,10 +557,14 @@ def _fail(reason: str = '', masculine: bool = True) -> None:
     ----------
     reason : str
         Valid strings are 'layout', 'date', 'session', 'automatic_download',
-        'driver_path', ''.
+        'driver_path', 'credentials', 'prescription', 'rules', 'home', ''.
+    details : str
+        More specific information, printed before the generic message.
     """
     p = lambda s: _center(s, config.line_width)
     start = 'non riuscito.\n' if masculine else 'non riuscita.\n'
+    if details != '':
+        start += details + '\n'
     if reason == 'layout':
         print(start); p("Probabilmente il layout della pagina e' "+
             "cambiato, per favore avvisami con email a "+
@@ -367,10 +582,26 @@ def _fail(reason: str = '', masculine: bool = True) -> None:
         print(start); p("Qualcosa e' andato storto. Per favore riprova, e se "+
               "il problema persiste contattami con email a "+
               "michele.deiana.dev@gmail.com")
+    if reason == 'credentials':
+        print(start); p("Le credenziali dell'impegnativa scelta non sono "+
+            "valide. Crea una nuova impegnativa ed assicurati che siano "+
+            "corrette.")
+    if reason == 'prescription':
+        print(start); p("L'impegnativa scelta non puo' essere usata per "+
+            "prenotare. Scegline un'altra oppure creane una nuova.")
+    if reason == 'rules':
+        print(start); p("Correggi il file delle regole e riprova. La sintassi "+
+            "e' descritta nel README.")
+    if reason == 'home':
+        print(start); p("Controlla il luogo indicato con --casa e riprova.")
     if reason =='driver_path':
         p("Errore: il percorso specificato per l'eseguibile di ChromeDriver " \
           "deve essere un file o una cartella esistente; se si sepecifica " \
           "una cartella, ChromeDriver verra' scaricato nella stessa.")
     if reason == '':
         print("Errore generico: qualcosa e' andato storto.")
+    # export what was collected so far before leaving
+    metrics.inc('failures')
+    metrics.end_cycle()
+    eventlog.emit('errore', motivo=reason or 'generico', dettagli=details)
     sys.exit(1)
\ No newline at end of file
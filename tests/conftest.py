@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the modules import each other by name, as when SaniDrive.py is run
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src',
+                                'SaniDrive'))
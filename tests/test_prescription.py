@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+from prescription import (Prescription, PrescriptionStore,
+                          import_prescriptions)
+
+CF = 'RSSMRA80A01H501U'
+
+@pytest.mark.parametrize('cf', [
+    CF,
+    'RSSMRA80A41B354A',     # women have 40 added to the day
+    'RSSMRAULALMB354H',     # omocodia, digits replaced by letters
+    'BNCLRA85T50H501X',
+])
+def test_cf_valid(cf):
+    assert Prescription.cf_is_valid(cf) == (True, '')
+
+@pytest.mark.parametrize('cf, reason', [
+    (CF[:-1], 'cf_length'),
+    (CF + 'A', 'cf_length'),
+    ('RSSMRA80Z01H501U', 'cf_format'),  # Z is not a month
+    ('RSSMRA8AA01H501U', 'cf_format'),  # A is not an omocodia letter
+    ('1SSMRA80A01H501U', 'cf_format'),
+    ('RSSMRA80A32H501U', 'cf_day'),
+    ('RSSMRA80A00H501U', 'cf_day'),
+    ('RSSMRA80A72H501U', 'cf_day'),
+    ('RSSMRA80A01H501V', 'cf_checksum'),
+    ('RSSMRA80A01H501W', 'cf_checksum'),
+])
+def test_cf_invalid(cf, reason):
+    assert Prescription.cf_is_valid(cf) == (False, reason)
+
+@pytest.mark.parametrize('nre, expected', [
+    ('2000A1234567890', (True, '')),
+    ('2000A123456789', (False, 'nre_length')),
+    ('2000A 1234567890', (False, 'nre_length')),
+    ('2001A1234567890', (False, 'nre_prefix')),
+    ('2000B1234567890', (False, 'nre_prefix')),
+    ('2000A12345678X0', (False, 'nre_digits')),
+])
+def test_nre(nre, expected):
+    assert Prescription.nre_is_valid(nre) == expected
+
+def test_is_valid_ignores_case_and_spaces():
+    assert Prescription(' ' + CF.lower(), '2000a1234567890 ', '', ''
+                        ).is_valid() == (True, '')
+
+def test_import_reports_bad_rows(tmp_path):
+    rows = [{'cf': CF, 'nre': '2000A0000000001', 'nome': 5},
+            {'cf': CF.lower(), 'nre': ' 2000a0000000002', 'nome': 'Prova'},
+            [CF, '2000A0000000003'],
+            {'cf': [CF], 'nre': '2000A0000000004'},
+            {'cf': CF, 'nre': '2000A0000000005'}]
+    path = tmp_path / 'impegnative.jsonl'
+    path.write_text('\n'.join(json.dumps(r) for r in rows) +
+                    '\n{"cf": \n', encoding='utf-8')
+    store = PrescriptionStore(str(tmp_path / 'impegnative.db'))
+    try:
+        added, duplicates, errors = import_prescriptions(str(path), store)
+        assert (added, duplicates) == (2, 0)
+        assert [n for n, _ in errors] == [1, 3, 4, 6]
+        assert store.get(CF, '2000A0000000002').name == 'Prova'
+    finally:
+        store.close()
+
+def test_import_csv(tmp_path):
+    path = tmp_path / 'impegnative.csv'
+    path.write_text(f'cf;nre;nome\n{CF};2000A0000000001;Prova\n'+
+                    f'{CF};2000A0000000001;Doppia\n'+
+                    'RSSMRA80A01H501V;2000A0000000002;\n', encoding='utf-8')
+    store = PrescriptionStore(str(tmp_path / 'impegnative.db'))
+    try:
+        assert import_prescriptions(str(path), store) == (
+            1, 1, [(4, "l'ultimo carattere del Codice Fiscale non "+
+                    "corrisponde agli altri, probabilmente c'e' un errore "+
+                    "di battitura")])
+    finally:
+        store.close()